@@ -0,0 +1,79 @@
+"""
+Benchmark GraFT inference throughput against the number of worker
+processes, on a synthetic calcium-imaging movie.
+
+    python benchmark_graft.py --size 256 --frames 2000 --workers 1 2 4 8 16 32
+
+Every run fits the same data with the same settings; only n_workers differs.
+Reported are pixel-iterations per second of the solver loop (graph
+construction and shared memory setup excluded) and the speedup over the
+first entry of --workers. BLAS runs on one thread in every run, as it does
+in the pool workers, so the speedup reflects the worker count only.
+"""
+
+import argparse
+import os
+import time
+
+from process_pool import BLAS_THREAD_VARIABLES
+
+# Must be set before numpy loads its BLAS
+os.environ.update(dict.fromkeys(BLAS_THREAD_VARIABLES, "1"))
+
+import numpy as np
+
+from graft_engine import GraFTEngine, auto_workers
+from pixel_graph import KNNGraphBuilder
+
+
+def synthetic_movie(size=128, n_frames=1000, n_cells=None, noise=0.3, seed=0):
+    """
+    (size * size, n_frames) pixel matrix of Gaussian cells with sparse,
+    exponentially decaying transients, plus the pixel coordinates.
+    """
+    rng = np.random.default_rng(seed)
+    n_cells = n_cells or max(4, size * size // 400)
+    yy, xx = np.mgrid[:size, :size]
+    centers = rng.uniform(4, size - 4, size=(n_cells, 2))
+    maps = np.exp(-((yy[None] - centers[:, 0, None, None]) ** 2 + (xx[None] - centers[:, 1, None, None]) ** 2)
+                  / (2 * 3.0 ** 2)).reshape(n_cells, -1).T.astype(np.float32)
+    spikes = (rng.random((n_cells, n_frames)) < 0.02).astype(np.float32)
+    kernel = np.exp(-np.arange(40) / 8.0).astype(np.float32)
+    traces = np.stack([np.convolve(s, kernel)[:n_frames] for s in spikes])
+    data = maps @ traces + 100 + noise * rng.standard_normal((size * size, n_frames)).astype(np.float32)
+    coords = np.stack(np.unravel_index(np.arange(size * size), (size, size)), axis=1)
+    return data.astype(np.float32), coords
+
+
+def run_benchmark(size, n_frames, workers, n_components, n_iterations):
+    data, coords = synthetic_movie(size, n_frames)
+    graph = KNNGraphBuilder(method="spatial").build(data, coords)
+    print(f"[Benchmark] {data.shape[0]} pixels x {n_frames} frames, {n_components} components, "
+          f"{n_iterations} iterations, {os.cpu_count()} CPUs; n_workers=None would use "
+          f"{auto_workers(*data.shape)}")
+
+    results = []
+    for n_workers in workers:
+        engine = GraFTEngine(n_components=n_components, n_iterations=n_iterations, n_workers=n_workers)
+        started = time.perf_counter()
+        engine.fit(data, graph=graph)
+        total = time.perf_counter() - started
+        solver = sum(entry['seconds'] for entry in engine.history)
+        rate = data.shape[0] * len(engine.history) / solver  # fits may stop early on convergence
+        results.append((n_workers, rate))
+        print(f"  {n_workers:3d} workers: {rate:12.0f} pixel-iterations/s  (solver {solver:.2f}s, "
+              f"total {total:.2f}s, {len(engine.history)} iterations, speedup {rate / results[0][1]:.2f}x, "
+              f"objective {engine.history[-1]['objective']:.6g})")
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--size", type=int, default=128, help="field of view is size x size pixels")
+    parser.add_argument("--frames", type=int, default=1000)
+    parser.add_argument("--components", type=int, default=20)
+    parser.add_argument("--iterations", type=int, default=5)
+    parser.add_argument("--workers", type=int, nargs="+",
+                        default=sorted({1, 2, 4, os.cpu_count() or 1}))
+    args = parser.parse_args()
+    run_benchmark(args.size, args.frames, args.workers, args.components, args.iterations)
@@ -0,0 +1,314 @@
+import os
+import re
+
+import h5py
+import numpy as np
+import scipy.io
+
+from image_sequence import ImageSequence
+from lazy_dataset import LazyH5Dataset
+from tiff_stack import TiffStack
+
+
+###############################################################################
+# File-format loaders
+#
+# These functions know nothing about Qt so they can run on a worker thread
+# (see load_worker.DataLoadWorker) or from a script. Each returns a dict that
+# maps the selected item name to its data: a lazy handle where the format
+# allows it, otherwise an in-memory array.
+###############################################################################
+def load_selected_data(data_path, selected_items):
+    """
+    Dispatch to the loader matching the file extension of data_path.
+    """
+    if os.path.isdir(data_path):
+        return load_image_folder_data(data_path, selected_items)
+    elif data_path.lower().endswith(('.h5', '.hdf5')):
+        return load_hdf5_data(data_path, selected_items)
+    elif data_path.lower().endswith('.mat'):
+        return load_mat_data(data_path, selected_items)
+    elif data_path.lower().endswith('.nwb'):
+        return load_nwb_data(data_path, selected_items)
+    elif data_path.lower().endswith(('.tif', '.tiff')):
+        return load_tiff_data(data_path, selected_items)
+    else:
+        print("[DataLoader] Unsupported file type.")
+        return {}
+
+
+def is_mat73(file_path):
+    """
+    Returns True if file_path is a MATLAB v7.3 file (i.e., an HDF5 file),
+    False otherwise.
+    """
+    try:
+        with open(file_path, 'rb') as f:
+            header = f.read(128)
+        return b'MATLAB 7.3 MAT-file' in header
+    except Exception:
+        return False
+
+
+# MATLAB classes that map onto a plain numpy dtype (char is stored as UTF-16).
+MAT_CLASS_DTYPES = {
+    'double': np.dtype('float64'), 'single': np.dtype('float32'),
+    'int8': np.dtype('int8'), 'uint8': np.dtype('uint8'),
+    'int16': np.dtype('int16'), 'uint16': np.dtype('uint16'),
+    'int32': np.dtype('int32'), 'uint32': np.dtype('uint32'),
+    'int64': np.dtype('int64'), 'uint64': np.dtype('uint64'),
+    'logical': np.dtype('bool'), 'char': np.dtype('uint16'),
+}
+
+
+def scan_mat_variables(mat_path):
+    """
+    List the variables of a v4/v5 .mat file without decoding any array payload.
+
+    scipy.io.whosmat reads only the tag and array header of each variable and
+    seeks past the data, so this stays fast on multi-GB files.
+    Returns a list of dicts with keys: name, shape, mat_class, dtype, nbytes.
+    nbytes is None for classes without a fixed element size (cell, struct, ...).
+    """
+    variables = []
+    for name, shape, mat_class in scipy.io.whosmat(mat_path):
+        dtype = MAT_CLASS_DTYPES.get(mat_class)
+        nbytes = int(np.prod(shape, dtype=np.int64)) * dtype.itemsize if dtype is not None else None
+        variables.append({
+            'name': name,
+            'shape': tuple(shape),
+            'mat_class': mat_class,
+            'dtype': str(dtype) if dtype is not None else mat_class,
+            'nbytes': nbytes,
+        })
+    return variables
+
+
+def load_hdf5_data(data_path, selected_items):
+    """
+    Open selected datasets from an HDF5 (.h5 or .hdf5) file as lazy handles.
+    Nothing is read here; consumers slice the handle to pull frames/ROIs from disk.
+    Works on both Windows and Unix-based systems (macOS, Linux).
+    """
+    loaded_data = {}
+    for full_path, dtype in selected_items:
+        # Extract only the internal dataset path inside the HDF5 file
+        relative_path = full_path.replace(data_path, "").lstrip("/").lstrip("\\")  # Normalize path
+        dataset_path = re.sub(r'^.*\.h5/', '', relative_path)  # Removes everything up to and including ".h5/"
+
+        print(f"[DataLoader] Trying to load dataset: '{relative_path}'")
+
+        try:
+            data = LazyH5Dataset(data_path, dataset_path)
+        except KeyError:
+            print(f"[DataLoader] Dataset '{relative_path}' not found in HDF5 file. Available datasets:")
+            def print_hdf5_structure(name, obj):
+                print(f" - {name}")
+
+            try:
+                with h5py.File(data_path, 'r') as f:
+                    f.visititems(print_hdf5_structure)  # for debugging
+            except Exception as e:
+                print(f"[DataLoader] Error loading HDF5 file: {e}")
+            continue
+        except Exception as e:
+            print(f"[DataLoader] Error loading HDF5 file: {e}")
+            continue
+
+        loaded_data[relative_path] = data
+        if data.mode == "mmap":
+            print(f"[DataLoader] '{relative_path}' is contiguous and uncompressed: using zero-copy memory map.")
+        else:
+            print(f"[DataLoader] '{relative_path}' cannot be memory-mapped ({data.chunked_reason}): "
+                  f"using on-demand HDF5 reads.")
+        print(f"\n[DataLoader] Successfully opened dataset '{relative_path}': {data}")
+
+    return loaded_data
+
+
+def load_mat_data(data_path, selected_items):
+    """
+    Load selected variables from a MATLAB .mat file and print the result.
+    """
+    if is_mat73(data_path):
+        # If it's a MATLAB v7.3 file, treat it like an HDF5 file
+        return load_hdf5_data(data_path, selected_items)
+
+    loaded_data = {}
+    try:
+        var_names = [os.path.basename(full_path) for full_path, dtype in selected_items]
+
+        # Decode only the selected variables; the others are skipped by seeking past them
+        mat_dict = scipy.io.loadmat(data_path, variable_names=var_names,
+                                    squeeze_me=False, struct_as_record=False)
+
+        for var_name in var_names:
+            if var_name in mat_dict:
+                data = mat_dict[var_name]  # Extract data
+
+                # Convert MATLAB struct objects to dictionary for readability
+                if isinstance(data, np.ndarray) and data.dtype.names is not None:
+                    data = {field: data[field] for field in data.dtype.names}
+
+                loaded_data[var_name] = data  # Store loaded variable
+                print(f"\n[DataLoader] Successfully loaded variable '{var_name}':\n", data) # print for now
+
+            else:
+                print(f"[DataLoader] '{var_name}' not found in .mat file.")
+
+    except Exception as e:
+        print(f"[DataLoader] Error loading .mat file: {e}")
+
+    return loaded_data
+
+
+# Top-level NWB sections shown in the preview, as (label, path in the HDF5 file)
+NWB_SECTIONS = [
+    ("Acquisition", "acquisition"),
+    ("Processing", "processing"),
+    ("Stimulus", "stimulus/presentation"),
+    ("Stimulus Templates", "stimulus/templates"),
+]
+
+
+def scan_nwb_containers(nwb_path, max_depth=4):
+    """
+    Describe the acquisition, processing and stimulus containers of an NWB file
+    by walking its HDF5 layout directly (no pynwb object graph is built).
+
+    Returns a list of section dicts {'name', 'path', 'kind', 'children'}.
+    Each child is a dict with keys name, path, kind, neurodata_type and
+    children; containers that hold a `data` dataset (TimeSeries and friends)
+    have kind 'Dataset' plus shape, dtype and nbytes of that dataset.
+    """
+    sections = []
+    with h5py.File(nwb_path, 'r') as f:
+        for label, path in NWB_SECTIONS:
+            if path not in f or len(f[path]) == 0:
+                continue
+            sections.append({
+                'name': label,
+                'path': path,
+                'kind': 'Group',
+                'children': _scan_nwb_group(f[path], max_depth),
+            })
+    return sections
+
+
+def _scan_nwb_group(group, depth):
+    entries = []
+    for key in group.keys():
+        obj = group.get(key)
+        if not isinstance(obj, h5py.Group):
+            continue  # loose datasets (descriptions, ids, ...) are not containers
+        neurodata_type = obj.attrs.get('neurodata_type', '')
+        if isinstance(neurodata_type, bytes):
+            neurodata_type = neurodata_type.decode()
+
+        entry = {'name': key, 'path': obj.name.lstrip("/"),
+                 'neurodata_type': neurodata_type, 'children': []}
+        data = obj.get('data')
+        if isinstance(data, h5py.Dataset):
+            entry.update(kind='Dataset', shape=data.shape, dtype=str(data.dtype),
+                         nbytes=data.size * data.dtype.itemsize)
+        else:
+            entry['kind'] = 'Module' if neurodata_type == 'ProcessingModule' else 'Group'
+            if depth > 1:
+                entry['children'] = _scan_nwb_group(obj, depth - 1)
+            if not entry['children'] and neurodata_type != 'ProcessingModule':
+                continue  # tables, segmentations etc. without loadable traces
+        entries.append(entry)
+    return entries
+
+
+def resolve_nwb_dataset_path(h5_file, container_path):
+    """
+    Map a container path such as 'processing/ophys/Fluorescence/RoiResponseSeries'
+    (or a bare acquisition/stimulus name) to the path of its `data` dataset.
+    Returns None if nothing matches.
+    """
+    container_path = container_path.replace("\\", "/").strip("/")
+    candidates = [container_path] + [f"{section}/{container_path}" for _, section in NWB_SECTIONS
+                                     if section != "processing"]
+    for path in candidates:
+        obj = h5_file.get(path)
+        if isinstance(obj, h5py.Dataset):
+            return obj.name
+        if isinstance(obj, h5py.Group) and isinstance(obj.get('data'), h5py.Dataset):
+            return obj['data'].name
+    return None
+
+
+def load_nwb_data(data_path, selected_items):
+    """
+    Open selected containers of an NWB file as lazy handles on their `data` dataset.
+    Only the selected containers are resolved, straight from the HDF5 layout.
+    """
+    loaded_data = {}
+    try:
+        with h5py.File(data_path, 'r') as f:
+            dataset_paths = {}
+            for full_path, dtype in selected_items:
+                name = full_path.replace(data_path, "").lstrip("/").lstrip("\\")
+                dataset_path = resolve_nwb_dataset_path(f, name)
+                if dataset_path is None:
+                    print(f"[DataLoader] '{name}' not found in NWB file.")
+                else:
+                    dataset_paths[name] = dataset_path
+    except Exception as e:
+        print(f"[DataLoader] Error loading NWB file: {e}")
+        return loaded_data
+
+    for name, dataset_path in dataset_paths.items():
+        try:
+            loaded_data[name] = LazyH5Dataset(data_path, dataset_path)
+            print(f"[DataLoader] Opened dataset '{name}' from NWB file ({loaded_data[name].mode}).")
+        except Exception as e:
+            print(f"[DataLoader] Error extracting '{name}' from NWB: {e}")
+
+    return loaded_data
+
+
+def load_image_folder_data(folder_path, selected_items):
+    """
+    Present the image files selected in a folder as one (T, H, W) ImageSequence.
+    Frames are stacked in selection order, which follows the preview tree.
+    """
+    paths = [os.path.join(folder_path, os.path.basename(full_path))
+             for full_path, dtype in selected_items if dtype == "Image Type"]
+    if not paths:
+        print("[DataLoader] No image files selected.")
+        return {}
+
+    name = os.path.basename(os.path.normpath(folder_path))
+    try:
+        sequence = ImageSequence(paths)
+    except Exception as e:
+        print(f"[DataLoader] Error reading image folder: {e}")
+        return {}
+
+    print(f"[DataLoader] Opened image sequence '{name}': {sequence}")
+    return {name: sequence}
+
+
+def load_tiff_data(tiff_path, selected_items):
+    """
+    Open a multi-page TIFF/BigTIFF as a lazy TiffStack (memory-mapped when
+    the pages are uncompressed and evenly spaced, decoded on demand otherwise).
+    """
+    if not selected_items:
+        return {}
+
+    name = os.path.basename(tiff_path)
+    try:
+        stack = TiffStack(tiff_path)
+    except Exception as e:
+        print(f"[DataLoader] Error loading TIFF file: {e}")
+        return {}
+
+    if stack.mode == "mmap":
+        print(f"[DataLoader] '{name}' pages are uncompressed and evenly spaced: using zero-copy memory map.")
+    else:
+        print(f"[DataLoader] '{name}' pages are compressed or scattered: decoding pages on demand.")
+    print(f"[DataLoader] Opened TIFF stack '{name}': {stack}")
+    return {name: stack}
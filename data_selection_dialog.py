@@ -5,8 +5,19 @@ from PyQt6.QtWidgets import (
     QTreeWidget, QTreeWidgetItem,
     QVBoxLayout, QHBoxLayout, QPushButton, QLabel, QMessageBox, QCheckBox
 )
-from PyQt6.QtCore import Qt
-from pynwb import NWBHDF5IO
+from PyQt6.QtCore import Qt, QThread
+
+from data_loaders import is_mat73, scan_mat_variables, scan_nwb_containers
+from folder_scanner import FolderScanWorker
+from preview_cache import PreviewCache
+from tiff_stack import scan_tiff
+
+# File types whose preview tree is kept in the persistent PreviewCache
+CACHED_EXTENSIONS = {".mat", ".h5", ".hdf5", ".nwb", ".tif", ".tiff"}
+
+# Item data roles used by the HDF5/NWB trees
+HDF5_PATH_ROLE = Qt.ItemDataRole.UserRole           # path of the object inside the file
+CHILDREN_PENDING_ROLE = Qt.ItemDataRole.UserRole + 1  # group children not loaded yet
 
 
 class DataSelectionDialog(QDialog):
@@ -19,6 +30,9 @@ class DataSelectionDialog(QDialog):
         self.data_path = data_path
         self.selected_items = []
         self.select_type = ''   # 'Folder' or 'File'
+        self.preview_cache = PreviewCache()
+        self._scan_thread = None
+        self._scan_worker = None
         self.setWindowTitle("Select Data to Load")
 
         # Main layout
@@ -49,6 +63,7 @@ class DataSelectionDialog(QDialog):
         self.ok_button.clicked.connect(self.on_ok)
         self.cancel_button.clicked.connect(self.on_cancel)
         self.tree_widget.itemChanged.connect(self.limit_dataset_selection)
+        self.tree_widget.itemExpanded.connect(self._on_item_expanded)
 
         self.layout.addLayout(btn_layout)
 
@@ -75,12 +90,19 @@ class DataSelectionDialog(QDialog):
         else:
             _, ext = os.path.splitext(self.data_path)
             ext = ext.lower()
-            if ext == ".mat":
+            cached_rows = self.preview_cache.get(self.data_path) if ext in CACHED_EXTENSIONS else None
+            if cached_rows is not None:
+                # Known, unchanged file: rebuild the preview without touching it
+                self._restore_tree(cached_rows, self.tree_widget.invisibleRootItem())
+                print(f"[DataSelectionDialog] Preview restored from cache for {self.data_path}")
+            elif ext == ".mat":
                 self._populate_tree_with_mat(self.data_path)
             elif ext in [".h5", ".hdf5"]:
                 self._populate_tree_with_hdf5(self.data_path)
             elif ext == ".nwb":
                 self._populate_tree_with_nwb(self.data_path)  # NEW FUNCTION
+            elif ext in [".tif", ".tiff"]:
+                self._populate_tree_with_tiff(self.data_path)
             else:
                 # Fallback for unsupported file type
                 item = QTreeWidgetItem(["(No structured preview)", "Unknown"])
@@ -93,38 +115,120 @@ class DataSelectionDialog(QDialog):
             self.select_type = 'File'
 
 
+    def done(self, result):
+        """
+        Stop a running folder scan and store the preview tree
+        (including groups expanded so far) before closing.
+        """
+        if self._scan_worker is not None:
+            self._scan_worker.cancel()
+        if self._scan_thread is not None and self._scan_thread.isRunning():
+            self._scan_thread.quit()
+            self._scan_thread.wait()
+        self._save_preview_to_cache()
+        super().done(result)
+
+
+    def _save_preview_to_cache(self):
+        if self.select_type != 'File' or self.tree_widget.topLevelItemCount() == 0:
+            return
+        if os.path.splitext(self.data_path)[1].lower() not in CACHED_EXTENSIONS:
+            return
+        try:
+            self.preview_cache.put(self.data_path, self._serialize_tree(self.tree_widget.invisibleRootItem()))
+        except Exception as e:
+            print(f"[DataSelectionDialog] Could not cache preview: {e}")
+
+
+    def _serialize_tree(self, parent_item):
+        """
+        Convert the tree below parent_item into JSON-friendly rows for PreviewCache.
+        """
+        rows = []
+        for i in range(parent_item.childCount()):
+            item = parent_item.child(i)
+            rows.append({
+                'columns': [item.text(c) for c in range(self.tree_widget.columnCount())],
+                'path': item.data(0, HDF5_PATH_ROLE),
+                'pending': bool(item.data(0, CHILDREN_PENDING_ROLE)),
+                'checkable': item.data(0, Qt.ItemDataRole.CheckStateRole) is not None,
+                'tooltip': item.toolTip(0),
+                'children': self._serialize_tree(item),
+            })
+        return rows
+
+
+    def _restore_tree(self, rows, parent_item):
+        """
+        Rebuild tree items from rows produced by _serialize_tree.
+        """
+        for row in rows:
+            item = QTreeWidgetItem(row['columns'])
+            if row['path'] is not None:
+                item.setData(0, HDF5_PATH_ROLE, row['path'])
+            if row['tooltip']:
+                item.setToolTip(0, row['tooltip'])
+            if row['checkable']:
+                item.setCheckState(0, Qt.CheckState.Unchecked)
+            if row['pending']:
+                item.setData(0, CHILDREN_PENDING_ROLE, True)
+                item.setChildIndicatorPolicy(QTreeWidgetItem.ChildIndicatorPolicy.ShowIndicator)
+            parent_item.addChild(item)
+            self._restore_tree(row['children'], item)
+
+
     def _populate_tree_with_folder(self, folder_path):
         """
         Populate the tree widget with image files in the selected folder.
+        The folder is scanned on a background thread and the tree fills in
+        batches, in natural order (frame_2 before frame_10).
         Enables the 'Select all images in folder' checkbox only if more than one image is found.
         """
-        image_extensions = {".tiff", ".tif", ".png", ".jpg", ".jpeg", ".bmp"}
+        self.tree_widget.clear()  # Clear any existing items in the tree
+        self.select_all_images_checkbox.setEnabled(False)  # Enabled once the scan is done
+        self.select_all_images_checkbox.setVisible(False)
+        self.info_label.setText(f"Preview: {folder_path} (scanning...)")
 
-        try:
-            self.tree_widget.clear()  # Clear any existing items in the tree
-            files = [f for f in os.listdir(folder_path) if os.path.splitext(f)[1].lower() in image_extensions]
-            files.sort()
+        self._scan_thread = QThread(self)
+        self._scan_worker = FolderScanWorker(folder_path)
+        self._scan_worker.moveToThread(self._scan_thread)
 
-            if len(files) > 1:
-                self.select_all_images_checkbox.setEnabled(True)  # Enable checkbox
-                self.select_all_images_checkbox.setVisible(True)  # Ensure it's visible
-            else:
-                self.select_all_images_checkbox.setEnabled(False)  # Disable if <= 1 file
-                self.select_all_images_checkbox.setVisible(False)  # Hide it
+        self._scan_thread.started.connect(self._scan_worker.run)
+        self._scan_worker.progress.connect(self._on_folder_scan_progress)
+        self._scan_worker.batch_ready.connect(self._on_folder_batch)
+        self._scan_worker.error.connect(
+            lambda message: QMessageBox.warning(self, "Error", f"Failed to load folder: {message}"))
+        self._scan_worker.finished.connect(self._on_folder_scan_finished)
+        self._scan_worker.finished.connect(self._scan_thread.quit)
+        self._scan_thread.finished.connect(self._scan_worker.deleteLater)
+        self._scan_thread.start()
 
-            for f in files:
-                full_path = os.path.join(folder_path, f)
-                ext = os.path.splitext(f)[1].lower()
-                size_bytes = os.path.getsize(full_path)
-                size_mb = f"{size_bytes / (1024 ** 2):.2f} MB"
 
-                top_item = QTreeWidgetItem([f, "Image Type", "", ext, size_mb])
-                top_item.setCheckState(0, Qt.CheckState.Unchecked)
+    def _on_folder_scan_progress(self, count):
+        self.info_label.setText(f"Preview: {self.data_path} (scanning... {count} images found)")
 
-                self.tree_widget.addTopLevelItem(top_item)
 
-        except Exception as e:
-            QMessageBox.warning(self, "Error", f"Failed to load folder: {e}")
+    def _on_folder_batch(self, files):
+        items = []
+        for f, ext, size_bytes in files:
+            size_mb = f"{size_bytes / (1024 ** 2):.2f} MB"
+
+            top_item = QTreeWidgetItem([f, "Image Type", "", ext, size_mb])
+            top_item.setCheckState(0, Qt.CheckState.Unchecked)
+            items.append(top_item)
+
+        self.tree_widget.addTopLevelItems(items)
+        self.info_label.setText(f"Preview: {self.data_path} "
+                                f"({self.tree_widget.topLevelItemCount()} images listed)")
+
+
+    def _on_folder_scan_finished(self, total):
+        self._scan_worker = None
+        self.info_label.setText(f"Preview: {self.data_path} ({self.tree_widget.topLevelItemCount()} images)")
+
+        if self.tree_widget.topLevelItemCount() > 1:
+            self.select_all_images_checkbox.setEnabled(True)  # Enable checkbox
+            self.select_all_images_checkbox.setVisible(True)  # Ensure it's visible
 
 
     def toggle_all_images_selection(self):
@@ -135,49 +239,40 @@ class DataSelectionDialog(QDialog):
         check_state = (Qt.CheckState.Checked if self.select_all_images_checkbox.isChecked()
                        else Qt.CheckState.Unchecked)
 
+        # Single-selection bookkeeping does not apply to images; skip it for speed
+        self.tree_widget.blockSignals(True)
         for i in range(root.childCount()):
             item = root.child(i)
             if item.text(1) == "Image Type":
                 item.setCheckState(0, check_state)
+        self.tree_widget.blockSignals(False)
+        self.tree_widget.viewport().update()
 
 
     def _populate_tree_with_mat(self, mat_path):
         """
-        Use scipy.io.loadmat for older .mat files. 
+        List the variables of older .mat files from their headers only
+        (name, shape, class, byte size); no array data is decoded here.
         If it's actually v7.3, treat it like HDF5.
         """
-        def is_mat73(file_path):
-            """
-            Returns True if file_path is a MATLAB v7.3 file (i.e., an HDF5 file),
-            False otherwise.
-            """
-            try:
-                with open(file_path, 'rb') as f:
-                    header = f.read(128)
-                return b'MATLAB 7.3 MAT-file' in header
-            except Exception:
-                return False
-
         if is_mat73(mat_path):
             # It's really an HDF5 in disguise. Use our HDF5 routine instead.
             self._populate_tree_with_hdf5(mat_path)
             return
 
-        # Otherwise, try the normal loadmat approach:
+        # Otherwise, scan the MAT v5 variable headers:
         try:
-            import scipy.io
-            mat_dict = scipy.io.loadmat(mat_path, squeeze_me=False, struct_as_record=False)
-            # Filter out the special keys like '__header__', etc.
-            for k in mat_dict:
-                if k.startswith("__"):
-                    continue
-                dtype = str(type(mat_dict[k])) # Dataset type
-                shape = str(mat_dict[k].shape)  # Dataset shape
-                size_bytes = mat_dict[k].nbytes  # Total bytes
-                size_mb = f"{size_bytes / (1024 ** 2):.2f}"  # Convert to MB
+            for var in scan_mat_variables(mat_path):
+                shape = str(var['shape'])  # Dataset shape
+                dtype = var['dtype']  # numpy dtype, or MATLAB class for cell/struct/...
+                if var['nbytes'] is None:
+                    size_mb = ""
+                else:
+                    size_mb = f"{var['nbytes'] / (1024 ** 2):.2f}"  # Convert to MB
 
                 # adding to tree widget item
-                item = QTreeWidgetItem([k, "Dataset", shape, dtype, size_mb])
+                item = QTreeWidgetItem([var['name'], "Dataset", shape, dtype, size_mb])
+                item.setToolTip(0, f"MATLAB class: {var['mat_class']}")
                 item.setCheckState(0, Qt.CheckState.Unchecked)
                 self.tree_widget.addTopLevelItem(item)
         except Exception as e:
@@ -186,10 +281,10 @@ class DataSelectionDialog(QDialog):
 
     def _populate_tree_with_hdf5(self, h5_path):
         """
-        Recursively populates the tree with the structure of an HDF5 file.
+        Populates the tree with the top level of an HDF5 file.
+        Group contents are filled in the first time a group is expanded.
         """
         try:
-            import h5py
             with h5py.File(h5_path, 'r') as f:
                 self._add_hdf5_items(f, self.tree_widget.invisibleRootItem())
 
@@ -199,21 +294,29 @@ class DataSelectionDialog(QDialog):
 
     def _add_hdf5_items(self, h5_group, parent_item, parent_path=""):
         """
-        Recursively adds items from an HDF5 group to the tree, including metadata.
+        Adds the direct children of an HDF5 group to the tree, including metadata.
+        Sub-groups are not visited; they get an expand arrow (if non-empty) and
+        are populated on demand by _on_item_expanded.
 
         Parameters:
         - h5_group: The current HDF5 group (or file) being explored.
         - parent_item: The parent QTreeWidgetItem to which new items are added.
         - parent_path: The full path to the current dataset or group.
         """
+        items = []
         for key in h5_group.keys():
             obj = h5_group[key]
             full_path = f"{parent_path}/{key}".strip("/")  # Construct full dataset path
 
             if isinstance(obj, h5py.Group):  
+                n_children = len(obj)  # Link count from the group info, no traversal
                 item = QTreeWidgetItem([key, "Group", "", "", ""])  # Groups have no shape or size
-                parent_item.addChild(item)
-                self._add_hdf5_items(obj, item, full_path)  # Recursively add children
+                item.setToolTip(0, f"{n_children} items")
+                item.setData(0, HDF5_PATH_ROLE, full_path)
+                if n_children > 0:
+                    item.setData(0, CHILDREN_PENDING_ROLE, True)
+                    item.setChildIndicatorPolicy(QTreeWidgetItem.ChildIndicatorPolicy.ShowIndicator)
+                items.append(item)
 
             elif isinstance(obj, h5py.Dataset):  
                 shape = str(obj.shape)  # Dataset shape
@@ -222,65 +325,91 @@ class DataSelectionDialog(QDialog):
                 size_mb = f"{size_bytes / (1024 ** 2):.2f}"  # Convert to MB
 
                 item = QTreeWidgetItem([key, "Dataset", shape, dtype, size_mb])
+                item.setData(0, HDF5_PATH_ROLE, full_path)
                 item.setCheckState(0, Qt.CheckState.Unchecked)
-                parent_item.addChild(item)          
+                items.append(item)
+
+        parent_item.addChildren(items)
+
+
+    def _on_item_expanded(self, item):
+        """
+        Fills in the children of an HDF5 group the first time it is expanded.
+        """
+        if not item.data(0, CHILDREN_PENDING_ROLE):
+            return
+        item.setData(0, CHILDREN_PENDING_ROLE, False)
+
+        group_path = item.data(0, HDF5_PATH_ROLE)
+        try:
+            with h5py.File(self.data_path, 'r') as f:
+                self._add_hdf5_items(f[group_path], item, group_path)
+        except Exception as e:
+            QMessageBox.warning(self, "Error", f"Failed to read HDF5 group '{group_path}': {e}")
+        finally:
+            item.setChildIndicatorPolicy(
+                QTreeWidgetItem.ChildIndicatorPolicy.DontShowIndicatorWhenChildless)
+
+
+    def _populate_tree_with_tiff(self, tiff_path):
+        """
+        Shows a multi-page TIFF/BigTIFF as a single stack, described from its
+        IFD chain (no pixel data is decoded).
+        """
+        try:
+            info = scan_tiff(tiff_path)
+            shape = str(info['shape'])
+            size_mb = f"{info['nbytes'] / (1024 ** 2):.2f}"  # Convert to MB
+
+            item = QTreeWidgetItem([os.path.basename(tiff_path), "Dataset", shape, info['dtype'], size_mb])
+            item.setToolTip(0, f"{'BigTIFF' if info['bigtiff'] else 'TIFF'}, {info['n_pages']} pages, "
+                               f"compression: {info['compression']}, "
+                               f"{'memory-mappable' if info['memmappable'] else 'decoded on demand'}")
+            item.setCheckState(0, Qt.CheckState.Unchecked)
+            self.tree_widget.addTopLevelItem(item)
+        except Exception as e:
+            QMessageBox.warning(self, "Error", f"Failed to load TIFF file: {e}")
 
 
     def _populate_tree_with_nwb(self, nwb_path):
         """
-        Populates the tree with NWB file contents.
+        Populates the tree with NWB file contents, read from the HDF5 layout.
         """
         try:
-            with NWBHDF5IO(nwb_path, 'r') as io:
-                nwbfile = io.read()
-
-                # Create a top-level NWB item
-                nwb_item = QTreeWidgetItem(["NWB File", "Root", "", "", ""])
-                self.tree_widget.addTopLevelItem(nwb_item)
-
-                # Acquisition Data
-                if nwbfile.acquisition:
-                    acquisition_item = QTreeWidgetItem(["Acquisition", "Group", "", "", ""])
-                    nwb_item.addChild(acquisition_item)
-                    for name, dataset in nwbfile.acquisition.items():
-                        self._add_nwb_dataset(acquisition_item, name, dataset)
-
-                # Processing Modules
-                if nwbfile.processing:
-                    processing_item = QTreeWidgetItem(["Processing", "Group", "", "", ""])
-                    nwb_item.addChild(processing_item)
-                    for module_name, module in nwbfile.processing.items():
-                        module_item = QTreeWidgetItem([module_name, "Module", "", "", ""])
-                        processing_item.addChild(module_item)
-                        for name, dataset in module.data_interfaces.items():
-                            self._add_nwb_dataset(module_item, name, dataset)
-
-                # Stimulus Data
-                if nwbfile.stimulus:
-                    stimulus_item = QTreeWidgetItem(["Stimulus", "Group", "", "", ""])
-                    nwb_item.addChild(stimulus_item)
-                    for name, dataset in nwbfile.stimulus.items():
-                        self._add_nwb_dataset(stimulus_item, name, dataset)
+            sections = scan_nwb_containers(nwb_path)
+
+            # Create a top-level NWB item
+            nwb_item = QTreeWidgetItem(["NWB File", "Root", "", "", ""])
+            self.tree_widget.addTopLevelItem(nwb_item)
+
+            # Acquisition, Processing and Stimulus sections
+            for section in sections:
+                section_item = QTreeWidgetItem([section['name'], section['kind'], "", "", ""])
+                nwb_item.addChild(section_item)
+                self._add_nwb_entries(section_item, section['children'])
 
         except Exception as e:
             QMessageBox.warning(self, "Error", f"Failed to load NWB file: {e}")
 
 
-    def _add_nwb_dataset(self, parent_item, name, dataset):
+    def _add_nwb_entries(self, parent_item, entries):
         """
-        Adds a dataset from NWB to the tree widget.
+        Adds NWB containers (modules, interfaces and data-carrying series) to the tree.
         """
-        try:
-            shape = str(dataset.data.shape) if hasattr(dataset, 'data') else "Unknown"
-            dtype = str(dataset.data.dtype) if hasattr(dataset, 'data') else "Unknown"
-            size_bytes = dataset.data.nbytes if hasattr(dataset, 'data') else 0
-            size_mb = f"{size_bytes / (1024 ** 2):.2f}"  # Convert to MB
+        for entry in entries:
+            if entry['kind'] == "Dataset":
+                shape = str(entry['shape'])
+                size_mb = f"{entry['nbytes'] / (1024 ** 2):.2f}"  # Convert to MB
+                item = QTreeWidgetItem([entry['name'], "Dataset", shape, entry['dtype'], size_mb])
+                item.setCheckState(0, Qt.CheckState.Unchecked)
+            else:
+                item = QTreeWidgetItem([entry['name'], entry['kind'], "", "", ""])
 
-            item = QTreeWidgetItem([name, "Dataset", shape, dtype, size_mb])
-            item.setCheckState(0, Qt.CheckState.Unchecked)
+            item.setData(0, HDF5_PATH_ROLE, entry['path'])
+            if entry['neurodata_type']:
+                item.setToolTip(0, entry['neurodata_type'])
             parent_item.addChild(item)
-        except Exception as e:
-            print(f"[DataSelectionDialog] Error adding NWB dataset '{name}': {e}")
+            self._add_nwb_entries(item, entry['children'])
 
 
     def limit_dataset_selection(self, item, column):
@@ -318,7 +447,12 @@ class DataSelectionDialog(QDialog):
             """
             name = item.text(0)
             data_type = item.text(1)
-            full_path = os.path.join(parent_path, name).strip("/")
+            item_path = item.data(0, HDF5_PATH_ROLE)
+            if item_path:
+                # Objects inside HDF5/NWB files carry their in-file path
+                full_path = f"{self.data_path}/{item_path}"
+            else:
+                full_path = os.path.join(parent_path, name).strip("/")
 
             # Handling case where a FILE is selected (preserving original logic)
             if self.select_type == 'File':
@@ -0,0 +1,89 @@
+import os
+import re
+import threading
+
+from PyQt6.QtCore import QObject, pyqtSignal
+
+
+###############################################################################
+# Image Folder Scanning
+###############################################################################
+IMAGE_EXTENSIONS = {".tiff", ".tif", ".png", ".jpg", ".jpeg", ".bmp"}
+
+_DIGITS = re.compile(r'(\d+)')
+
+
+def natural_sort_key(name):
+    """
+    Sort key that orders embedded numbers by value: frame_2 < frame_10.
+    """
+    return [int(part) if part.isdigit() else part.lower() for part in _DIGITS.split(name)]
+
+
+def scan_image_folder(folder_path, extensions=IMAGE_EXTENSIONS, on_progress=None,
+                      is_cancelled=None, progress_every=1000):
+    """
+    List the image files of a folder in one os.scandir pass.
+
+    Returns (name, ext, size_bytes) tuples in natural order. The size comes
+    from the directory entry's stat result, which is fetched once per file
+    (and is free on Windows, where scandir already has it).
+    on_progress(count) is called every `progress_every` images; scanning
+    stops early, returning None, once is_cancelled() is true.
+    """
+    files = []
+    with os.scandir(folder_path) as entries:
+        for entry in entries:
+            ext = os.path.splitext(entry.name)[1].lower()
+            if ext not in extensions or not entry.is_file():
+                continue
+            files.append((entry.name, ext, entry.stat().st_size))
+
+            if len(files) % progress_every == 0:
+                if is_cancelled is not None and is_cancelled():
+                    return None
+                if on_progress is not None:
+                    on_progress(len(files))
+
+    files.sort(key=lambda f: natural_sort_key(f[0]))
+    return files
+
+
+class FolderScanWorker(QObject):
+    """
+    Scans an image folder off the GUI thread and hands the result over in
+    batches, so the tree can fill incrementally without blocking the dialog.
+    """
+    progress = pyqtSignal(int)          # images found so far
+    batch_ready = pyqtSignal(list)      # list of (name, ext, size_bytes), natural order
+    finished = pyqtSignal(int)          # total number of images
+    error = pyqtSignal(str)
+
+    BATCH_SIZE = 2000
+
+    def __init__(self, folder_path, parent=None):
+        super().__init__(parent)
+        self.folder_path = folder_path
+        self._cancel_event = threading.Event()
+
+    def cancel(self):
+        self._cancel_event.set()
+
+    def run(self):
+        try:
+            files = scan_image_folder(self.folder_path, on_progress=self.progress.emit,
+                                      is_cancelled=self._cancel_event.is_set)
+        except OSError as e:
+            self.error.emit(str(e))
+            self.finished.emit(0)
+            return
+        if files is None:
+            self.finished.emit(0)
+            return
+
+        self.progress.emit(len(files))
+        for start in range(0, len(files), self.BATCH_SIZE):
+            if self._cancel_event.is_set():
+                break
+            self.batch_ready.emit(files[start:start + self.BATCH_SIZE])
+        self.finished.emit(len(files))
@@ -0,0 +1,602 @@
+import os
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+import scipy.linalg
+import scipy.sparse
+
+from pixel_graph import GRAPH_METHODS, KNNGraphBuilder
+from process_pool import make_spawn_pool
+
+
+###############################################################################
+# Batched Coefficient Inference
+###############################################################################
+def solve_nonnegative_l1(products, gram, penalty, initial=None, max_steps=100, tol=1e-3, step=None):
+    """
+    Solve, for every pixel i at once,
+        min_a 0.5 a^T G a - b_i^T a + lambda_i^T a   subject to a >= 0,
+    with G = `gram` (K, K), b_i the rows of `products` (N, K) and lambda_i
+    the rows of `penalty` (N, K). Batched FISTA with adaptive restart; a
+    pixel leaves the active set once no coefficient moves by more than tol
+    times its largest one. Returns (coefficients, info) with
+    info = {'steps', 'pixel_steps', 'converged'}.
+    """
+    n_pixels, k = products.shape
+    coefficients = (np.zeros((n_pixels, k), dtype=np.float32) if initial is None
+                    else np.array(initial, dtype=np.float32))
+    if step is None:
+        step = 1.0 / max(float(np.linalg.eigvalsh(gram)[-1]), 1e-12)
+    step = np.float32(step)
+    gram = gram.astype(np.float32, copy=False)
+    # b - lambda, the constant part of the negative gradient
+    drive = (products - penalty).astype(np.float32)
+
+    active = np.arange(n_pixels)
+    x = coefficients.copy()     # compact arrays over the active pixels
+    y = x.copy()
+    momentum = np.ones(n_pixels, dtype=np.float32)
+    pixel_steps = 0
+    steps = 0
+    while active.size and steps < max_steps:
+        steps += 1
+        pixel_steps += active.size
+        x_new = np.maximum(y - step * (y @ gram - drive[active]), 0)
+        change = x_new - x
+
+        # Adaptive restart: drop the momentum of pixels moving against the gradient step
+        restart = np.einsum('ik,ik->i', y - x_new, change) > 0
+        momentum_new = 0.5 * (1 + np.sqrt(1 + 4 * momentum * momentum))
+        beta = np.where(restart, 0, (momentum - 1) / momentum_new).astype(np.float32)
+        momentum = np.where(restart, 1, momentum_new).astype(np.float32)
+        y = x_new + beta[:, None] * change
+        x = x_new
+
+        scale = np.maximum(np.abs(x).max(axis=1), 1e-12)
+        converged = np.abs(change).max(axis=1) <= tol * scale
+        if np.any(converged):
+            coefficients[active[converged]] = x[converged]
+            keep = ~converged
+            active, x, y, momentum = active[keep], x[keep], y[keep], momentum[keep]
+
+    coefficients[active] = x  # pixels still active at max_steps
+    return coefficients, {'steps': steps, 'pixel_steps': pixel_steps,
+                          'converged': 1.0 - active.size / max(n_pixels, 1)}
+
+
+def reweighted_penalty(coefficients, smoothed, sparsity, beta, graph_weight):
+    """
+    GraFT's graph-filtered L1 weights (see GraFTEngine) given the coefficients
+    and their graph average `smoothed` (graph @ coefficients).
+    """
+    return sparsity * beta / (beta + coefficients + graph_weight * smoothed)
+
+
+###############################################################################
+# Shared-Memory Process Pool
+###############################################################################
+# Arrays of the pool attached in each worker process: {name: ndarray}
+_worker_arrays = {}
+_worker_blocks = []
+
+
+def _attach_shared(specs):
+    """
+    Pool initializer: map every shared block once per worker. Tasks then only
+    pass block names and row ranges, never array data.
+    """
+    for name, (shm_name, shape, dtype) in specs.items():
+        block = shared_memory.SharedMemory(name=shm_name)
+        _worker_blocks.append(block)
+        _worker_arrays[name] = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+
+
+def _graph_rows(arrays, start, stop):
+    # Rows [start, stop) of the shared CSR graph, as a CSR view on the shared buffers
+    indptr = arrays['graph_indptr']
+    lo, hi = indptr[start], indptr[stop]
+    return scipy.sparse.csr_matrix((arrays['graph_data'][lo:hi], arrays['graph_indices'][lo:hi],
+                                    indptr[start:stop + 1] - lo),
+                                   shape=(stop - start, arrays['graph_indptr'].shape[0] - 1))
+
+
+def _project_block(start, stop, scale):
+    a = _worker_arrays
+    dictionary = a['dictionary']
+    products = a['data'][start:stop] @ dictionary.T
+    products -= np.outer(a['mean'][start:stop], dictionary.sum(axis=1))
+    a['products'][start:stop] = products / scale
+
+
+def _back_project_block(start, stop, source, scale):
+    a = _worker_arrays
+    coefficients = a[source][start:stop]
+    partial = coefficients.T @ a['data'][start:stop]
+    partial -= (coefficients.T @ a['mean'][start:stop])[:, None]
+    return partial / scale  # (K, T): small next to the data block
+
+
+def _penalty_block(start, stop, source, settings):
+    a = _worker_arrays
+    smoothed = _graph_rows(a, start, stop) @ a[source]
+    a['penalty'][start:stop] = reweighted_penalty(a[source][start:stop], smoothed, settings['sparsity'],
+                                                  settings['beta'], settings['graph_weight'])
+
+
+def _solve_block(start, stop, source, target, settings):
+    """
+    One reweighting round for pixels [start, stop): weights from the
+    coefficients in `source` (all pixels, for the graph term), solve, write
+    the block's new coefficients to `target`.
+    """
+    a = _worker_arrays
+    _penalty_block(start, stop, source, settings)
+    coefficients, info = solve_nonnegative_l1(a['products'][start:stop], a['gram'],
+                                              a['penalty'][start:stop], initial=a[source][start:stop],
+                                              max_steps=settings['max_steps'], tol=settings['tol'],
+                                              step=settings['step'])
+    a[target][start:stop] = coefficients
+    return info['pixel_steps'], int(round(info['converged'] * (stop - start)))
+
+
+class SharedGraFTPool:
+    """
+    Process pool for the pixel-parallel steps of GraFT (projection,
+    back-projection, reweighted-L1 inference) over disjoint pixel blocks.
+    The arrays live in shared memory mapped once per worker; tasks pass only
+    names, row ranges and scalars.
+    """
+    def __init__(self, data, mean, graph, n_components, n_workers, block_rows=None):
+        n_pixels, n_frames = data.shape
+        graph = scipy.sparse.csr_matrix(graph, dtype=np.float32)
+        self.n_pixels = n_pixels
+        self.n_workers = n_workers
+        block_rows = block_rows or max(256, -(-n_pixels // (4 * n_workers)))
+        self.blocks = [(start, min(start + block_rows, n_pixels)) for start in range(0, n_pixels, block_rows)]
+
+        self._blocks = []
+        self.arrays = {}
+        specs = {}
+        try:
+            layout = {'data': ((n_pixels, n_frames), np.float32),
+                      'mean': ((n_pixels,), np.float32),
+                      'graph_indptr': (graph.indptr.shape, graph.indptr.dtype),
+                      'graph_indices': ((max(graph.nnz, 1),), graph.indices.dtype),
+                      'graph_data': ((max(graph.nnz, 1),), np.float32),
+                      'dictionary': ((n_components, n_frames), np.float32),
+                      'gram': ((n_components, n_components), np.float32),
+                      'products': ((n_pixels, n_components), np.float32),
+                      'coefficients_a': ((n_pixels, n_components), np.float32),
+                      'coefficients_b': ((n_pixels, n_components), np.float32),
+                      'penalty': ((n_pixels, n_components), np.float32)}
+            for name, (shape, dtype) in layout.items():
+                nbytes = max(int(np.prod(shape, dtype=np.int64)) * np.dtype(dtype).itemsize, 1)
+                block = shared_memory.SharedMemory(create=True, size=nbytes)
+                self._blocks.append(block)
+                self.arrays[name] = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+                specs[name] = (block.name, shape, np.dtype(dtype).str)
+
+            for start, stop in self.blocks:
+                self.arrays['data'][start:stop] = data[start:stop]
+            self.arrays['mean'][:] = mean
+            self.arrays['graph_indptr'][:] = graph.indptr
+            self.arrays['graph_indices'][:graph.nnz] = graph.indices
+            self.arrays['graph_data'][:graph.nnz] = graph.data
+
+            self._pool = make_spawn_pool(n_workers, initializer=_attach_shared, initargs=(specs,))
+        except Exception:
+            self.close()
+            raise
+
+    def _map(self, function, *args):
+        futures = [self._pool.submit(function, start, stop, *args) for start, stop in self.blocks]
+        return [future.result() for future in futures]
+
+    def project(self, dictionary, scale):
+        self.arrays['dictionary'][:] = dictionary
+        self._map(_project_block, scale)
+        return self.arrays['products'].copy()
+
+    def back_project(self, coefficients, scale):
+        self.arrays['coefficients_a'][:] = coefficients
+        return sum(self._map(_back_project_block, 'coefficients_a', scale))
+
+    def infer(self, coefficients, gram, n_rounds, settings):
+        """
+        n_rounds reweighted solves against the products of the last project().
+        Returns (coefficients, final penalty, info).
+        """
+        self.arrays['gram'][:] = gram
+        self.arrays['coefficients_a'][:] = coefficients
+        source, target = 'coefficients_a', 'coefficients_b'
+        pixel_steps = converged = 0
+        for _ in range(n_rounds):
+            results = self._map(_solve_block, source, target, settings)
+            pixel_steps = pixel_steps + sum(r[0] for r in results)
+            converged = sum(r[1] for r in results)
+            source, target = target, source
+        self._map(_penalty_block, source, settings)
+        info = {'pixel_steps': pixel_steps, 'converged': converged / max(self.n_pixels, 1)}
+        return self.arrays[source].copy(), self.arrays['penalty'].copy(), info
+
+    def close(self):
+        pool = getattr(self, '_pool', None)
+        if pool is not None:
+            pool.shutdown(wait=True)
+            self._pool = None
+        self.arrays = {}
+        for block in self._blocks:
+            block.close()
+            block.unlink()
+        self._blocks = []
+
+
+###############################################################################
+# GraFT: Graph-Filtered Temporal Dictionary Learning
+###############################################################################
+# Smallest fit (pixels x frames) that gets a worker pool by default: starting
+# the workers and sharing the data costs over a second
+POOL_MIN_ELEMENTS = 5 * 10 ** 7
+# Fewest pixels per worker process
+POOL_MIN_PIXELS_PER_WORKER = 4096
+
+
+def auto_workers(n_pixels, n_frames):
+    """
+    Worker processes for fitting an (n_pixels, n_frames) matrix: 1 (serial)
+    below POOL_MIN_ELEMENTS, otherwise one per core with at least
+    POOL_MIN_PIXELS_PER_WORKER pixels each.
+    """
+    if n_pixels * n_frames < POOL_MIN_ELEMENTS:
+        return 1
+    return max(1, min(os.cpu_count() or 1, n_pixels // POOL_MIN_PIXELS_PER_WORKER))
+
+
+def format_iteration(entry):
+    """
+    One-line summary of a GraFTEngine history entry.
+    """
+    return (f"iter {entry['iteration']:3d}  objective {entry['objective']:.6g} "
+            f"(change {entry['objective_change']:.2e})  dictionary change {entry['dictionary_change']:.2e}  "
+            f"support change {entry['support_change']:.2e}  nonzero {entry['nonzero_fraction']:.1%}  "
+            f"{entry['steps_per_pixel']:.1f} steps/pixel  {entry['seconds']:.3f}s")
+
+
+class GraFTEngine:
+    """
+    Graph-filtered temporal dictionary learning on an (N pixels, T) matrix Y.
+
+    Factors the pixel-centered Y as A @ Phi: Phi (K, T) holds unit-norm
+    temporal components and A (N, K) their non-negative weights, i.e. K
+    spatial maps. Iterations alternate reweighted-L1 inference of A, with
+        lambda_ik = sparsity * beta / (beta + a_ik + graph_weight * (G a_k)_i)
+    for the row-normalized pixel graph G, and a ridge least-squares update
+    of Phi. sparsity and beta are in correlation units.
+
+    fit() stops early once the objective, dictionary and support changes
+    stay below their tolerances for `patience` iterations, and records every
+    iteration in `history`. warm_start=True starts from the previous fit
+    when the shapes match. n_workers > 1 runs on a SharedGraFTPool; None
+    picks the count from the problem size (auto_workers).
+    """
+    name = "graft"
+
+    def __init__(self, n_components=20, n_iterations=20, sparsity=0.1, graph_weight=1.0, beta=0.1,
+                 n_neighbors=8, graph_method="auto", graph_radius=4, n_reweight=3, inference_steps=100,
+                 inference_tol=1e-3, ridge=1e-3, seed=0, n_workers=None, objective_tol=1e-4,
+                 dictionary_tol=1e-3, support_tol=1e-3, patience=2, warm_start=False):
+        if n_components < 1 or n_iterations < 1:
+            raise ValueError("n_components and n_iterations must be >= 1")
+        if min(objective_tol, dictionary_tol, support_tol) < 0 or patience < 1:
+            raise ValueError("Convergence tolerances must be >= 0 and patience >= 1")
+        if graph_method != "auto" and graph_method not in GRAPH_METHODS:
+            raise ValueError(f"graph_method must be 'auto' or one of {GRAPH_METHODS}, got '{graph_method}'")
+        if sparsity < 0 or graph_weight < 0 or beta <= 0 or ridge < 0:
+            raise ValueError("sparsity, graph_weight and ridge must be >= 0 and beta > 0")
+        if n_workers is not None and n_workers < 1:
+            raise ValueError("n_workers must be >= 1, or None to choose from the problem size")
+        self.n_components = n_components
+        self.n_iterations = n_iterations
+        self.sparsity = sparsity
+        self.graph_weight = graph_weight
+        self.beta = beta
+        self.n_neighbors = n_neighbors
+        self.graph_method = graph_method
+        self.graph_radius = graph_radius
+        self.n_reweight = n_reweight
+        self.inference_steps = inference_steps
+        self.inference_tol = inference_tol
+        self.ridge = ridge
+        self.seed = seed
+        self.n_workers = n_workers
+        self.objective_tol = objective_tol
+        self.dictionary_tol = dictionary_tol
+        self.support_tol = support_tol
+        self.patience = patience
+        self.warm_start = warm_start
+
+        self.graph = None
+        self.dictionary = None     # (K, T) temporal components
+        self.coefficients = None   # (N, K) spatial maps, in data units
+        self.history = []
+        self.last_run_stats = None
+        self._pool = None
+
+    def params(self):
+        # n_workers only changes the speed, not the result
+        return {'n_components': self.n_components, 'n_iterations': self.n_iterations,
+                'sparsity': self.sparsity, 'graph_weight': self.graph_weight, 'beta': self.beta,
+                'n_neighbors': self.n_neighbors, 'graph_method': self.graph_method,
+                'graph_radius': self.graph_radius, 'n_reweight': self.n_reweight,
+                'inference_steps': self.inference_steps, 'inference_tol': self.inference_tol,
+                'ridge': self.ridge, 'seed': self.seed, 'objective_tol': self.objective_tol,
+                'dictionary_tol': self.dictionary_tol, 'support_tol': self.support_tol,
+                'patience': self.patience}
+
+    # -- products with the centered, scaled data -------------------------------
+    def _project(self, dictionary):
+        # Y_c @ Phi^T / scale, with Y_c = Y - mean: (N, K)
+        if self._pool is not None:
+            return self._pool.project(dictionary, self._scale)
+        products = self._data @ dictionary.T
+        products -= np.outer(self._mean, dictionary.sum(axis=1))
+        return products / self._scale
+
+    def _back_project(self, coefficients):
+        # A^T @ Y_c / scale: (K, T)
+        if self._pool is not None:
+            return self._pool.back_project(coefficients, self._scale)
+        products = coefficients.T @ self._data
+        products -= (coefficients.T @ self._mean)[:, None]
+        return products / self._scale
+
+    def _residual_norms(self, coefficients, products, gram):
+        # Per-pixel ||y_i - Phi^T a_i||^2 without forming the reconstruction
+        return (self._row_norms - 2 * np.einsum('ik,ik->i', coefficients, products)
+                + np.einsum('ik,kl,il->i', coefficients, gram, coefficients))
+
+    # -- steps -----------------------------------------------------------------
+    def _initial_dictionary(self, rng):
+        # Traces of random high-variance pixels
+        candidates = np.flatnonzero(self._row_norms >= np.median(self._row_norms))
+        chosen = rng.choice(candidates, size=min(self.n_components, len(candidates)), replace=False)
+        atoms = (np.asarray(self._data[np.sort(chosen)], dtype=np.float32)
+                 - self._mean[np.sort(chosen), None])
+        if len(atoms) < self.n_components:
+            noise = rng.standard_normal((self.n_components - len(atoms), atoms.shape[1]))
+            atoms = np.vstack([atoms, noise.astype(np.float32)])
+        return self._normalize_rows(atoms)
+
+    @staticmethod
+    def _normalize_rows(dictionary):
+        norms = np.linalg.norm(dictionary, axis=1, keepdims=True)
+        return dictionary / np.maximum(norms, 1e-12)
+
+    def _penalty_settings(self):
+        # sparsity and beta are in units of sqrt(T), the norm of a unit-variance trace
+        return {'sparsity': float(self.sparsity * self._unit), 'beta': float(self.beta * self._unit),
+                'graph_weight': float(self.graph_weight)}
+
+    def _penalty(self, coefficients):
+        smoothed = self.graph @ coefficients  # sparse (N, N) x dense (N, K)
+        return reweighted_penalty(coefficients, smoothed, **self._penalty_settings())
+
+    def _projection(self, dictionary):
+        # (Gram matrix, products with the data) of a dictionary
+        return dictionary @ dictionary.T, self._project(dictionary)
+
+    def _infer(self, coefficients, dictionary, projection=None):
+        """
+        Reweighted-L1 inference of the coefficients of every pixel at once.
+        `projection` is _projection(dictionary) when already computed.
+        """
+        gram, products = projection if projection is not None else self._projection(dictionary)
+        step = 1.0 / max(float(np.linalg.eigvalsh(gram)[-1]), 1e-12)
+        if self._pool is not None:
+            settings = dict(self._penalty_settings(), step=step, max_steps=self.inference_steps,
+                            tol=self.inference_tol)
+            coefficients, penalty, self._inference_info = self._pool.infer(coefficients, gram,
+                                                                           self.n_reweight, settings)
+            return coefficients, products, gram, penalty
+
+        penalty = self._penalty(coefficients)
+        pixel_steps = 0
+        for _ in range(self.n_reweight):
+            coefficients, info = solve_nonnegative_l1(products, gram, penalty, initial=coefficients,
+                                                      max_steps=self.inference_steps,
+                                                      tol=self.inference_tol, step=step)
+            pixel_steps += info['pixel_steps']
+            penalty = self._penalty(coefficients)
+        self._inference_info = {'pixel_steps': pixel_steps, 'converged': info['converged']}
+        return coefficients, products, gram, penalty
+
+    def _update_dictionary(self, coefficients, dictionary, products, gram):
+        k = coefficients.shape[1]
+        # In float64 and with the ridge relative to the mean diagonal: near-duplicate
+        # components make A^T A close to singular, beyond float32 precision
+        lhs = coefficients.T.astype(np.float64) @ coefficients
+        lhs[np.diag_indices(k)] += self.ridge * max(float(np.trace(lhs)) / k, 1.0)
+        updated = scipy.linalg.solve(lhs, self._back_project(coefficients), assume_a='pos').astype(np.float32)
+
+        norms = np.linalg.norm(updated, axis=1)
+        unused = (norms < 1e-8) | (coefficients.max(axis=0) <= 0)
+        if np.any(unused):
+            # Re-seed unused components with the traces of the worst fitted pixels
+            errors = self._residual_norms(coefficients, products, gram)
+            worst = np.argsort(errors)[::-1][:int(unused.sum())]
+            updated[unused] = np.asarray(self._data[worst], dtype=np.float32) - self._mean[worst, None]
+            coefficients[:, unused] = 0
+            norms = np.linalg.norm(updated, axis=1)
+        # Unit-norm components; the scale moves into the coefficients
+        coefficients *= norms[None, :]
+        return (updated / np.maximum(norms, 1e-12)[:, None]).astype(np.float32), coefficients
+
+    def _objective(self, coefficients, projection, penalty):
+        gram, products = projection
+        data_term = 0.5 * float(np.sum(self._residual_norms(coefficients, products, gram)))
+        sparsity_term = float(np.sum(penalty * coefficients))
+        return data_term, sparsity_term
+
+    def build_graph(self, data, coords=None):
+        """
+        Pixel affinity graph (see pixel_graph.KNNGraphBuilder). "auto" searches
+        spatial neighbourhoods when pixel coordinates are known and random
+        projections otherwise.
+        """
+        method = self.graph_method
+        if method == "auto":
+            method = "spatial" if coords is not None else "random_projection"
+        builder = KNNGraphBuilder(n_neighbors=self.n_neighbors, method=method, radius=self.graph_radius,
+                                  seed=self.seed)
+        return builder.build(data, coords)
+
+    # -- driver ----------------------------------------------------------------
+    def _converged(self):
+        # All criteria met for the last `patience` iterations
+        recent = self.history[-self.patience:]
+        return len(self.history) > self.patience and all(
+            entry['objective_change'] <= self.objective_tol
+            and entry['dictionary_change'] <= self.dictionary_tol
+            and entry['support_change'] <= self.support_tol for entry in recent)
+
+    def fit(self, data, graph=None, coords=None, progress=None, is_cancelled=None, monitor=None):
+        """
+        Learn the dictionary and coefficients of an (N, T) pixel matrix (e.g.
+        gathered via PreprocessingTab.analysis_input()). `graph` may be a precomputed (N, N)
+        sparse affinity matrix; otherwise one is built with build_graph(), using
+        the (N, 2) image coordinates `coords` of the pixels if given.
+        monitor(entry), if given, is called with every history entry from the
+        solver thread; it should only queue the entry (e.g. queue.put).
+        Returns self, or None if cancelled.
+        """
+        started = time.perf_counter()
+        data = np.asarray(data)
+        if data.ndim != 2 or min(data.shape) < 2:
+            raise ValueError(f"GraFT needs an (n_pixels, n_frames) matrix, got shape {data.shape}")
+        if not np.issubdtype(data.dtype, np.floating):
+            data = data.astype(np.float32)
+        n_pixels, n_frames = data.shape
+
+        self._data = data
+        self._mean = data.mean(axis=1, dtype=np.float64).astype(np.float32)
+        sums_of_squares = (np.einsum('ij,ij->i', data, data, dtype=np.float64)
+                           - n_frames * self._mean.astype(np.float64) ** 2)
+        self._scale = np.float32(np.sqrt(max(sums_of_squares.sum() / data.size, 1e-24)))
+        self._row_norms = (np.maximum(sums_of_squares, 0) / self._scale ** 2).astype(np.float32)
+        self._unit = np.float32(np.sqrt(n_frames))
+
+        graph_started = time.perf_counter()
+        self.graph = graph if graph is not None else self.build_graph(data, coords)
+        graph_seconds = time.perf_counter() - graph_started
+
+        rng = np.random.default_rng(self.seed)
+        if (self.warm_start and self.dictionary is not None and self.coefficients is not None
+                and self.dictionary.shape == (self.n_components, n_frames)
+                and self.coefficients.shape == (n_pixels, self.n_components)):
+            dictionary = self.dictionary.copy()
+            coefficients = (self.coefficients / self._scale).astype(np.float32)
+        else:
+            dictionary = self._initial_dictionary(rng)
+            coefficients = np.zeros((n_pixels, self.n_components), dtype=np.float32)
+        self.history = []
+        stopped = "max_iterations"
+        previous_objective = None
+        pool_seconds = 0.0
+        projection = None
+        n_workers = self.n_workers or auto_workers(n_pixels, n_frames)
+        try:
+            if n_workers > 1:
+                pool_started = time.perf_counter()
+                self._pool = SharedGraFTPool(data, self._mean, self.graph, self.n_components, n_workers)
+                pool_seconds = time.perf_counter() - pool_started
+
+            for iteration in range(self.n_iterations):
+                timings = {}
+                previous_dictionary = dictionary
+                previous_support = coefficients > 0
+                step_started = time.perf_counter()
+                # Warm start: inference continues from the previous coefficients.
+                # The objective already projected the data onto this dictionary.
+                coefficients, products, gram, penalty = self._infer(coefficients, dictionary, projection)
+                timings['inference'] = time.perf_counter() - step_started
+
+                step_started = time.perf_counter()
+                dictionary, coefficients = self._update_dictionary(coefficients, dictionary, products, gram)
+                timings['dictionary'] = time.perf_counter() - step_started
+
+                step_started = time.perf_counter()
+                projection = self._projection(dictionary)
+                data_term, sparsity_term = self._objective(coefficients, projection, penalty)
+                objective = data_term + sparsity_term
+                support = coefficients > 0
+                changes = {
+                    'objective_change': (abs(previous_objective - objective) / max(abs(previous_objective), 1e-12)
+                                         if previous_objective is not None else float('inf')),
+                    'dictionary_change': float(np.linalg.norm(dictionary - previous_dictionary)
+                                               / max(np.linalg.norm(previous_dictionary), 1e-12)),
+                    'support_change': float(np.count_nonzero(support != previous_support)) / support.size,
+                }
+                previous_objective = objective
+                timings['objective'] = time.perf_counter() - step_started
+
+                entry = {'iteration': iteration + 1, 'objective': objective,
+                         'data_term': data_term, 'sparsity_term': sparsity_term,
+                         'nonzero_fraction': float(np.count_nonzero(support)) / support.size,
+                         'steps_per_pixel': self._inference_info['pixel_steps'] / n_pixels,
+                         'converged_fraction': self._inference_info['converged'],
+                         'seconds': sum(timings.values()), 'timings': timings, **changes}
+                self.history.append(entry)
+                if monitor is not None:
+                    monitor(dict(entry))
+                if progress is not None:
+                    progress(iteration + 1, self.n_iterations)
+                if is_cancelled is not None and is_cancelled():
+                    return None
+                if self._converged():
+                    stopped = "converged"
+                    break
+
+            self.dictionary = dictionary
+            self.coefficients = coefficients * self._scale
+        finally:
+            self._data = None
+            if self._pool is not None:
+                self._pool.close()
+                self._pool = None
+
+        elapsed = time.perf_counter() - started
+        self.last_run_stats = {'pixels': n_pixels, 'frames': n_frames, 'iterations': len(self.history),
+                               'seconds': elapsed, 'graph_seconds': graph_seconds,
+                               'workers': n_workers, 'pool_seconds': pool_seconds, 'stopped': stopped,
+                               'graph_edges': int(self.graph.nnz)}
+        return self
+
+    def spatial_maps(self, mask_stage=None):
+        """
+        Coefficients as (H, W, K) images when a MaskStage is given (NaN outside
+        the mask), otherwise the (N, K) matrix.
+        """
+        if self.coefficients is None:
+            return None
+        if mask_stage is None:
+            return self.coefficients
+        return mask_stage.unmask(self.coefficients)
+
+    def timing_report(self):
+        """
+        Multi-line summary of last_run_stats and the per-iteration history.
+        """
+        stats = self.last_run_stats
+        if stats is None:
+            return "No run yet."
+        lines = [f"graft: {stats['pixels']} pixels x {stats['frames']} frames, {self.n_components} "
+                 f"components, {stats['iterations']} iterations ({stats['stopped']}) in "
+                 f"{stats['seconds']:.2f}s (graph {stats['graph_seconds']:.2f}s, {stats['graph_edges']} edges)"]
+        if stats['workers'] > 1:
+            lines.append(f"  {stats['workers']} worker processes, {stats['pool_seconds']:.2f}s to "
+                         f"start them and fill shared memory")
+        for entry in self.history:
+            steps = "  ".join(f"{name} {seconds:.3f}s" for name, seconds in entry['timings'].items())
+            lines.append(f"  {format_iteration(entry)}  {steps}")
+        return "\n".join(lines)
@@ -0,0 +1,144 @@
+import json
+import os
+
+import h5py
+import numpy as np
+
+from lazy_dataset import LazyH5Dataset
+
+
+###############################################################################
+# Chunked HDF5 Output
+###############################################################################
+COMPRESSORS = ("lzf", "gzip", "none")
+ACCESS_PATTERNS = ("frames", "traces")
+DEFAULT_OUTPUT_DATASET = "preprocessed/movie"
+
+
+def choose_chunk_shape(shape, itemsize, access="frames", target_bytes=4 * 1024 ** 2):
+    """
+    HDF5 chunk shape of about target_bytes for a (T, H, W) dataset.
+
+    "frames": whole frames, a few per chunk. Suits reading time blocks of the
+    full field of view (the streaming pipeline, the masked pixel matrix).
+    "traces": long runs of frames over small square tiles. Suits reading the
+    time course of single pixels or small regions.
+    """
+    n_frames, height, width = shape
+    frame_bytes = height * width * itemsize
+    if access == "frames":
+        t = max(1, min(n_frames, target_bytes // max(frame_bytes, 1)))
+        return (int(t), height, width)
+    if access == "traces":
+        t = min(n_frames, 128)
+        tile = int(np.sqrt(max(target_bytes // (t * itemsize), 1)))
+        return (int(t), max(1, min(height, tile)), max(1, min(width, tile)))
+    raise ValueError(f"access must be one of {ACCESS_PATTERNS}, got '{access}'")
+
+
+def _attr_value(value):
+    # HDF5 attributes hold scalars, strings and arrays; anything else goes in as JSON
+    if isinstance(value, (str, int, float, np.ndarray, np.generic)):
+        return value
+    return json.dumps(value, default=str)
+
+
+class HDF5Output:
+    """
+    Write handle that streams a (T, H, W) result into a chunked, optionally
+    compressed HDF5 dataset.
+
+    It slices like an array for writing (out[start:stop] = block), so it can
+    be passed as `out` to the pipeline and stage runners. The chunk cache is
+    sized to hold one full row of chunks across the field of view, so writing
+    whole time blocks compresses every chunk exactly once. Uncompressed output
+    read by frames is stored contiguously instead, so the reopened dataset is
+    memory-mapped (LazyH5Dataset mode "mmap").
+
+    The data is written to `file_path` + ".partial". finish() closes it,
+    moves it over `file_path` and reopens it as a LazyH5Dataset, so a session
+    larger than RAM can keep working from disk. Until then an existing
+    `file_path` is left untouched, even when it is the input being processed:
+    handles still open on it keep reading the old contents. (Windows cannot
+    replace a file that is open; there the old handle must be closed first.)
+    abort() deletes the partial file.
+    """
+    def __init__(self, file_path, shape, dtype=np.float32, dataset_path=DEFAULT_OUTPUT_DATASET,
+                 compression="lzf", access="frames", compression_level=4):
+        if compression not in COMPRESSORS:
+            raise ValueError(f"compression must be one of {COMPRESSORS}, got '{compression}'")
+        self.file_path = file_path
+        self.dataset_path = dataset_path
+        self.partial_path = f"{file_path}.partial"
+        self.compression = compression
+
+        dtype = np.dtype(dtype)
+        if compression == "none" and access == "frames":
+            chunks = None  # contiguous
+            slab_bytes = 0
+        else:
+            chunks = choose_chunk_shape(shape, dtype.itemsize, access)
+            slab_bytes = chunks[0] * int(np.prod(shape[1:], dtype=np.int64)) * dtype.itemsize
+        options = {}
+        if compression != "none":
+            options['compression'] = compression
+            options['shuffle'] = True  # byte shuffling makes float data far more compressible
+            if compression == "gzip":
+                options['compression_opts'] = compression_level
+
+        self._file = h5py.File(self.partial_path, 'w', rdcc_nbytes=max(slab_bytes, 1024 ** 2) + 1024 ** 2,
+                               rdcc_w0=1.0, rdcc_nslots=100003)
+        try:
+            self._dataset = self._file.create_dataset(dataset_path, shape=tuple(shape), dtype=dtype,
+                                                      chunks=chunks, **options)
+        except Exception:
+            self.abort()
+            raise
+
+    @property
+    def shape(self):
+        return self._dataset.shape
+
+    @property
+    def dtype(self):
+        return self._dataset.dtype
+
+    @property
+    def chunks(self):
+        return self._dataset.chunks
+
+    def __setitem__(self, key, value):
+        self._dataset[key] = value
+
+    def __getitem__(self, key):
+        return self._dataset[key]
+
+    def set_attrs(self, attrs):
+        """
+        Record provenance (stage parameters, source identity, ...) on the dataset.
+        """
+        for name, value in attrs.items():
+            self._dataset.attrs[name] = _attr_value(value)
+
+    def write_extra(self, name, array):
+        """
+        Store a small side array (e.g. motion shifts) next to the dataset.
+        """
+        group = os.path.dirname(self.dataset_path)
+        self._file.create_dataset(f"{group}/{name}" if group else name, data=np.asarray(array))
+
+    def finish(self):
+        """
+        Close the file, move it to file_path and return the written dataset
+        as a LazyH5Dataset.
+        """
+        self._file.close()
+        os.replace(self.partial_path, self.file_path)
+        return LazyH5Dataset(self.file_path, self.dataset_path)
+
+    def abort(self):
+        self._file.close()
+        try:
+            os.remove(self.partial_path)
+        except OSError:
+            pass
@@ -0,0 +1,116 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from lazy_dataset import LazyArray, split_frame_key
+
+
+###############################################################################
+# Image Sequence (folder of frames)
+###############################################################################
+TIFF_EXTENSIONS = {".tif", ".tiff"}
+
+
+def read_image(path, out=None):
+    """
+    Decode a single 2D image file. TIFFs go through tifffile (decoding straight
+    into `out` when given); other formats (.png, .jpg, .bmp) through Pillow.
+    """
+    if os.path.splitext(path)[1].lower() in TIFF_EXTENSIONS:
+        import tifffile
+        return tifffile.imread(path, out=out)
+
+    from PIL import Image
+    with Image.open(path) as img:
+        frame = np.asarray(img)
+    if out is not None:
+        out[...] = frame
+        return out
+    return frame
+
+
+class ImageSequence(LazyArray):
+    """
+    A folder of single-frame images presented as one (T, H, W[, C]) stack.
+
+    Frame order is the order of `paths`. Shape and dtype come from the first
+    file; every other frame is checked against them as it is decoded, which
+    costs nothing extra. Slicing decodes only the requested frames, spread
+    over a thread pool (image decoders release the GIL):
+
+        stack = ImageSequence(sorted_paths)
+        stack[100:200]          # decodes 100 frames in parallel
+        stack.read_into(buf, 0, 500)
+
+    Decoding is expensive compared to reading HDF5, so the loader materializes
+    the whole stack once (mode == "decode"), see DataLoadWorker.
+    """
+    mode = "decode"
+
+    def __init__(self, paths, max_workers=None):
+        if not paths:
+            raise ValueError("ImageSequence needs at least one file")
+        self.paths = list(paths)
+        self.max_workers = max_workers or min(32, (os.cpu_count() or 1) * 2)
+
+        first = read_image(self.paths[0])
+        self.frame_shape = first.shape
+        self._dtype = first.dtype
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers,
+                                            thread_name_prefix="ImageSequence")
+
+    # -- array-like metadata ---------------------------------------------------
+    @property
+    def shape(self):
+        return (len(self.paths),) + self.frame_shape
+
+    @property
+    def dtype(self):
+        return self._dtype
+
+    def __repr__(self):
+        return (f"<ImageSequence {len(self.paths)} frames frame_shape={self.frame_shape} "
+                f"dtype={self.dtype}>")
+
+    # -- reading ---------------------------------------------------------------
+    def _decode_into(self, index, out):
+        frame = read_image(self.paths[index], out=out if self._can_decode_into(index) else None)
+        if frame.shape != self.frame_shape or frame.dtype != self.dtype:
+            raise ValueError(
+                f"{os.path.basename(self.paths[index])}: expected {self.frame_shape} {self.dtype}, "
+                f"got {frame.shape} {frame.dtype}")
+        if frame is not out:
+            out[...] = frame
+
+    def _can_decode_into(self, index):
+        # tifffile validates shape/dtype itself before writing into `out`
+        return os.path.splitext(self.paths[index])[1].lower() in TIFF_EXTENSIONS
+
+    def read_into(self, out, start, stop):
+        """
+        Decode frames [start, stop) in parallel directly into out[start:stop].
+        """
+        futures = [self._executor.submit(self._decode_into, i, out[i])
+                   for i in range(start, stop)]
+        for future in futures:
+            future.result()  # re-raise decode/validation errors
+        return out
+
+    def __getitem__(self, key):
+        frame_key, rest = split_frame_key(key)
+        indices = np.arange(len(self.paths))[frame_key]
+        scalar = np.ndim(indices) == 0
+        indices = np.atleast_1d(indices)
+
+        frames = np.empty((len(indices),) + self.frame_shape, dtype=self.dtype)
+        futures = [self._executor.submit(self._decode_into, i, frames[n])
+                   for n, i in enumerate(indices)]
+        for future in futures:
+            future.result()
+
+        frames = frames[rest]
+        return frames[0] if scalar else frames
+
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,367 @@
+import os
+import tempfile
+
+import h5py
+import numpy as np
+
+
+DEFAULT_SCRATCH_DIR = os.path.join(tempfile.gettempdir(), "graft_app_frames")
+
+
+def allocate_array(shape, dtype, memory_limit_bytes, scratch_dir=DEFAULT_SCRATCH_DIR):
+    """
+    Allocate an output array in RAM if it fits in memory_limit_bytes,
+    otherwise as a memory-mapped .npy file in scratch_dir.
+    """
+    nbytes = int(np.prod(shape, dtype=np.int64)) * np.dtype(dtype).itemsize
+    if nbytes <= memory_limit_bytes:
+        return np.empty(shape, dtype=dtype)
+
+    os.makedirs(scratch_dir, exist_ok=True)
+    fd, path = tempfile.mkstemp(suffix=".npy", dir=scratch_dir)
+    os.close(fd)
+    out = np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=shape)
+    try:
+        # The mapping stays valid after unlinking, and the disk space is
+        # released with it. Not possible on Windows, where the file stays
+        # in the temp directory instead.
+        os.unlink(path)
+    except OSError:
+        pass
+    return out
+
+
+###############################################################################
+# Array-like Protocol
+###############################################################################
+class LazyArray:
+    """
+    Base of the lazy, sliceable data sources: subclasses provide `shape`,
+    `dtype` and __getitem__; ndim, size, nbytes, len() and np.asarray()
+    follow from those.
+    """
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def size(self):
+        return int(np.prod(self.shape, dtype=np.int64))
+
+    @property
+    def nbytes(self):
+        return self.size * np.dtype(self.dtype).itemsize
+
+    def __len__(self):
+        if not self.shape:
+            raise TypeError("len() of unsized object")
+        return self.shape[0]
+
+    def __array__(self, dtype=None, copy=None):
+        # Explicit full read, e.g. np.asarray(handle)
+        data = np.asarray(self[()])
+        return data if dtype is None else data.astype(dtype, copy=False)
+
+
+def split_frame_key(key):
+    """
+    Split an index into the key along the first (frame) axis and the key that
+    then applies to the stacked frames, with the frame axis kept.
+    """
+    if not isinstance(key, tuple):
+        key = (key,)
+    if not key or key[0] is Ellipsis:
+        return slice(None), key
+    return key[0], (slice(None),) + key[1:]
+
+
+###############################################################################
+# Lazy HDF5 Dataset Handle
+###############################################################################
+class LazyH5Dataset(LazyArray):
+    """
+    Read-on-demand handle to a dataset inside an HDF5 (or MAT v7.3) file.
+
+    The file stays open for the lifetime of the handle and nothing is read
+    until the handle is sliced. Slicing follows numpy semantics (frames,
+    ROI windows, strides) and only the requested hyperslab is pulled from disk:
+
+        movie = LazyH5Dataset("session.h5", "imaging/movie")
+        frame = movie[0]                  # one frame
+        roi = movie[:, 100:300, 100:300]  # spatial window, all frames
+        sub = movie[::10]                 # every 10th frame
+
+    Datasets stored contiguously and without filters are exposed as a
+    numpy.memmap at their file offset instead (mode == "mmap"): slices are
+    zero-copy, page-cache-backed views. Chunked or compressed datasets go
+    through HDF5 hyperslab reads (mode == "chunked").
+    """
+    # Chunk cache per open file. The h5py default (1 MB) is too small to hold
+    # a single chunk of a typical imaging movie, which makes frame-wise reads
+    # decompress the same chunk over and over.
+    CHUNK_CACHE_BYTES = 64 * 1024 ** 2
+
+    def __init__(self, file_path, dataset_path):
+        self.file_path = file_path
+        self.dataset_path = dataset_path
+
+        self._file = h5py.File(file_path, 'r', rdcc_nbytes=self.CHUNK_CACHE_BYTES)
+        try:
+            self._dataset = self._file[dataset_path]
+            if not isinstance(self._dataset, h5py.Dataset):
+                raise TypeError(f"'{dataset_path}' is not a dataset")
+            self._shape = self._dataset.shape
+            self._dtype = self._dataset.dtype
+            # Why the dataset is read through HDF5 rather than memory-mapped
+            self.chunked_reason = memmap_unsupported_reason(self._dataset)
+            self._memmap = memmap_contiguous_dataset(file_path, self._dataset)
+        except Exception:
+            self._file.close()
+            raise
+
+        if self._memmap is not None:
+            # The mapping does not need the HDF5 library any more.
+            self.mode = "mmap"
+            self._dataset = None
+            self._file.close()
+        else:
+            self.mode = "chunked"
+
+    # -- array-like metadata ---------------------------------------------------
+    @property
+    def shape(self):
+        return self._shape
+
+    @property
+    def dtype(self):
+        return self._dtype
+
+    def __repr__(self):
+        state = "closed" if self.closed else "open"
+        return (f"<LazyH5Dataset '{self.dataset_path}' shape={self.shape} "
+                f"dtype={self.dtype} mode={self.mode} ({state})>")
+
+    # -- reading ---------------------------------------------------------------
+    def __getitem__(self, key):
+        """
+        Read only the selected hyperslab.
+        Negative-step slices are read forward and flipped in memory,
+        since HDF5 hyperslabs only support positive strides.
+        """
+        if self._memmap is not None:
+            return self._memmap[key]
+
+        key, flip_axes = _split_negative_steps(key, self.shape)
+        data = self._dataset[key]
+        if flip_axes:
+            data = np.flip(data, axis=flip_axes)
+        return data
+
+    def read_into(self, out, start, stop):
+        """
+        Read frames [start, stop) straight into out[start:stop] (no temporary copy).
+        """
+        if self._memmap is not None:
+            out[start:stop] = self._memmap[start:stop]
+        else:
+            self._dataset.read_direct(out, np.s_[start:stop], np.s_[start:stop])
+        return out
+
+    # -- lifetime --------------------------------------------------------------
+    @property
+    def closed(self):
+        if self.mode == "mmap":
+            return self._memmap is None
+        return not bool(self._file)
+
+    def close(self):
+        # Views already handed out keep the mapping alive until they are dropped.
+        self._memmap = None
+        if self._file:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+def memmap_unsupported_reason(dataset):
+    """
+    Why `dataset` cannot be memory-mapped, or None if it can: its raw bytes
+    must sit in one contiguous, unfiltered block of the file.
+    """
+    if dataset.compression is not None:
+        return f"{dataset.compression} compressed"
+    plist = dataset.id.get_create_plist()
+    if plist.get_nfilters() > 0:
+        return "stored with HDF5 filters"
+    if dataset.chunks is not None:
+        return "chunked"
+    if plist.get_external_count() > 0:
+        return "stored in external files"
+    if dataset.shape is None or len(dataset.shape) == 0 or dataset.size == 0:
+        return "empty or scalar"
+
+    dtype = dataset.dtype
+    if dtype.hasobject or dtype.kind not in "biufc" or dtype.names is not None:
+        return f"non-numeric dtype {dtype}"  # strings, variable-length, reference or compound types
+
+    offset = dataset.id.get_offset()
+    if offset is None or dataset.id.get_storage_size() < dataset.size * dtype.itemsize:
+        return "storage not allocated"  # reads yield the fill value
+    return None
+
+
+def memmap_contiguous_dataset(file_path, dataset):
+    """
+    Return a read-only numpy.memmap over `dataset` if its raw bytes sit in one
+    contiguous, unfiltered block of `file_path`; otherwise return None.
+    """
+    if memmap_unsupported_reason(dataset) is not None:
+        return None
+    return np.memmap(file_path, mode='r', dtype=dataset.dtype, offset=dataset.id.get_offset(),
+                     shape=dataset.shape)
+
+
+def _split_negative_steps(key, shape):
+    """
+    Rewrite slices with a negative step as the equivalent forward slice.
+    Returns the rewritten key and the axes (of the result) that must be flipped.
+    """
+    if not isinstance(key, tuple):
+        key = (key,)
+    if not any(isinstance(k, slice) and k.step is not None and k.step < 0 for k in key):
+        return key, ()
+
+    # Expand a single Ellipsis so every entry lines up with an axis.
+    n_explicit = sum(k is not Ellipsis and k is not None for k in key)
+    expanded = []
+    for k in key:
+        if k is Ellipsis:
+            expanded.extend([slice(None)] * (len(shape) - n_explicit))
+        else:
+            expanded.append(k)
+
+    new_key, flip_axes = [], []
+    axis, out_axis = 0, 0
+    for k in expanded:
+        if k is None:
+            new_key.append(k)
+            out_axis += 1
+            continue
+        if isinstance(k, slice):
+            start, stop, step = k.indices(shape[axis])
+            if step < 0:
+                indices = range(start, stop, step)
+                if len(indices) == 0:
+                    k = slice(0, 0)
+                else:
+                    k = slice(indices[-1], indices[0] + 1, -step)
+                    flip_axes.append(out_axis)
+            new_key.append(k)
+            out_axis += 1
+        else:
+            new_key.append(k)
+            if np.ndim(k) > 0:
+                out_axis += 1
+        axis += 1
+    return tuple(new_key), tuple(flip_axes)
+
+
+###############################################################################
+# Lazy Views
+###############################################################################
+class DatasetView(LazyArray):
+    """
+    Lazy basic-slicing view over any sliceable dataset (LazyH5Dataset,
+    TiffStack, numpy arrays and memmaps, ...).
+
+    view() composes slices without touching the data; reading (indexing)
+    translates the request into a single key on the source, so a lazy
+    source only ever reads the hyperslab inside the view:
+
+        roi = DatasetView(movie).view(np.s_[1000:5000, 100:300, 100:300])
+        roi.shape       # (4000, 200, 200), nothing read yet
+        block = roi[:500]   # reads movie[1000:1500, 100:300, 100:300]
+    """
+    def __init__(self, source, axes=None):
+        self.source = source
+        # One entry per source axis: a range (kept axis) or an int (dropped axis)
+        self._axes = tuple(axes) if axes is not None else tuple(range(n) for n in source.shape)
+
+    # -- array-like metadata ---------------------------------------------------
+    @property
+    def shape(self):
+        return tuple(len(a) for a in self._axes if isinstance(a, range))
+
+    @property
+    def dtype(self):
+        return self.source.dtype
+
+    @property
+    def mode(self):
+        return getattr(self.source, 'mode', "memory")
+
+    def __repr__(self):
+        if isinstance(self.source, np.ndarray):
+            source = f"<{type(self.source).__name__} shape={self.source.shape}>"
+        else:
+            source = repr(self.source)
+        return f"<DatasetView shape={self.shape} of {source}>"
+
+    # -- composing -------------------------------------------------------------
+    def view(self, key):
+        """
+        Return a new DatasetView restricted by a basic (int/slice/Ellipsis) key.
+        """
+        return DatasetView(self.source, self._compose(key))
+
+    def source_key(self, key=()):
+        """
+        Translate `key` (relative to this view) into the equivalent key on the source.
+        """
+        return tuple(_range_to_key(a) for a in self._compose(key))
+
+    def _compose(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        kept = [i for i, a in enumerate(self._axes) if isinstance(a, range)]
+
+        if any(k is Ellipsis for k in key):
+            i = next(i for i, k in enumerate(key) if k is Ellipsis)
+            fill = len(kept) - (len(key) - 1)
+            key = key[:i] + (slice(None),) * fill + key[i + 1:]
+        if len(key) > len(kept):
+            raise IndexError(f"too many indices for view of dimension {len(kept)}")
+
+        axes = list(self._axes)
+        for axis, k in zip(kept, key):
+            if isinstance(k, slice):
+                axes[axis] = axes[axis][k]
+            elif isinstance(k, (int, np.integer)):
+                axes[axis] = axes[axis][k]  # range indexing handles negatives and bounds
+            else:
+                raise TypeError(f"DatasetView supports int, slice and Ellipsis keys, not {type(k).__name__}")
+        return axes
+
+    # -- reading ---------------------------------------------------------------
+    def __getitem__(self, key):
+        return np.asarray(self.source[self.source_key(key)])
+
+    def read_into(self, out, start, stop):
+        out[start:stop] = self[start:stop]
+        return out
+
+    def close(self):
+        pass  # the view does not own its source
+
+
+def _range_to_key(axis):
+    if not isinstance(axis, range):
+        return axis
+    if axis.step < 0 and axis.stop < 0:
+        # range(5, -1, -1) would read as slice(5, -1, -1) == nothing
+        return slice(axis.start, None, axis.step)
+    return slice(axis.start, axis.stop, axis.step)
@@ -0,0 +1,142 @@
+import threading
+
+from PyQt6.QtCore import QObject, pyqtSignal
+
+from data_loaders import load_selected_data
+from lazy_dataset import allocate_array, DEFAULT_SCRATCH_DIR
+from stage_cache import dataset_identity
+
+
+###############################################################################
+# Background Data Loader
+###############################################################################
+class DataLoadWorker(QObject):
+    """
+    Loads the selected datasets off the GUI thread.
+
+    Usage (from the GUI thread):
+        worker.moveToThread(thread)
+        thread.started.connect(worker.run)
+        thread.start()
+
+    Datasets are first opened through data_loaders.load_selected_data. Lazy
+    handles that need decoding (chunked/compressed HDF5) and fit in
+    `preload_limit_bytes` are then streamed into RAM chunk by chunk along the
+    first axis; after every chunk the worker emits `progress` and a
+    `partial_data` view over the frames read so far, so the UI can preview
+    the beginning of the movie while the rest streams in. Larger datasets
+    and memory-mapped ones are handed over as lazy handles right away.
+
+    Image sequences (mode "decode") are always materialized, since decoding
+    the same frames again on every access would be far too slow. Those that
+    do not fit in `preload_limit_bytes` go to an on-disk .npy cache in
+    `cache_dir` which is then used as a memory map.
+
+    The stage cache identity of every loaded movie (see
+    stage_cache.dataset_identity; one stat per file for an image folder) is
+    computed here too and handed over with `finished`.
+
+    cancel() may be called from any thread. The worker checks the flag between
+    chunks, closes the handle it was streaming and emits `cancelled`.
+    """
+    progress = pyqtSignal(str, int, int)        # name, chunks done, chunks total
+    partial_data = pyqtSignal(str, object)      # name, view over the frames loaded so far
+    dataset_loaded = pyqtSignal(str, object)    # name, array or lazy handle
+    finished = pyqtSignal(object)               # {name: identity} of the loaded movies
+    cancelled = pyqtSignal()
+    error = pyqtSignal(str)
+
+    PRELOAD_LIMIT_BYTES = 2 * 1024 ** 3
+    CHUNK_BYTES = 64 * 1024 ** 2
+
+    def __init__(self, data_path, selected_items, preload_limit_bytes=None, cache_dir=None,
+                 parent=None):
+        super().__init__(parent)
+        self.data_path = data_path
+        self.selected_items = selected_items
+        self.preload_limit_bytes = (self.PRELOAD_LIMIT_BYTES if preload_limit_bytes is None
+                                    else preload_limit_bytes)
+        self.cache_dir = cache_dir or DEFAULT_SCRATCH_DIR
+        self._cancel_event = threading.Event()
+
+    def cancel(self):
+        self._cancel_event.set()
+
+    def is_cancelled(self):
+        return self._cancel_event.is_set()
+
+    def run(self):
+        try:
+            loaded = load_selected_data(self.data_path, self.selected_items)
+        except Exception as e:
+            self.error.emit(f"Failed to open {self.data_path}: {e}")
+            self.finished.emit({})
+            return
+
+        identities = {}
+        names = list(loaded.keys())
+        for i, name in enumerate(names):
+            if self.is_cancelled():
+                self._close_all(loaded, names[i:])
+                self.cancelled.emit()
+                self.finished.emit(identities)
+                return
+
+            data = loaded[name]
+            try:
+                if self._should_stream(data):
+                    data = self._stream_into_memory(name, data)
+                    if data is None:  # cancelled mid-stream
+                        self._close_all(loaded, names[i + 1:])
+                        self.cancelled.emit()
+                        self.finished.emit(identities)
+                        return
+                else:
+                    self.progress.emit(name, 1, 1)
+            except Exception as e:
+                self.error.emit(f"Error loading '{name}': {e}")
+                continue
+
+            if len(getattr(data, 'shape', ())) >= 3:
+                identities[name] = dataset_identity(self.data_path, name, data)
+            self.dataset_loaded.emit(name, data)
+
+        self.finished.emit(identities)
+
+    def _should_stream(self, data):
+        mode = getattr(data, 'mode', None)
+        if mode == "decode":
+            return True
+        return (mode == "chunked" and data.ndim > 0
+                and data.nbytes <= self.preload_limit_bytes)
+
+    def _stream_into_memory(self, name, handle):
+        """
+        Copy a lazy handle into a preallocated array (or on-disk cache),
+        one chunk of frames at a time.
+        Returns the array, or None if the load was cancelled.
+        """
+        n_frames = handle.shape[0]
+        frame_bytes = max(1, handle.nbytes // max(1, n_frames))
+        frames_per_chunk = max(1, self.CHUNK_BYTES // frame_bytes)
+        n_chunks = -(-n_frames // frames_per_chunk)
+
+        try:
+            buffer = allocate_array(handle.shape, handle.dtype, self.preload_limit_bytes,
+                                    self.cache_dir)
+            for done, start in enumerate(range(0, n_frames, frames_per_chunk), start=1):
+                stop = min(start + frames_per_chunk, n_frames)
+                handle.read_into(buffer, start, stop)
+                self.progress.emit(name, done, n_chunks)
+                self.partial_data.emit(name, buffer[:stop])
+                if self.is_cancelled():
+                    return None
+        finally:
+            handle.close()
+        return buffer
+
+    @staticmethod
+    def _close_all(loaded, names):
+        for name in names:
+            if hasattr(loaded[name], 'close'):
+                loaded[name].close()
@@ -1,12 +1,9 @@
 import sys
 from PyQt6.QtWidgets import (
-    QApplication, QDialog, QMainWindow, QWidget, QTabWidget, QMessageBox)
+    QApplication, QDialog, QMainWindow, QWidget, QTabWidget, QMessageBox,
+    QProgressBar, QPushButton)
 from PyQt6.QtGui import QAction
-import h5py
-import re
-import scipy
-from pynwb import NWBHDF5IO
-import numpy as np
+from PyQt6.QtCore import QThread
 
 # dependencies
 from tabs_preprocessing import (PreprocessingTab, ParameterSetupTab, 
@@ -14,9 +11,9 @@ from tabs_preprocessing import (PreprocessingTab, ParameterSetupTab,
 )
 from startup_dialog import StartupDialog
 
-import os
 from data_selection_dialog import DataSelectionDialog
 from color_manager import ColorCycler 
+from load_worker import DataLoadWorker
 
 
 ###############################################################################
@@ -46,8 +43,9 @@ class GraFTMainWindow(QMainWindow):
 
         # Create tabs
         self.preprocess_tab = PreprocessingTab()
+        self.preprocess_tab.output_ready.connect(self._on_preprocessing_output)
         self.parameter_tab = ParameterSetupTab()
-        self.algorithm_tab = AlgorithmExecutionTab()
+        self.algorithm_tab = AlgorithmExecutionTab(self.preprocess_tab, self.parameter_tab)
         self.results_tab = ResultsVisualizationTab()
 
         # Add tabs
@@ -59,6 +57,13 @@ class GraFTMainWindow(QMainWindow):
         # Create a menu bar
         self._create_menu_bar()
 
+        # Status bar with load progress and cancel button
+        self.loaded_data = {}
+        self._partial_names = set()
+        self._load_thread = None
+        self._load_worker = None
+        self._create_status_bar()
+
         # Immediately load data if path is provided
         if self.data_path:
             self.load_data()
@@ -165,9 +170,15 @@ class GraFTMainWindow(QMainWindow):
 
 
     def load_data(self):
+        """
+        Start loading the selected datasets on a background thread.
+        Progress is shown in the status bar; results arrive through the
+        DataLoadWorker signals and are collected in self.loaded_data.
+        """
         print(f"[MainApp] Loading data from: {self.data_path}")
 
         self.loaded_data = {}  # Dictionary to store the loaded data
+        self._partial_names = set()  # Datasets still streaming in
 
         # At this point, you already know which items user selected:
         if self.selected_items:
@@ -178,150 +189,130 @@ class GraFTMainWindow(QMainWindow):
         else:
             print("[MainApp] No items were selected.")
             return
-        
-        # Load data based on the file type
-        if self.data_path.lower().endswith(('.h5', '.hdf5')):
-            self._load_hdf5_data()
-        elif self.data_path.lower().endswith('.mat'):
-            self._load_mat_data()
-        elif self.data_path.lower().endswith('.nwb'):
-            self._load_nwb_data()
-        else:
-            print("[MainApp] Unsupported file type.")
 
-        # At this point, self.loaded_data contains the loaded datasets
-        if self.loaded_data:
-            print("[MainApp] Data successfully loaded:")
-            for name in self.loaded_data.keys():
-                print(f"  - {name}: {self.loaded_data[name].shape} (shape)")
-        else:
-            print("[MainApp] No data was loaded.")
+        self._load_thread = QThread(self)
+        self._load_worker = DataLoadWorker(self.data_path, self.selected_items)
+        self._load_worker.moveToThread(self._load_thread)
 
+        self._load_thread.started.connect(self._load_worker.run)
+        self._load_worker.progress.connect(self._on_load_progress)
+        self._load_worker.partial_data.connect(self._on_partial_data)
+        self._load_worker.dataset_loaded.connect(self._on_dataset_loaded)
+        self._load_worker.error.connect(self._on_load_error)
+        self._load_worker.cancelled.connect(self._on_load_cancelled)
+        self._load_worker.finished.connect(self._on_load_finished)
+        self._load_worker.finished.connect(self._load_thread.quit)
+        self._load_thread.finished.connect(self._load_worker.deleteLater)
 
-    # def _load_hdf5_data(self):
-    #     """
-    #     Load selected datasets from an HDF5 (.h5 or .hdf5) file and print the results.
-    #     Supports nested groups within the HDF5 file.
-    #     """
-    #     try:
-    #         with h5py.File(self.data_path, 'r') as f:
-    #             for full_path, dtype in self.selected_items:
-    #                 # Convert Windows-style backslashes to forward slashes for HDF5 paths
-    #                 dataset_path = full_path.replace("\\", "/")
+        self.load_progress_bar.setValue(0)
+        self.load_progress_bar.setVisible(True)
+        self.cancel_load_button.setEnabled(True)
+        self.cancel_load_button.setVisible(True)
+        self.statusBar().showMessage("Loading data...")
 
-    #                 # Extract the relative dataset path inside the HDF5 file
-    #                 relative_path = dataset_path.replace(self.data_path.replace("\\", "/"), "").lstrip("/")
+        self._load_thread.start()
 
-    #                 if relative_path in f:
-    #                     data = np.array(f[relative_path])  # Convert dataset to NumPy array
-    #                     self.loaded_data[relative_path] = data
-    #                     print(f"\n[MainApp] Successfully loaded dataset '{relative_path}':\n", data)
 
-    #                 else:
-    #                     print(f"[MainApp] Dataset '{relative_path}' not found in HDF5 file.")
+    def cancel_loading(self):
+        """
+        Ask the loader to stop after the chunk it is currently reading.
+        """
+        if self._load_worker is not None:
+            self._load_worker.cancel()
+            self.cancel_load_button.setEnabled(False)
+            self.statusBar().showMessage("Cancelling...")
 
-    #     except Exception as e:
-    #         print(f"[MainApp] Error loading HDF5 file: {e}")
 
+    def _create_status_bar(self):
+        self.load_progress_bar = QProgressBar()
+        self.load_progress_bar.setMaximumWidth(250)
+        self.load_progress_bar.setVisible(False)
 
-    def _load_hdf5_data(self):
-        """
-        Load selected datasets from an HDF5 (.h5 or .hdf5) file and print the results.
-        Works on both Windows and Unix-based systems (macOS, Linux).
-        """
-        try:
-            with h5py.File(self.data_path, 'r') as f:
-                for full_path, dtype in self.selected_items:
-                    # Extract only the internal dataset path inside the HDF5 file
-                    relative_path = full_path.replace(self.data_path, "").lstrip("/").lstrip("\\")  # Normalize path
-                    dataset_path = re.sub(r'^.*\.h5/', '', relative_path)  # Removes everything up to and including ".h5/"
+        self.cancel_load_button = QPushButton("Cancel")
+        self.cancel_load_button.clicked.connect(self.cancel_loading)
+        self.cancel_load_button.setVisible(False)
 
-                    print(f"[MainApp] Trying to load dataset: '{relative_path}'")
+        self.statusBar().addPermanentWidget(self.load_progress_bar)
+        self.statusBar().addPermanentWidget(self.cancel_load_button)
 
-                    # Ensure dataset exists in file
-                    if dataset_path in f:
-                        data = np.array(f[dataset_path])
-                        self.loaded_data[relative_path] = data
-                        print(f"\n[MainApp] Successfully loaded dataset '{relative_path}':\n", data)
 
-                    else:
-                        print(f"[MainApp] Dataset '{relative_path}' not found in HDF5 file. Available datasets:")
-                        def print_hdf5_structure(name, obj):
-                            print(f" - {name}")
+    def _on_load_progress(self, name, done, total):
+        self.load_progress_bar.setMaximum(total)
+        self.load_progress_bar.setValue(done)
+        self.statusBar().showMessage(f"Loading '{name}': chunk {done}/{total}")
 
-                        f.visititems(print_hdf5_structure)  # for debugging
 
-        except Exception as e:
-            print(f"[MainApp] Error loading HDF5 file: {e}")
+    def _on_partial_data(self, name, data):
+        # Expose what has been read so far; replaced by the full array when done.
+        self.loaded_data[name] = data
+        self._partial_names.add(name)
+        self.statusBar().showMessage(f"Loading '{name}': {data.shape[0]} frames available for preview")
 
 
-    def _load_mat_data(self):
-        """
-        Load selected variables from a MATLAB .mat file and print the result.
-        """
-        def is_mat73(file_path):
-            """
-            Returns True if file_path is a MATLAB v7.3 file (i.e., an HDF5 file),
-            False otherwise.
-            """
-            try:
-                with open(file_path, 'rb') as f:
-                    header = f.read(128)
-                return b'MATLAB 7.3 MAT-file' in header
-            except Exception:
-                return False
-
-        if is_mat73(self.data_path):
-            # If it's a MATLAB v7.3 file, treat it like an HDF5 file
-            self._load_hdf5_data()
-            return
+    def _on_dataset_loaded(self, name, data):
+        self.loaded_data[name] = data
+        self._partial_names.discard(name)
 
-        try:
-            # Load the .mat file
-            mat_dict = scipy.io.loadmat(self.data_path, squeeze_me=False, struct_as_record=False)
 
-            for full_path, dtype in self.selected_items:
-                var_name = os.path.basename(full_path)  # Extract just the variable name
+    def _on_load_error(self, message):
+        print(f"[MainApp] {message}")
+        QMessageBox.warning(self, "Error", message)
 
-                if var_name in mat_dict:
-                    data = mat_dict[var_name]  # Extract data
 
-                    # Convert MATLAB struct objects to dictionary for readability
-                    if isinstance(data, np.ndarray) and data.dtype.names is not None:
-                        data = {field: data[field] for field in data.dtype.names}
+    def _on_load_cancelled(self):
+        # Drop the dataset that was only partially streamed in.
+        for name in self._partial_names:
+            self.loaded_data.pop(name, None)
+        self._partial_names.clear()
+        print("[MainApp] Loading cancelled by user.")
 
-                    self.loaded_data[var_name] = data  # Store loaded variable
-                    print(f"\n[MainApp] Successfully loaded variable '{var_name}':\n", data) # print for now
 
-                else:
-                    print(f"[MainApp] '{var_name}' not found in .mat file.")
+    def _on_load_finished(self, identities):
+        self._load_worker = None
+        self.load_progress_bar.setVisible(False)
+        self.cancel_load_button.setVisible(False)
+        self.statusBar().showMessage("Data loaded" if self.loaded_data else "No data was loaded", 5000)
+
+        # At this point, self.loaded_data contains the loaded datasets
+        if self.loaded_data:
+            print("[MainApp] Data successfully loaded:")
+            for name in self.loaded_data.keys():
+                print(f"  - {name}: {self.loaded_data[name].shape} (shape)")
+        else:
+            print("[MainApp] No data was loaded.")
+            return
+
+        # Hand the first movie-like dataset to the preprocessing tab
+        for name, data in self.loaded_data.items():
+            if len(getattr(data, 'shape', ())) >= 3:
+                self.preprocess_tab.set_dataset(name, data, identity=identities.get(name))
+                break
+
 
-        except Exception as e:
-            print(f"[MainApp] Error loading .mat file: {e}")
+    def _on_preprocessing_output(self, name, data):
+        # The written HDF5 file is the working dataset from now on
+        self.loaded_data[name] = data
+        self.statusBar().showMessage(f"Working dataset: {data.file_path} ({data.mode})", 5000)
+        print(f"[MainApp] Preprocessed output '{name}': {data.shape}")
 
 
-    def _load_nwb_data(self):
+    def closeEvent(self, event):
         """
-        Load selected datasets from an NWB file.
+        Stop any running load or preprocessing step and release file handles
+        held by lazily loaded datasets.
         """
-        try:
-            with NWBHDF5IO(self.data_path, 'r') as io:
-                nwbfile = io.read()
-
-                for name, dtype in self.selected_items:
-                    try:
-                        # Check if dataset exists in NWB file
-                        if hasattr(nwbfile, name):
-                            dataset = getattr(nwbfile, name)
-                            self.loaded_data[name] = np.array(dataset.data[:])  # Convert to NumPy array
-                            print(f"[MainApp] Loaded dataset '{name}' from NWB file.")
-                        else:
-                            print(f"[MainApp] '{name}' not found in NWB file.")
-                    except Exception as e:
-                        print(f"[MainApp] Error extracting '{name}' from NWB: {e}")
-
-        except Exception as e:
-            print(f"[MainApp] Error loading NWB file: {e}")
+        self.algorithm_tab.cancel()
+        self.preprocess_tab.cancel_stage()
+        if self._load_worker is not None:
+            self._load_worker.cancel()
+        if self._load_thread is not None and self._load_thread.isRunning():
+            self._load_thread.quit()
+            self._load_thread.wait()
+
+        for data in getattr(self, 'loaded_data', {}).values():
+            if hasattr(data, 'close'):
+                data.close()
+        super().closeEvent(event)
 
 
     def _create_menu_bar(self):
@@ -0,0 +1,505 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import numpy as np
+import scipy.fft
+
+
+###############################################################################
+# Rigid Motion Correction (phase correlation)
+###############################################################################
+def _fourier_shift_phase(shape, shifts):
+    """
+    Phase ramps that move (B, H, W) frames by -shifts when multiplied onto
+    their rfft2 spectra. Returns a complex64 (B, H, W // 2 + 1) array.
+    """
+    height, width = shape
+    ky = np.fft.fftfreq(height).astype(np.float32)
+    kx = np.fft.rfftfreq(width).astype(np.float32)
+    dy = shifts[:, 0:1].astype(np.float32)
+    dx = shifts[:, 1:2].astype(np.float32)
+    # exp(2*pi*i*(ky*dy + kx*dx)) as an outer product of two 1D ramps
+    ramp_y = np.exp(2j * np.pi * ky[None, :] * dy).astype(np.complex64)
+    ramp_x = np.exp(2j * np.pi * kx[None, :] * dx).astype(np.complex64)
+    return ramp_y[:, :, None] * ramp_x[:, None, :]
+
+
+def _parabolic_offset(c_minus, c_zero, c_plus):
+    """
+    Sub-sample offset of a peak from three neighbouring samples (vectorized).
+    """
+    denom = c_minus - 2 * c_zero + c_plus
+    with np.errstate(divide='ignore', invalid='ignore'):
+        offset = np.where(denom != 0, 0.5 * (c_minus - c_plus) / denom, 0.0)
+    return np.clip(offset, -0.5, 0.5)
+
+
+def _wrap_shift(index, n):
+    # Map a circular peak index to a signed shift in [-n/2, n/2)
+    return (index + n // 2) % n - n // 2
+
+
+def _taper_mask(shape):
+    """
+    Separable sigmoid taper that fades the outer ~1/8 of each axis to zero, so
+    the (non-periodic) image borders do not dominate the correlation.
+    """
+    def ramp(n):
+        edge = max(n / 8, 1.0)
+        distance = np.minimum(np.arange(n), n - 1 - np.arange(n))
+        return 1.0 / (1.0 + np.exp(-(distance - edge / 2) / (edge / 8)))
+    return np.outer(ramp(shape[0]), ramp(shape[1])).astype(np.float32)
+
+
+def _reference_spectrum(images, taper, smooth_sigma):
+    """
+    Conjugate, whitened and Gaussian-low-passed rfft2 of tapered reference
+    image(s) (..., h, w). Correlating tapered frames with it is phase
+    correlation in which only the reference is normalized, which stays robust
+    for smooth, low-contrast images.
+    """
+    images = images - images.mean(axis=(-2, -1), keepdims=True)
+    spectrum = np.conj(scipy.fft.rfft2(images * taper, workers=1))
+    spectrum /= np.abs(spectrum) + np.float32(1e-5)
+    if smooth_sigma:
+        height, width = images.shape[-2:]
+        ky = np.fft.fftfreq(height)[:, None]
+        kx = np.fft.rfftfreq(width)[None, :]
+        spectrum *= np.exp(-2 * np.pi ** 2 * smooth_sigma ** 2 * (ky ** 2 + kx ** 2))
+    return spectrum.astype(np.complex64)
+
+
+def _tapered_spectra(images, taper):
+    images = images - images.mean(axis=(-2, -1), keepdims=True)
+    return scipy.fft.rfft2(images * taper, workers=1)
+
+
+def _correlation_peaks(cross, shape, search_window=None, upsample_factor=1):
+    """
+    (N, 2) subpixel (dy, dx) correlation peaks of N image pairs, given their
+    cross spectra as (N, h, w // 2 + 1) rfft2 half spectra.
+    search_window is a boolean mask broadcastable to (N, h, w) that restricts
+    where the integer peak may lie. Integer peaks are refined on a
+    1/upsample_factor grid, or with a parabolic fit if upsample_factor is 1.
+    """
+    corr = scipy.fft.irfft2(cross, s=shape, workers=1)
+    if search_window is not None:
+        np.copyto(corr, -np.inf, where=~search_window)
+
+    height, width = shape
+    n = corr.shape[0]
+    peak = np.argmax(corr.reshape(n, -1), axis=1)
+    py, px = np.unravel_index(peak, shape)
+    rows = np.arange(n)
+
+    coarse = np.stack([_wrap_shift(py, height), _wrap_shift(px, width)], axis=1).astype(np.float64)
+    if upsample_factor > 1:
+        return _refine_upsampled(cross, coarse, shape, upsample_factor)
+
+    c0 = corr[rows, py, px]
+    oy = _parabolic_offset(corr[rows, (py - 1) % height, px], c0, corr[rows, (py + 1) % height, px])
+    ox = _parabolic_offset(corr[rows, py, (px - 1) % width], c0, corr[rows, py, (px + 1) % width])
+    oy = np.nan_to_num(oy, posinf=0.0, neginf=0.0)
+    ox = np.nan_to_num(ox, posinf=0.0, neginf=0.0)
+    return coarse + np.stack([oy, ox], axis=1)
+
+
+def _refine_upsampled(cross, coarse, shape, factor):
+    """
+    Refine integer peaks by evaluating the correlation on a 1/factor grid
+    within +-0.75 px, as a batched matrix DFT of the half spectrum
+    (Guizar-Sicairos et al., 2008), then a parabolic fit on that grid.
+    """
+    height, width = shape
+    n = int(np.ceil(1.5 * factor)) | 1  # odd, so the coarse peak is the centre sample
+    offsets = (np.arange(n) - n // 2) / factor
+
+    ky = np.fft.fftfreq(height)
+    kx = np.fft.rfftfreq(width)
+    ys = coarse[:, 0:1] + offsets[None, :]
+    xs = coarse[:, 1:2] + offsets[None, :]
+    kernel_y = np.exp(2j * np.pi * ys[:, :, None] * ky[None, None, :]).astype(np.complex64)
+    kernel_x = np.exp(2j * np.pi * kx[None, :, None] * xs[:, None, :]).astype(np.complex64)
+
+    # Hermitian weights: interior rfft columns stand for two conjugate columns
+    weights = np.full(len(kx), 2.0, dtype=np.float32)
+    weights[0] = 1.0
+    if width % 2 == 0:
+        weights[-1] = 1.0
+
+    upsampled = np.real(kernel_y @ (cross * weights) @ kernel_x)
+    batch = upsampled.shape[0]
+    peak = np.argmax(upsampled.reshape(batch, -1), axis=1)
+    iy, ix = np.unravel_index(peak, (n, n))
+    rows = np.arange(batch)
+
+    c0 = upsampled[rows, iy, ix]
+    oy = _parabolic_offset(upsampled[rows, np.maximum(iy - 1, 0), ix], c0,
+                           upsampled[rows, np.minimum(iy + 1, n - 1), ix])
+    ox = _parabolic_offset(upsampled[rows, iy, np.maximum(ix - 1, 0)], c0,
+                           upsampled[rows, iy, np.minimum(ix + 1, n - 1)])
+    return np.stack([coarse[:, 0] + (offsets[iy] + oy / factor),
+                     coarse[:, 1] + (offsets[ix] + ox / factor)], axis=1)
+
+
+class RigidMotionCorrector:
+    """
+    Rigid registration of (T, H, W) movies to a template by phase correlation.
+
+    Frames are processed in batches. The edge-tapered frames are correlated
+    with the whitened, low-passed template spectrum (smooth_sigma px) and the
+    integer peak within max_shift is refined on a 1/upsample_factor grid
+    (upsample_factor=1 uses a parabolic fit). The frames' own spectra are then
+    phase-shifted back into place and inverse transformed, so the whole batch
+    takes two forward and two inverse FFTs. Batches are spread over a thread pool
+    (scipy.fft releases the GIL) and the movie is streamed from its source in
+    chunks of `frames_per_chunk`, with the next chunk read while the current
+    one is registered, so memory stays bounded regardless of length.
+
+    shifts are the (dy, dx) displacement of each frame relative to the
+    template; corrected frames are moved by -shifts (with circular wrap at
+    the borders).
+    """
+    name = "motion_correction"
+    # Pipeline hints: frames are registered independently, on any chunk grid
+    temporal_overlap = 0
+    chunk_alignment = 1
+
+    def __init__(self, max_shift=None, upsample_factor=10, smooth_sigma=1.15, template_frames=200,
+                 batch_size=32, frames_per_chunk=1024, max_workers=None, template=None):
+        self.max_shift = max_shift
+        self.upsample_factor = upsample_factor
+        self.smooth_sigma = smooth_sigma
+        self.template_frames = template_frames
+        self.batch_size = batch_size
+        self.frames_per_chunk = frames_per_chunk
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.template = None if template is None else np.asarray(template, dtype=np.float32)
+        self._template_given = template is not None
+
+        self.last_run_stats = None
+        self.shifts = None
+        self._n_frames = None
+        self._timings = {}
+        self._timings_lock = threading.Lock()
+        self._template_fft_conj = None
+        self._taper = None
+        self._search_window = None
+        self._executor = None
+
+    def params(self):
+        # Only settings that change the output; batching and threads do not.
+        return {'mode': 'rigid', 'max_shift': self.max_shift,
+                'upsample_factor': self.upsample_factor, 'smooth_sigma': self.smooth_sigma,
+                'template_frames': self.template_frames}
+
+    # -- setup -----------------------------------------------------------------
+    def prepare(self, source):
+        """
+        Build the template (mean of the first `template_frames` frames unless one
+        was given) and cache its spectrum. A template built for an earlier
+        source is rebuilt, since the same stage may run on another crop or binning.
+        """
+        if self.template is None or not self._template_given:
+            n = min(self.template_frames, source.shape[0])
+            self.template = np.asarray(source[:n], dtype=np.float32).mean(axis=0)
+        self._set_template(self.template)
+        self._n_frames = source.shape[0]
+        self.shifts = None
+        return self
+
+    def _set_template(self, template):
+        height, width = template.shape
+        self._taper = _taper_mask(template.shape)
+        self._template_fft_conj = _reference_spectrum(template.astype(np.float32), self._taper,
+                                                      self.smooth_sigma)
+
+        if self.max_shift is None:
+            self._search_window = None
+        else:
+            dy = np.abs(_wrap_shift(np.arange(height), height))
+            dx = np.abs(_wrap_shift(np.arange(width), width))
+            self._search_window = (dy[:, None] <= self.max_shift) & (dx[None, :] <= self.max_shift)
+
+    def _get_executor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers,
+                                                thread_name_prefix="MotionCorrection")
+        return self._executor
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    @contextmanager
+    def _timed(self, step):
+        # Accumulates per-step time; batches run concurrently, so steps done by
+        # the workers add up thread time rather than wall time.
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self._timings_lock:
+                self._timings[step] = self._timings.get(step, 0.0) + time.perf_counter() - started
+
+    # -- registration ----------------------------------------------------------
+    def _rigid_shifts(self, frames):
+        cross = _tapered_spectra(frames, self._taper) * self._template_fft_conj
+        return _correlation_peaks(cross, frames.shape[1:], self._search_window, self.upsample_factor)
+
+    def _register_batch(self, frames):
+        frames = np.asarray(frames, dtype=np.float32)
+        frame_shape = frames.shape[1:]
+        with self._timed('shift estimation'):
+            shifts = self._rigid_shifts(frames)
+        with self._timed('apply shifts'):
+            spectra = scipy.fft.rfft2(frames, workers=1)
+            spectra *= _fourier_shift_phase(frame_shape, shifts)
+            corrected = scipy.fft.irfft2(spectra, s=frame_shape, workers=1)
+        return corrected, shifts
+
+    def correct_chunk(self, frames):
+        """
+        Register an in-memory (T, H, W) block. Returns (corrected float32 frames, shifts).
+        """
+        if self._template_fft_conj is None:
+            raise RuntimeError("Call prepare() before correcting frames")
+        frames = np.asarray(frames)
+        batches = [frames[i:i + self.batch_size] for i in range(0, len(frames), self.batch_size)]
+        results = list(self._get_executor().map(self._register_batch, batches))
+        corrected = np.concatenate([r[0] for r in results]) if results else frames.astype(np.float32)
+        shifts = np.concatenate([r[1] for r in results]) if results else np.zeros((0, 2))
+        return corrected, shifts
+
+    def process_chunk(self, frames, start):
+        """
+        Pipeline entry point: register frames [start, start + len(frames)) of
+        the prepared source and record their shifts in self.shifts.
+        """
+        corrected, shifts = self.correct_chunk(frames)
+        if self.shifts is None:
+            self.shifts = np.zeros((self._n_frames,) + shifts.shape[1:], dtype=np.float64)
+        self.shifts[start:start + len(shifts)] = shifts
+        return corrected
+
+    def correct(self, source, out=None, progress=None, is_cancelled=None):
+        """
+        Stream `source` through registration into `out` (allocated in memory
+        as float32 if not given; pass a memmap/HDF5 dataset for long movies).
+        Returns the per-frame shifts ((T, 2) here), or None if cancelled.
+        last_run_stats then holds the throughput and a per-step timing report.
+        """
+        if self._template_fft_conj is None:
+            self.prepare(source)
+        n_frames = source.shape[0]
+        if out is None:
+            out = np.empty(source.shape, dtype=np.float32)
+        shifts = None
+        self._timings = {}
+
+        starts = list(range(0, n_frames, self.frames_per_chunk))
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=1, thread_name_prefix="MotionCorrectionReader") as reader:
+            def read(start):
+                with self._timed('read'):
+                    return np.asarray(source[start:min(start + self.frames_per_chunk, n_frames)])
+
+            pending = reader.submit(read, starts[0]) if starts else None
+            for i, start in enumerate(starts):
+                block = pending.result()
+                if i + 1 < len(starts):
+                    pending = reader.submit(read, starts[i + 1])  # prefetch while registering
+
+                corrected, block_shifts = self.correct_chunk(block)
+                stop = start + len(block)
+                with self._timed('write'):
+                    out[start:stop] = corrected
+                if shifts is None:
+                    shifts = np.empty((n_frames,) + block_shifts.shape[1:], dtype=np.float64)
+                shifts[start:stop] = block_shifts
+
+                if progress is not None:
+                    progress(stop, n_frames)
+                if is_cancelled is not None and is_cancelled():
+                    return None
+
+        elapsed = time.perf_counter() - started
+        self.last_run_stats = {'frames': n_frames, 'seconds': elapsed,
+                               'frames_per_second': n_frames / elapsed if elapsed > 0 else float('inf'),
+                               'timings': dict(self._timings)}
+        if shifts is None:
+            shifts = np.zeros((0, 2))
+        return shifts
+
+    def timing_report(self):
+        """
+        Multi-line summary of last_run_stats, one line per step.
+        """
+        stats = self.last_run_stats
+        if stats is None:
+            return "No run yet."
+        lines = [f"{self.params()['mode']}: {stats['frames']} frames in {stats['seconds']:.2f}s "
+                 f"({stats['frames_per_second']:.0f} frames/s)"]
+        for step, seconds in stats['timings'].items():
+            lines.append(f"  {step:<20s}{seconds:8.2f}s")
+        return "\n".join(lines)
+
+
+###############################################################################
+# Piecewise-Rigid Motion Correction (overlapping patches)
+###############################################################################
+def _patch_starts(n, patch, overlap):
+    """
+    Start offsets of patches of length `patch` overlapping by `overlap` that
+    cover [0, n); the last patch is moved back to end exactly at n.
+    """
+    if patch >= n:
+        return np.array([0])
+    starts = list(range(0, n - patch + 1, patch - overlap))
+    if starts[-1] != n - patch:
+        starts.append(n - patch)
+    return np.asarray(starts)
+
+
+def _interpolation_matrix(n, centers):
+    """
+    (n, len(centers)) matrix of linear-interpolation weights from values at
+    `centers` to every pixel 0..n-1 (held constant beyond the outer centers).
+    """
+    if len(centers) == 1:
+        return np.ones((n, 1), dtype=np.float32)
+    identity = np.eye(len(centers))
+    pixels = np.arange(n)
+    return np.stack([np.interp(pixels, centers, identity[k]) for k in range(len(centers))],
+                    axis=1).astype(np.float32)
+
+
+def _remap_bilinear(frames, dy, dx):
+    """
+    Sample each (B, H, W) frame at (y + dy, x + dx) with bilinear interpolation,
+    for the whole batch at once. Coordinates outside the frame are clamped to
+    the border.
+    """
+    batch, height, width = frames.shape
+    y = np.arange(height, dtype=np.float32)[:, None] + dy
+    x = np.arange(width, dtype=np.float32)[None, :] + dx
+    np.clip(y, 0, height - 1, out=y)
+    np.clip(x, 0, width - 1, out=x)
+
+    y0 = np.minimum(y.astype(np.int32), max(height - 2, 0))  # y >= 0, so astype floors
+    x0 = np.minimum(x.astype(np.int32), max(width - 2, 0))
+    wy = y - y0
+    wx = x - x0
+    y1 = np.minimum(y0 + 1, height - 1)
+    x1 = np.minimum(x0 + 1, width - 1)
+
+    flat = frames.reshape(batch, -1)
+
+    def gather(yi, xi):
+        return np.take_along_axis(flat, (yi * width + xi).reshape(batch, -1), axis=1).reshape(yi.shape)
+
+    top = gather(y0, x0) * (1 - wx) + gather(y0, x1) * wx
+    bottom = gather(y1, x0) * (1 - wx) + gather(y1, x1) * wx
+    return top * (1 - wy) + bottom * wy
+
+
+class PiecewiseRigidMotionCorrector(RigidMotionCorrector):
+    """
+    Piecewise-rigid registration for non-uniform (e.g. brain) motion.
+
+    Each batch of frames is first registered rigidly as a whole. Every frame
+    is then cut into overlapping patches of `patch_size` pixels (overlapping
+    by `overlap`), and all patches of the batch are registered to the
+    matching template patches at once, searching within `max_deviation`
+    pixels of the frame's rigid shift. The patch shifts are linearly
+    interpolated between patch centres into a smooth per-pixel shift field,
+    and the batch is resampled with one vectorized bilinear remap. Batches
+    still run in parallel on the thread pool.
+
+    Shifts are returned per patch as (T, n_patches_y, n_patches_x, 2);
+    borders are clamped instead of wrapped.
+    """
+    def __init__(self, patch_size=128, overlap=32, max_deviation=3, **kwargs):
+        super().__init__(**kwargs)
+        if not 0 <= overlap < patch_size:
+            raise ValueError(f"overlap must be in [0, patch_size), got {overlap} for {patch_size}")
+        self.patch_size = patch_size
+        self.overlap = overlap
+        self.max_deviation = max_deviation
+
+        self._patch_y = None
+        self._patch_x = None
+        self._patch_shape = None
+        self._patch_template_fft_conj = None
+        self._patch_taper = None
+        self._field_y = None
+        self._field_x = None
+
+    def params(self):
+        params = super().params()
+        params.update({'mode': 'piecewise_rigid', 'patch_size': self.patch_size,
+                       'overlap': self.overlap, 'max_deviation': self.max_deviation})
+        return params
+
+    @property
+    def patch_grid(self):
+        """
+        (n_patches_y, n_patches_x) once prepared.
+        """
+        return (len(self._patch_y), len(self._patch_x))
+
+    def _set_template(self, template):
+        super()._set_template(template)
+        height, width = template.shape
+        ph, pw = min(self.patch_size, height), min(self.patch_size, width)
+        self._patch_shape = (ph, pw)
+        self._patch_y = _patch_starts(height, ph, self.overlap)
+        self._patch_x = _patch_starts(width, pw, self.overlap)
+
+        patches = self._extract_patches(template[None].astype(np.float32))[0]
+        self._patch_taper = _taper_mask(self._patch_shape)
+        self._patch_template_fft_conj = _reference_spectrum(patches, self._patch_taper, self.smooth_sigma)
+        self._field_y = _interpolation_matrix(height, self._patch_y + (ph - 1) / 2)
+        self._field_x = _interpolation_matrix(width, self._patch_x + (pw - 1) / 2)
+
+    def _extract_patches(self, frames):
+        # (B, H, W) -> (B, n_patches_y, n_patches_x, ph, pw) copy
+        windows = np.lib.stride_tricks.sliding_window_view(frames, self._patch_shape, axis=(1, 2))
+        return windows[:, self._patch_y[:, None], self._patch_x[None, :]]
+
+    def _patch_shifts(self, frames, rigid):
+        ph, pw = self._patch_shape
+        batch = len(frames)
+        ny, nx = self.patch_grid
+
+        patches = self._extract_patches(frames)
+        cross = _tapered_spectra(patches, self._patch_taper) * self._patch_template_fft_conj
+
+        # Search only near each frame's rigid shift
+        center = np.round(rigid).astype(np.int64)
+        dy = np.abs(_wrap_shift(np.arange(ph)[None, :] - center[:, 0:1], ph)) <= self.max_deviation
+        dx = np.abs(_wrap_shift(np.arange(pw)[None, :] - center[:, 1:2], pw)) <= self.max_deviation
+        window = dy[:, None, None, :, None] & dx[:, None, None, None, :]
+        window = np.broadcast_to(window, (batch, ny, nx, ph, pw)).reshape(-1, ph, pw)
+
+        shifts = _correlation_peaks(cross.reshape((-1,) + cross.shape[3:]), self._patch_shape,
+                                    window, self.upsample_factor)
+        return shifts.reshape(batch, ny, nx, 2)
+
+    def _register_batch(self, frames):
+        frames = np.asarray(frames, dtype=np.float32)
+        with self._timed('rigid estimate'):
+            rigid = self._rigid_shifts(frames)
+        with self._timed('patch registration'):
+            shifts = self._patch_shifts(frames, rigid)
+        with self._timed('shift field'):
+            field = shifts.astype(np.float32)
+            dy = self._field_y @ field[..., 0] @ self._field_x.T
+            dx = self._field_y @ field[..., 1] @ self._field_x.T
+        with self._timed('remap'):
+            corrected = _remap_bilinear(frames, dy, dx)
+        return corrected, shifts
@@ -0,0 +1,257 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import scipy.sparse
+
+
+###############################################################################
+# Pixel Affinity Graph (k nearest neighbours by temporal correlation)
+###############################################################################
+GRAPH_METHODS = ("spatial", "random_projection", "exact")
+
+
+class TraceNormalizer:
+    """
+    Zero-mean, unit-norm rows of an (N, T) matrix, produced on demand for a
+    subset of rows, so that dot products between them are Pearson
+    correlations. Only the per-row mean and norm are kept, never a normalized
+    copy of the whole matrix. Constant rows normalize to zero.
+    """
+    def __init__(self, traces, rows_per_pass=4096):
+        self.traces = traces
+        n_pixels = traces.shape[0]
+        self.mean = np.empty(n_pixels, dtype=np.float32)
+        self.inv_norm = np.empty(n_pixels, dtype=np.float32)
+        for start in range(0, n_pixels, rows_per_pass):
+            block = np.asarray(traces[start:start + rows_per_pass], dtype=np.float32)
+            mean = block.mean(axis=1)
+            norm = np.linalg.norm(block - mean[:, None], axis=1)
+            self.mean[start:start + len(block)] = mean
+            self.inv_norm[start:start + len(block)] = np.divide(1.0, norm, out=np.zeros_like(norm),
+                                                                where=norm > 0)
+
+    def __call__(self, ids):
+        ids = np.asarray(ids)
+        if ids.size and np.all(np.diff(ids) == 1):
+            block = np.asarray(self.traces[ids[0]:ids[-1] + 1], dtype=np.float32)  # plain slice read
+        else:
+            block = np.asarray(self.traces[ids], dtype=np.float32)
+        return (block - self.mean[ids, None]) * self.inv_norm[ids, None]
+
+
+def normalize_traces(traces):
+    """
+    Zero-mean, unit-norm float32 copy of the rows of an (N, T) matrix.
+    """
+    return TraceNormalizer(traces)(np.arange(traces.shape[0]))
+
+
+def _top_k(similarity, k):
+    # Column indices and values of the k largest finite entries of every row
+    k = min(k, similarity.shape[1])
+    nearest = np.argpartition(similarity, -k, axis=1)[:, -k:]
+    values = np.take_along_axis(similarity, nearest, axis=1)
+    return nearest, values
+
+
+def _block_edges(row_ids, col_ids, similarity, k):
+    # (rows, cols, values) of the top-k candidates of each row; -inf entries are not edges
+    nearest, values = _top_k(similarity, k)
+    keep = np.isfinite(values)
+    rows = np.broadcast_to(np.asarray(row_ids)[:, None], nearest.shape)
+    return rows[keep], np.asarray(col_ids)[nearest[keep]], values[keep]
+
+
+def _merge_edges(edge_lists, n_pixels, k):
+    """
+    Keep the k best distinct neighbours per row over several candidate edge
+    lists (e.g. from overlapping windows or several hash tables).
+    """
+    rows = np.concatenate([e[0] for e in edge_lists]).astype(np.int64)
+    cols = np.concatenate([e[1] for e in edge_lists]).astype(np.int64)
+    values = np.concatenate([e[2] for e in edge_lists]).astype(np.float32)
+    _, unique = np.unique(rows * n_pixels + cols, return_index=True)
+    rows, cols, values = rows[unique], cols[unique], values[unique]
+
+    order = np.lexsort((-values, rows))
+    rows, cols, values = rows[order], cols[order], values[order]
+    first = np.searchsorted(rows, rows, side='left')
+    keep = np.arange(len(rows)) - first < k
+    return rows[keep], cols[keep], values[keep]
+
+
+def edges_to_graph(rows, cols, weights, n_pixels):
+    """
+    Symmetric, row-normalized CSR affinity matrix from kNN edge lists. An edge
+    found from either end is kept and weighted by the positive part of the
+    correlation; rows without edges stay empty.
+    """
+    graph = scipy.sparse.csr_matrix((np.maximum(weights, 0), (rows, cols)),
+                                    shape=(n_pixels, n_pixels), dtype=np.float32)
+    graph = graph.maximum(graph.T).tocsr()
+    graph.eliminate_zeros()
+    degree = np.asarray(graph.sum(axis=1)).ravel()
+    scale = np.divide(1.0, degree, out=np.zeros_like(degree), where=degree > 0)
+    return (scipy.sparse.diags(scale.astype(np.float32)) @ graph).tocsr()
+
+
+class KNNGraphBuilder:
+    """
+    k-nearest-neighbour graph of pixel traces under temporal correlation,
+    stored as a scipy.sparse CSR matrix (see edges_to_graph).
+
+    Methods, all computed as blocked matrix products of normalized traces:
+      - "spatial": candidates are the pixels within `radius` of each pixel in
+        the image. The image is cut into tiles of `tile_size` pixels; every
+        tile is compared with its tile grown by the radius. Cost O(N r^2 T).
+        Needs the (row, col) coordinates of the pixels.
+      - "random_projection": candidates come from `n_tables` random
+        hyperplane hashes (sign of projections of the traces). Pixels are
+        sorted by their hash code, so correlated pixels land close together,
+        and compared within half-overlapping windows of `window` pixels.
+        Cost O(N window n_tables T); finds correlated pixels anywhere in the
+        field of view.
+      - "exact": every pair, in blocks of `block_size` rows. Cost O(N^2 T);
+        for small problems and for checking the approximations.
+    Blocks run on `max_workers` threads (the products release the GIL).
+    Only the blocks in flight hold normalized traces, so peak memory is
+    bounded by block size times workers, not by the number of pixels.
+    """
+    def __init__(self, n_neighbors=8, method="spatial", radius=4, tile_size=8, n_tables=4,
+                 window=512, block_size=1024, max_workers=None, seed=0):
+        if method not in GRAPH_METHODS:
+            raise ValueError(f"method must be one of {GRAPH_METHODS}, got '{method}'")
+        if n_neighbors < 1:
+            raise ValueError("n_neighbors must be >= 1")
+        self.n_neighbors = n_neighbors
+        self.method = method
+        self.radius = radius
+        self.tile_size = tile_size
+        self.n_tables = n_tables
+        self.window = window
+        self.block_size = block_size
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.seed = seed
+
+    def params(self):
+        params = {'n_neighbors': self.n_neighbors, 'method': self.method}
+        if self.method == "spatial":
+            params['radius'] = self.radius
+        elif self.method == "random_projection":
+            params.update(n_tables=self.n_tables, window=self.window, seed=self.seed)
+        return params
+
+    def build(self, traces, coords=None):
+        """
+        Graph of the rows of an (N, T) matrix. coords is the (N, 2) array of
+        (row, col) image coordinates of the pixels, required by "spatial".
+        """
+        n_pixels = traces.shape[0]
+        if n_pixels < 2:
+            return scipy.sparse.csr_matrix((n_pixels, n_pixels), dtype=np.float32)
+        normalizer = TraceNormalizer(traces)
+        if self.method == "spatial":
+            if coords is None:
+                raise ValueError("The spatial graph needs the image coordinates of the pixels")
+            jobs = self._spatial_jobs(np.asarray(coords))
+        elif self.method == "random_projection":
+            jobs = self._projection_jobs(normalizer, n_pixels)
+        else:
+            jobs = self._exact_jobs(n_pixels)
+
+        k = self.n_neighbors
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="PixelGraph") as pool:
+            edge_lists = list(pool.map(lambda job: job(normalizer, k), jobs))
+        edge_lists = [edges for edges in edge_lists if len(edges[0])]
+        if not edge_lists:
+            return scipy.sparse.csr_matrix((n_pixels, n_pixels), dtype=np.float32)
+        return edges_to_graph(*_merge_edges(edge_lists, n_pixels, k), n_pixels)
+
+    # -- candidate blocks ------------------------------------------------------
+    def _spatial_jobs(self, coords):
+        coords = coords - coords.min(axis=0)
+        height, width = coords.max(axis=0) + 1
+        index_image = np.full((height, width), -1, dtype=np.int64)
+        index_image[coords[:, 0], coords[:, 1]] = np.arange(len(coords))
+        r, t = self.radius, self.tile_size
+
+        def job(y0, x0):
+            def run(normalizer, k):
+                tile = index_image[y0:y0 + t, x0:x0 + t]
+                row_ids = tile[tile >= 0]
+                if row_ids.size == 0:
+                    return _empty_edges()
+                grown = index_image[max(0, y0 - r):y0 + t + r, max(0, x0 - r):x0 + t + r]
+                col_ids = grown[grown >= 0]
+                similarity = normalizer(row_ids) @ normalizer(col_ids).T
+                # Only pixels within the radius (and not the pixel itself) are candidates
+                d = coords[row_ids][:, None, :] - coords[col_ids][None, :, :]
+                far = (d ** 2).sum(axis=2) > r * r
+                similarity[far | (row_ids[:, None] == col_ids[None, :])] = -np.inf
+                return _block_edges(row_ids, col_ids, similarity, k)
+            return run
+
+        return [job(y0, x0) for y0 in range(0, height, t) for x0 in range(0, width, t)]
+
+    def _projection_jobs(self, normalizer, n_pixels):
+        rng = np.random.default_rng(self.seed)
+        n_frames = normalizer.traces.shape[1]
+        n_bits = int(np.clip(np.ceil(np.log2(max(n_pixels / self.window, 1))) + 4, 4, 62))
+        weights = (1 << np.arange(n_bits, dtype=np.int64))
+        planes = [rng.standard_normal((n_frames, n_bits)).astype(np.float32) for _ in range(self.n_tables)]
+
+        # Hash codes of all pixels, a block of rows at a time
+        codes = np.empty((self.n_tables, n_pixels), dtype=np.int64)
+        for start in range(0, n_pixels, self.block_size):
+            ids = np.arange(start, min(start + self.block_size, n_pixels))
+            z = normalizer(ids)
+            for table, plane in enumerate(planes):
+                codes[table, ids] = ((z @ plane) > 0) @ weights
+
+        window = min(self.window, n_pixels)
+        step = max(1, window // 2)
+        starts = list(range(0, max(n_pixels - window, 0) + 1, step))
+        if starts[-1] + window < n_pixels:
+            starts.append(n_pixels - window)
+
+        def job(order, start):
+            def run(normalizer, k):
+                ids = np.sort(order[start:start + window])  # sorted ids read faster
+                z = normalizer(ids)
+                similarity = z @ z.T
+                np.fill_diagonal(similarity, -np.inf)
+                return _block_edges(ids, ids, similarity, k)
+            return run
+
+        orders = [np.argsort(codes[table], kind='stable') for table in range(self.n_tables)]
+        return [job(order, start) for order in orders for start in starts]
+
+    def _exact_jobs(self, n_pixels):
+        b = self.block_size
+
+        def job(start):
+            def run(normalizer, k):
+                row_ids = np.arange(start, min(start + b, n_pixels))
+                z = normalizer(row_ids)
+                best = []
+                for col_start in range(0, n_pixels, b):
+                    col_ids = np.arange(col_start, min(col_start + b, n_pixels))
+                    similarity = z @ normalizer(col_ids).T
+                    similarity[row_ids[:, None] == col_ids[None, :]] = -np.inf
+                    best.append(_block_edges(row_ids, col_ids, similarity, k))
+                return _merge_edges(best, n_pixels, k)
+            return run
+
+        return [job(start) for start in range(0, n_pixels, b)]
+
+
+def _empty_edges():
+    return np.empty(0, np.int64), np.empty(0, np.int64), np.empty(0, np.float32)
+
+
+def knn_graph(traces, n_neighbors=8, method="spatial", coords=None, **options):
+    """
+    Shortcut for KNNGraphBuilder(n_neighbors, method, **options).build(traces, coords).
+    """
+    return KNNGraphBuilder(n_neighbors=n_neighbors, method=method, **options).build(traces, coords)
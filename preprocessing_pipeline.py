@@ -0,0 +1,246 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from lazy_dataset import allocate_array
+
+
+###############################################################################
+# Streaming Preprocessing Pipeline
+###############################################################################
+def _chunk_margins(stages):
+    # (alignment, overlap) of chunks that every stage in `stages` can process
+    alignment = max([getattr(stage, 'chunk_alignment', 1) for stage in stages] + [1])
+    overlap = sum(getattr(stage, 'temporal_overlap', 0) for stage in stages)
+    return alignment, -(-overlap // alignment) * alignment
+
+
+class StageInput:
+    """
+    What a stage receives in the pipeline: the source passed through the
+    stages before it, computed on demand for contiguous time slices.
+    """
+    def __init__(self, source, stages):
+        self.source = source
+        self.stages = list(stages)
+        self._alignment, self._overlap = _chunk_margins(self.stages)
+
+    @property
+    def shape(self):
+        return tuple(self.source.shape)
+
+    @property
+    def dtype(self):
+        return np.dtype(np.float32)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def block_bytes(self, n_frames):
+        """
+        Frame data alive while reading n_frames: the block with its margins
+        and one intermediate per stage.
+        """
+        frame_bytes = int(np.prod(self.shape[1:], dtype=np.int64)) * 4
+        return (n_frames + 2 * self._overlap + self._alignment) * frame_bytes * (1 + len(self.stages))
+
+    def __getitem__(self, key):
+        if not isinstance(key, slice) or key.step not in (None, 1):
+            raise IndexError("StageInput only supports contiguous time slices")
+        start, stop, _ = key.indices(self.shape[0])
+        lo = max(0, start - self._overlap) // self._alignment * self._alignment
+        hi = min(self.shape[0], stop + self._overlap)
+        block = np.asarray(self.source[lo:hi], dtype=np.float32)
+        for stage in self.stages:
+            block = stage.process_chunk(block, lo)
+        return block[start - lo:stop - lo]
+
+
+class PreprocessingPipeline:
+    """
+    Runs crop -> chunk stages -> mask over a (T, H, W) movie in a single pass.
+
+    The crop is pushed down to the source, which is read once in time chunks
+    of frames_per_chunk frames. Each chunk goes through every stage's
+    process_chunk(frames, start) in memory, is optionally reduced by the mask
+    to (n_pixels, t), and is written once. Before the pass each stage gets
+    prepare(input), input being a StageInput of the stages before it; after
+    it, close() if the stage has one.
+
+    Chunks are read with the stages' summed temporal_overlap on both sides
+    and start on a multiple of their largest chunk_alignment.
+    peak_chunk_bytes() bounds the memory of a pass, independent of movie
+    length: (2 + len(stages)) chunks, or a stage's prepare_bytes(input).
+    """
+    def __init__(self, source, crop=None, stages=(), mask=None, frames_per_chunk=512):
+        self.source = source if crop is None else crop.apply(source)
+        self.crop = crop
+        self.stages = list(stages)
+        self.mask = mask
+        self.frames_per_chunk = frames_per_chunk
+        self.last_run_stats = None
+
+        if mask is not None and mask.image_shape != tuple(self.source.shape[1:3]):
+            raise ValueError(f"Mask is {mask.image_shape} but frames are {tuple(self.source.shape[1:3])}")
+
+    @property
+    def n_frames(self):
+        return self.source.shape[0]
+
+    @property
+    def output_shape(self):
+        if self.mask is not None:
+            return self.mask.output_shape(self.source.shape)
+        return tuple(self.source.shape)
+
+    @property
+    def stage_names(self):
+        names = [stage.name for stage in self.stages]
+        return (["crop"] if self.crop is not None else []) + names + (["mask"] if self.mask is not None else [])
+
+    def _chunk_grid(self):
+        alignment, overlap = _chunk_margins(self.stages)
+        core = max(alignment, self.frames_per_chunk // alignment * alignment)
+        n = self.n_frames
+        return [(max(0, start - overlap), start, min(start + core, n), min(n, start + core + overlap))
+                for start in range(0, n, core)]
+
+    def _stage_input(self, index):
+        # What stage `index` receives: the source, or a StageInput of the stages before it
+        return self.source if index == 0 else StageInput(self.source, self.stages[:index])
+
+    def peak_chunk_bytes(self):
+        """
+        Upper bound of the frame data alive at once (float32), while streaming
+        or while a stage prepares (prepare_bytes).
+        """
+        longest = max((hi - lo for lo, _, _, hi in self._chunk_grid()), default=0)
+        frame_bytes = int(np.prod(self.source.shape[1:], dtype=np.int64)) * 4
+        peak = longest * frame_bytes * (2 + len(self.stages))
+        for index, stage in enumerate(self.stages):
+            prepare_bytes = getattr(stage, 'prepare_bytes', None)
+            if prepare_bytes is not None:
+                peak = max(peak, prepare_bytes(self._stage_input(index)))
+        return peak
+
+    def chunks(self, is_cancelled=None, checkpoints=None):
+        """
+        Generator of (start, stop, block) with every stage applied to frames
+        [start, stop). block is (stop - start, H, W), or (n_pixels, stop - start)
+        with a mask. The next chunk is read on a helper thread while the
+        current one is processed. Stops early once is_cancelled() is true.
+
+        checkpoints maps a stage index to a (T, H, W) array that receives that
+        stage's output on the way through, e.g. to cache an intermediate result
+        without a second pass.
+        """
+        checkpoints = checkpoints or {}
+        timings = {name: 0.0 for name in ['prepare', 'read'] + [stage.name for stage in self.stages]
+                   + (['mask'] if self.mask is not None else [])}
+        if checkpoints:
+            timings['checkpoint'] = 0.0
+        self._timings = timings
+
+        try:
+            # Each stage prepares on its own input, e.g. motion-corrected frames
+            started = time.perf_counter()
+            for index, stage in enumerate(self.stages):
+                stage.prepare(self._stage_input(index))
+            timings['prepare'] = time.perf_counter() - started
+            yield from self._stream(self._chunk_grid(), timings, is_cancelled, checkpoints)
+        finally:
+            for stage in self.stages:
+                close = getattr(stage, 'close', None)
+                if close is not None:
+                    close()
+
+    def _stream(self, grid, timings, is_cancelled, checkpoints):
+        def read(lo, hi):
+            started = time.perf_counter()
+            block = np.asarray(self.source[lo:hi], dtype=np.float32)
+            timings['read'] += time.perf_counter() - started
+            return block
+
+        with ThreadPoolExecutor(max_workers=1, thread_name_prefix="PipelineReader") as reader:
+            pending = reader.submit(read, grid[0][0], grid[0][3]) if grid else None
+            for i, (lo, start, stop, hi) in enumerate(grid):
+                block = pending.result()
+                if i + 1 < len(grid):
+                    pending = reader.submit(read, grid[i + 1][0], grid[i + 1][3])
+
+                for index, stage in enumerate(self.stages):
+                    started = time.perf_counter()
+                    block = stage.process_chunk(block, lo)
+                    timings[stage.name] += time.perf_counter() - started
+                    if index in checkpoints:
+                        started = time.perf_counter()
+                        checkpoints[index][start:stop] = block[start - lo:stop - lo]
+                        timings['checkpoint'] += time.perf_counter() - started
+                block = block[start - lo:stop - lo]
+
+                if self.mask is not None:
+                    started = time.perf_counter()
+                    block = self.mask.apply_chunk(block)
+                    timings['mask'] += time.perf_counter() - started
+
+                yield start, stop, block
+                if is_cancelled is not None and is_cancelled():
+                    return
+
+    def run(self, out=None, progress=None, is_cancelled=None, memory_limit_bytes=2 * 1024 ** 3,
+            checkpoints=None):
+        """
+        Stream the whole movie through the pipeline into `out` (float32; a
+        scratch memmap via allocate_array if not given and larger than
+        memory_limit_bytes). Returns `out`, or None if cancelled.
+        See chunks() for checkpoints.
+        """
+        if out is None:
+            out = allocate_array(self.output_shape, np.float32, memory_limit_bytes)
+
+        started = time.perf_counter()
+        write_seconds = 0.0
+        chunks = self.chunks(is_cancelled, checkpoints)
+        try:
+            for start, stop, block in chunks:
+                write_started = time.perf_counter()
+                if self.mask is not None:
+                    out[:, start:stop] = block
+                else:
+                    out[start:stop] = block
+                write_seconds += time.perf_counter() - write_started
+                if progress is not None:
+                    progress(stop, self.n_frames)
+        finally:
+            chunks.close()  # closes the stages even if writing failed
+        if is_cancelled is not None and is_cancelled():
+            return None
+
+        elapsed = time.perf_counter() - started
+        timings = dict(self._timings, write=write_seconds)
+        self.last_run_stats = {
+            'frames': self.n_frames,
+            'seconds': elapsed,
+            'frames_per_second': self.n_frames / elapsed if elapsed > 0 else float('inf'),
+            'stages': {name: {'seconds': seconds,
+                              'frames_per_second': self.n_frames / seconds if seconds > 0 else float('inf')}
+                       for name, seconds in timings.items()},
+            'peak_chunk_bytes': self.peak_chunk_bytes(),
+            'chunks': len(self._chunk_grid()),
+        }
+        return out
+
+    def timing_report(self):
+        """
+        Multi-line summary of last_run_stats, one line per stage.
+        """
+        stats = self.last_run_stats
+        if stats is None:
+            return "No run yet."
+        lines = [f"{' -> '.join(self.stage_names) or 'copy'}: {stats['frames']} frames in "
+                 f"{stats['seconds']:.2f}s ({stats['frames_per_second']:.0f} frames/s), "
+                 f"peak chunk memory {stats['peak_chunk_bytes'] / 1024 ** 2:.0f} MB"]
+        for name, stage in stats['stages'].items():
+            lines.append(f"  {name:<20s}{stage['seconds']:8.2f}s {stage['frames_per_second']:10.0f} frames/s")
+        return "\n".join(lines)
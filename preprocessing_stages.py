@@ -0,0 +1,270 @@
+import numpy as np
+
+from lazy_dataset import DatasetView, LazyArray, split_frame_key
+
+
+###############################################################################
+# Preprocessing Stages
+#
+# Qt-free building blocks behind the PreprocessingTab buttons. Datasets are
+# (T, H, W) and may be numpy arrays, memmaps or lazy handles.
+###############################################################################
+class CropStage:
+    """
+    Temporal and spatial region of interest.
+
+    Each range is a (start, stop) pair in source coordinates, or None to keep
+    the full axis. apply() never copies: numpy arrays and memmaps yield a
+    numpy view, lazy handles a DatasetView, so only the cropped hyperslab is
+    ever read from disk.
+    """
+    name = "crop"
+
+    def __init__(self, t_range=None, y_range=None, x_range=None):
+        self.t_range = t_range
+        self.y_range = y_range
+        self.x_range = x_range
+
+    def params(self):
+        return {'t_range': self.t_range, 'y_range': self.y_range, 'x_range': self.x_range}
+
+    def key(self):
+        return tuple(slice(*r) if r is not None else slice(None)
+                     for r in (self.t_range, self.y_range, self.x_range))
+
+    def output_shape(self, shape):
+        return tuple(len(range(*s.indices(n))) for s, n in zip(self.key(), shape[:3])) + tuple(shape[3:])
+
+    def validate(self, shape):
+        """
+        Raise ValueError if the ROI is empty or falls outside a dataset of `shape`.
+        """
+        if len(shape) < 3:
+            raise ValueError(f"Cropping needs a (T, H, W) dataset, got shape {shape}")
+        for label, r, n in zip("TYX", (self.t_range, self.y_range, self.x_range), shape):
+            if r is None:
+                continue
+            start, stop = r
+            if not 0 <= start < stop <= n:
+                raise ValueError(f"{label} range {start}:{stop} is outside 0:{n} or empty")
+
+    def apply(self, source):
+        self.validate(source.shape)
+        if isinstance(source, np.ndarray):
+            return source[self.key()]
+        if isinstance(source, DatasetView):
+            return source.view(self.key())
+        return DatasetView(source).view(self.key())
+
+
+class BinningStage:
+    """
+    N-frame temporal and k x k spatial binning for quick, reduced-resolution
+    previews and trial runs.
+
+    Frames and pixels that do not fill a whole bin at the end of an axis are
+    dropped. Each block is binned with a single reshape to
+    (t, t_bin, h, s_bin, w, s_bin) and one reduction over the bin axes.
+    apply() returns a lazy BinnedDataset that reads and bins the source
+    chunk by chunk, so it can feed the pipeline or be previewed directly.
+    """
+    name = "binning"
+    REDUCERS = ("mean", "sum", "max")
+
+    def __init__(self, t_bin=1, s_bin=1, reducer="mean"):
+        if t_bin < 1 or s_bin < 1:
+            raise ValueError(f"Bin sizes must be >= 1, got t_bin={t_bin}, s_bin={s_bin}")
+        if reducer not in self.REDUCERS:
+            raise ValueError(f"reducer must be one of {self.REDUCERS}, got '{reducer}'")
+        self.t_bin = t_bin
+        self.s_bin = s_bin
+        self.reducer = reducer
+
+    def params(self):
+        return {'t_bin': self.t_bin, 's_bin': self.s_bin, 'reducer': self.reducer}
+
+    def output_shape(self, shape):
+        return (shape[0] // self.t_bin, shape[1] // self.s_bin, shape[2] // self.s_bin) + tuple(shape[3:])
+
+    def output_dtype(self, dtype):
+        return np.dtype(dtype) if self.reducer == "max" else np.dtype(np.float32)
+
+    def validate(self, shape):
+        if len(shape) < 3:
+            raise ValueError(f"Binning needs a (T, H, W) dataset, got shape {shape}")
+        if 0 in self.output_shape(shape)[:3]:
+            raise ValueError(f"Bins of {self.t_bin} frames / {self.s_bin}x{self.s_bin} pixels "
+                             f"do not fit in a dataset of shape {shape}")
+
+    def reduce(self, frames):
+        """
+        Bin a (t * t_bin, H, W[, ...]) block into (t, H // s_bin, W // s_bin[, ...]).
+        """
+        frames = np.asarray(frames)
+        t, h, w = frames.shape[0] // self.t_bin, frames.shape[1] // self.s_bin, frames.shape[2] // self.s_bin
+        tail = frames.shape[3:]
+        block = frames[:t * self.t_bin, :h * self.s_bin, :w * self.s_bin]
+        block = block.reshape((t, self.t_bin, h, self.s_bin, w, self.s_bin) + tail)
+        if self.reducer == "max":
+            return block.max(axis=(1, 3, 5))
+        binned = block.sum(axis=(1, 3, 5), dtype=np.float32)
+        if self.reducer == "mean":
+            binned /= np.float32(self.t_bin * self.s_bin * self.s_bin)
+        return binned
+
+    def apply(self, source):
+        self.validate(source.shape)
+        return BinnedDataset(source, self)
+
+
+class BinnedDataset(LazyArray):
+    """
+    Lazy binned view of a (T, H, W) dataset (see BinningStage). Slicing along
+    time reads only the source frames of the requested bins, in blocks of at
+    most FRAMES_PER_READ source frames.
+    """
+    FRAMES_PER_READ = 1024
+
+    def __init__(self, source, stage):
+        self.source = source
+        self.stage = stage
+
+    @property
+    def shape(self):
+        return self.stage.output_shape(self.source.shape)
+
+    @property
+    def dtype(self):
+        return self.stage.output_dtype(self.source.dtype)
+
+    @property
+    def mode(self):
+        return getattr(self.source, 'mode', "memory")
+
+    def __repr__(self):
+        return f"<BinnedDataset shape={self.shape} {self.stage.params()} of {self.source!r}>"
+
+    def _read_bins(self, start, stop):
+        t_bin = self.stage.t_bin
+        out = np.empty((stop - start,) + self.shape[1:], dtype=self.dtype)
+        bins_per_read = max(1, self.FRAMES_PER_READ // t_bin)
+        for first in range(start, stop, bins_per_read):
+            last = min(first + bins_per_read, stop)
+            frames = np.asarray(self.source[first * t_bin:last * t_bin])
+            out[first - start:last - start] = self.stage.reduce(frames)
+        return out
+
+    def __getitem__(self, key):
+        t_key, rest = split_frame_key(key)
+        n = self.shape[0]
+        if isinstance(t_key, (int, np.integer)):
+            index = int(t_key) + n if t_key < 0 else int(t_key)
+            if not 0 <= index < n:
+                raise IndexError(f"index {t_key} is out of bounds for axis 0 with size {n}")
+            return self._read_bins(index, index + 1)[rest][0]
+        if isinstance(t_key, slice):
+            start, stop, step = t_key.indices(n)
+            indices = range(start, stop, step)
+            if len(indices) == 0:
+                return np.empty((0,) + self.shape[1:], dtype=self.dtype)[rest]
+            lo, hi = min(indices[0], indices[-1]), max(indices[0], indices[-1]) + 1
+            block = self._read_bins(lo, hi)
+            return block[indices[0] - lo::step][:len(indices)][rest] if step > 0 else \
+                block[indices[0] - lo::step][rest]
+        indices = np.arange(n)[t_key]
+        return self[int(indices.min()):int(indices.max()) + 1][indices - indices.min()][rest]
+
+    def close(self):
+        pass
+
+
+class MaskStage:
+    """
+    Spatial pixel mask over (H, W) frames.
+
+    The mask is kept in two compact forms: a bit-packed copy (1 bit per pixel,
+    used for storage and identity) and the sorted flat indices of the selected
+    pixels (used for gathering and scattering). apply_chunk() turns a
+    (T, H, W) block into the (n_pixels, T) matrix that downstream stages work
+    on, so background pixels are dropped once and never touched again.
+    unmask() scatters per-pixel values back to image coordinates for display.
+    """
+    name = "mask"
+
+    def __init__(self, mask):
+        mask = np.asarray(mask, dtype=bool)
+        if mask.ndim != 2:
+            raise ValueError(f"Mask must be 2D (H, W), got shape {mask.shape}")
+        self.image_shape = mask.shape
+        self.packed = np.packbits(mask, axis=None)
+        index_dtype = np.int32 if mask.size < 2 ** 31 else np.int64
+        self.indices = np.flatnonzero(mask).astype(index_dtype)
+
+    @classmethod
+    def from_threshold(cls, image, percentile):
+        """
+        Keep the pixels of `image` (e.g. the mean image) above the given percentile.
+        """
+        image = np.asarray(image, dtype=np.float64)
+        return cls(image > np.nanpercentile(image, percentile))
+
+    @classmethod
+    def from_file(cls, path):
+        """
+        Load a mask from .npy or an image file (.png, .tif, ...); non-zero means selected.
+        """
+        if path.lower().endswith(".npy"):
+            mask = np.load(path)
+        else:
+            from image_sequence import read_image
+            mask = read_image(path)
+            if mask.ndim == 3:
+                mask = mask[..., 0]
+        return cls(mask != 0)
+
+    @property
+    def mask(self):
+        return np.unpackbits(self.packed, count=int(np.prod(self.image_shape))).astype(bool).reshape(self.image_shape)
+
+    @property
+    def n_pixels(self):
+        return len(self.indices)
+
+    @property
+    def coordinates(self):
+        """
+        (n_pixels, 2) array of the (row, col) image position of every selected pixel.
+        """
+        return np.column_stack(np.unravel_index(self.indices, self.image_shape))
+
+    @property
+    def coverage(self):
+        return self.n_pixels / float(np.prod(self.image_shape))
+
+    def params(self):
+        return {'image_shape': self.image_shape, 'n_pixels': self.n_pixels,
+                'packed': self.packed.tobytes().hex()}
+
+    def output_shape(self, shape):
+        return (self.n_pixels, shape[0])
+
+    def apply_chunk(self, block):
+        """
+        (T, H, W) block -> (n_pixels, T) matrix of the masked pixels.
+        """
+        block = np.asarray(block)
+        if block.shape[1:3] != self.image_shape:
+            raise ValueError(f"Mask is {self.image_shape} but frames are {block.shape[1:3]}")
+        flat = block.reshape(block.shape[0], -1)
+        return np.ascontiguousarray(np.take(flat, self.indices, axis=1).T)
+
+    def unmask(self, values, fill_value=np.nan):
+        """
+        Scatter (n_pixels,) or (n_pixels, K) values back into an (H, W[, K]) image.
+        """
+        values = np.asarray(values)
+        tail = values.shape[1:]
+        dtype = np.result_type(values.dtype, np.min_scalar_type(fill_value))
+        image = np.full((int(np.prod(self.image_shape)),) + tail, fill_value, dtype=dtype)
+        image[self.indices] = values
+        return image.reshape(self.image_shape + tail)
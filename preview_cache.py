@@ -0,0 +1,116 @@
+import json
+import os
+import tempfile
+from collections import OrderedDict
+
+
+###############################################################################
+# Persistent Preview Cache
+###############################################################################
+APP_DATA_DIR = os.path.join(os.path.expanduser("~"), ".graft_app")
+DEFAULT_CACHE_PATH = os.path.join(APP_DATA_DIR, "preview_cache.json")
+
+
+def write_json_atomic(path, payload):
+    """
+    Write `payload` as JSON to `path` through a temporary file and os.replace,
+    so a crash never leaves a truncated file behind.
+    """
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(payload, f)
+        os.replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+class PreviewCache:
+    """
+    On-disk cache of DataSelectionDialog preview trees.
+
+    Entries are keyed by absolute file path and carry the file's size and
+    mtime; an entry whose file has changed is dropped on lookup. The cache is
+    bounded both in entry count and in total serialized size, and evicts the
+    least recently used entries first. Writes are atomic (write_json_atomic).
+
+    The cached value is whatever list of rows the caller stores, as long as it
+    is JSON-serializable (see DataSelectionDialog._serialize_tree).
+    """
+    VERSION = 1
+
+    def __init__(self, cache_path=DEFAULT_CACHE_PATH, max_entries=200, max_bytes=32 * 1024 ** 2):
+        self.cache_path = cache_path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = self._read()
+
+    @staticmethod
+    def _file_signature(file_path):
+        st = os.stat(file_path)
+        return st.st_size, st.st_mtime_ns
+
+    def _read(self):
+        try:
+            with open(self.cache_path, 'r', encoding='utf-8') as f:
+                payload = json.load(f)
+            if payload.get('version') != self.VERSION:
+                return OrderedDict()
+            return OrderedDict(payload.get('entries', []))
+        except (OSError, ValueError):
+            return OrderedDict()
+
+    def _write(self):
+        write_json_atomic(self.cache_path, {'version': self.VERSION, 'entries': list(self._entries.items())})
+
+    def get(self, file_path):
+        """
+        Return the cached rows for file_path, or None if missing or stale.
+        """
+        key = os.path.abspath(file_path)
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+
+        try:
+            size, mtime_ns = self._file_signature(key)
+        except OSError:
+            size, mtime_ns = None, None
+        if entry['size'] != size or entry['mtime_ns'] != mtime_ns:
+            del self._entries[key]
+            self._save_quietly()
+            return None
+
+        self._entries.move_to_end(key)
+        return entry['rows']
+
+    def put(self, file_path, rows):
+        key = os.path.abspath(file_path)
+        size, mtime_ns = self._file_signature(key)
+        entry = {'size': size, 'mtime_ns': mtime_ns, 'rows': rows,
+                 'nbytes': len(json.dumps(rows))}
+        if entry['nbytes'] > self.max_bytes:
+            return  # a single tree this large is cheaper to rescan than to cache
+
+        # Reload first so entries written by other windows/processes are kept
+        self._entries = self._read()
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        self._evict()
+        self._save_quietly()
+
+    def _evict(self):
+        total = sum(e['nbytes'] for e in self._entries.values())
+        while self._entries and (len(self._entries) > self.max_entries or total > self.max_bytes):
+            _, evicted = self._entries.popitem(last=False)
+            total -= evicted['nbytes']
+
+    def _save_quietly(self):
+        try:
+            self._write()
+        except OSError as e:
+            print(f"[PreviewCache] Could not write cache: {e}")
@@ -0,0 +1,42 @@
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+
+###############################################################################
+# Spawn Process Pools
+###############################################################################
+# Read by numpy's BLAS when a process starts; one BLAS thread per worker
+# keeps n_workers processes from oversubscribing the cores
+BLAS_THREAD_VARIABLES = ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS")
+
+
+def make_spawn_pool(n_workers, initializer=None, initargs=()):
+    """
+    ProcessPoolExecutor of n_workers "spawn" processes (forking a process
+    that runs Qt and reader threads is unsafe), each with one BLAS thread.
+    All workers are started before returning, so the start-up cost is not
+    paid inside the first task.
+    """
+    pool = ProcessPoolExecutor(max_workers=n_workers, mp_context=multiprocessing.get_context("spawn"),
+                               initializer=initializer, initargs=initargs)
+    # The pool starts a process per submit while none is idle, so n_workers
+    # blocking tasks start them all
+    saved = {name: os.environ.get(name) for name in BLAS_THREAD_VARIABLES}
+    os.environ.update(dict.fromkeys(BLAS_THREAD_VARIABLES, "1"))
+    try:
+        futures = [pool.submit(time.sleep, 0.05) for _ in range(n_workers)]
+    finally:
+        for name, value in saved.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+    try:
+        for future in futures:
+            future.result()
+    except Exception:
+        pool.shutdown(wait=False, cancel_futures=True)
+        raise
+    return pool
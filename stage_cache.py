@@ -0,0 +1,210 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+from preview_cache import APP_DATA_DIR, write_json_atomic
+
+
+###############################################################################
+# Content-Addressed Stage Cache
+###############################################################################
+DEFAULT_STAGE_CACHE_DIR = os.path.join(APP_DATA_DIR, "stage_cache")
+
+
+def _digest(payload):
+    text = json.dumps(payload, sort_keys=True, default=str)
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def dataset_identity(data_path, dataset_name, data=None):
+    """
+    Identity of a loaded dataset: the file (or folder) it came from, its size
+    and modification time, and the dataset selected inside it. For an image
+    folder every image file's size and mtime is folded in, since editing a
+    frame does not change the folder's own mtime.
+    Returns None if data_path cannot be stat'ed.
+    """
+    try:
+        st = os.stat(data_path)
+    except (OSError, TypeError):
+        return None
+
+    identity = {'path': os.path.abspath(data_path), 'dataset': dataset_name,
+                'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+    if os.path.isdir(data_path):
+        files = hashlib.sha256()
+        with os.scandir(data_path) as entries:
+            for entry in sorted(entries, key=lambda e: e.name):
+                if entry.is_file():
+                    entry_st = entry.stat()
+                    files.update(f"{entry.name}\0{entry_st.st_size}\0{entry_st.st_mtime_ns}\n".encode())
+        identity['files'] = files.hexdigest()
+    if data is not None:
+        identity['shape'] = tuple(int(n) for n in data.shape)
+        identity['dtype'] = str(data.dtype)
+    return identity
+
+
+def dataset_key(identity):
+    return _digest({'dataset': identity})
+
+
+def chain_key(parent_key, stage_name, params):
+    """
+    Key of a stage output: the key of its input combined with the stage name
+    and parameters. Changing one stage changes its key and those downstream,
+    but leaves upstream keys (and their cached outputs) untouched.
+    """
+    return _digest({'parent': parent_key, 'stage': stage_name, 'params': params})
+
+
+class PendingEntry:
+    """
+    Output being written into the cache. `data` is a writable .npy memmap in
+    a private directory; commit() publishes it under its key, abort() drops it.
+    """
+    def __init__(self, cache, key, path, data):
+        self.cache = cache
+        self.key = key
+        self.path = path
+        self.data = data
+
+    def commit(self, extras=None, meta=None):
+        """
+        Publish the entry with optional small side arrays (e.g. motion shifts)
+        and JSON metadata. Returns the read-only cached array.
+        """
+        self.data.flush()
+        self.data = None
+        for name, value in (extras or {}).items():
+            np.save(os.path.join(self.path, f"{name}.npy"), np.asarray(value))
+        return self.cache._publish(self, meta or {})
+
+    def abort(self):
+        self.data = None
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+class StageCache:
+    """
+    On-disk cache of preprocessing stage outputs, keyed by chain_key().
+
+    Each entry is a directory holding data.npy (opened as a read-only memmap
+    on lookup) plus any side arrays. index.json records each entry's size and
+    last use; once the total exceeds max_bytes, the least recently used
+    entries are evicted. Outputs are written straight into the cache
+    (create/commit), so caching costs no extra copy, and only committed
+    entries are ever visible.
+    """
+    VERSION = 1
+
+    def __init__(self, cache_dir=DEFAULT_STAGE_CACHE_DIR, max_bytes=50 * 1024 ** 3):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.index_path = os.path.join(cache_dir, "index.json")
+
+    # -- index -----------------------------------------------------------------
+    def _read_index(self):
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                payload = json.load(f)
+            if payload.get('version') != self.VERSION:
+                return {}
+            return payload.get('entries', {})
+        except (OSError, ValueError):
+            return {}
+
+    def _write_index(self, entries):
+        write_json_atomic(self.index_path, {'version': self.VERSION, 'entries': entries})
+
+    def _entry_dir(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    @property
+    def total_bytes(self):
+        return sum(entry['nbytes'] for entry in self._read_index().values())
+
+    # -- lookup ----------------------------------------------------------------
+    def __contains__(self, key):
+        return key in self._read_index() and os.path.exists(os.path.join(self._entry_dir(key), "data.npy"))
+
+    def get(self, key):
+        """
+        Return (data, extras, meta) for a cached key, or None. data is a
+        read-only memmap; extras is a dict of the side arrays.
+        """
+        entries = self._read_index()
+        if key not in entries:
+            return None
+        entry_dir = self._entry_dir(key)
+        try:
+            data = np.load(os.path.join(entry_dir, "data.npy"), mmap_mode='r')
+            extras = {}
+            for file_name in os.listdir(entry_dir):
+                name, ext = os.path.splitext(file_name)
+                if ext == ".npy" and name != "data":
+                    extras[name] = np.load(os.path.join(entry_dir, file_name))
+        except (OSError, ValueError):
+            # Deleted or damaged behind our back: forget it
+            entries.pop(key, None)
+            self._save_index_quietly(entries)
+            return None
+
+        entries[key]['last_used'] = time.time()
+        self._save_index_quietly(entries)
+        return data, extras, entries[key].get('meta', {})
+
+    # -- insertion -------------------------------------------------------------
+    def create(self, key, shape, dtype=np.float32):
+        """
+        Start writing an output of the given shape. Returns a PendingEntry, or
+        None if the output alone would exceed max_bytes (it is not cached then).
+        """
+        nbytes = int(np.prod(shape, dtype=np.int64)) * np.dtype(dtype).itemsize
+        if nbytes > self.max_bytes:
+            return None
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = tempfile.mkdtemp(prefix=f"{key[:16]}-", suffix=".partial", dir=self.cache_dir)
+        data = np.lib.format.open_memmap(os.path.join(path, "data.npy"), mode='w+',
+                                         dtype=dtype, shape=tuple(shape))
+        return PendingEntry(self, key, path, data)
+
+    def _publish(self, pending, meta):
+        entry_dir = self._entry_dir(pending.key)
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        os.replace(pending.path, entry_dir)
+
+        nbytes = sum(os.path.getsize(os.path.join(entry_dir, f)) for f in os.listdir(entry_dir))
+        entries = self._read_index()
+        entries[pending.key] = {'nbytes': nbytes, 'last_used': time.time(), 'meta': meta}
+        self._evict(entries, keep=pending.key)
+        self._save_index_quietly(entries)
+        return np.load(os.path.join(entry_dir, "data.npy"), mmap_mode='r')
+
+    def _evict(self, entries, keep=None):
+        total = sum(entry['nbytes'] for entry in entries.values())
+        for key in sorted(entries, key=lambda k: entries[k]['last_used']):
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            # Open memmaps of an evicted entry stay valid on POSIX
+            shutil.rmtree(self._entry_dir(key), ignore_errors=True)
+            total -= entries.pop(key)['nbytes']
+
+    def clear(self):
+        entries = self._read_index()
+        for key in list(entries):
+            shutil.rmtree(self._entry_dir(key), ignore_errors=True)
+        self._save_index_quietly({})
+
+    def _save_index_quietly(self, entries):
+        try:
+            self._write_index(entries)
+        except OSError as e:
+            print(f"[StageCache] Could not write index: {e}")
@@ -0,0 +1,63 @@
+import threading
+
+from PyQt6.QtCore import QObject, QThread, pyqtSignal
+
+
+###############################################################################
+# Background Stage Runner
+###############################################################################
+class StageWorker(QObject):
+    """
+    Runs one long computation (a preprocessing stage, the solver, ...) off the
+    GUI thread.
+
+    `task` is called as task(progress, is_cancelled) where progress(done, total)
+    may be called from any thread and is_cancelled() should be polled between
+    chunks. Its return value is delivered through `result`.
+    """
+    progress = pyqtSignal(int, int)     # done, total
+    result = pyqtSignal(object)
+    error = pyqtSignal(str)
+    finished = pyqtSignal()
+
+    def __init__(self, task, parent=None):
+        super().__init__(parent)
+        self.task = task
+        self._cancel_event = threading.Event()
+
+    def cancel(self):
+        self._cancel_event.set()
+
+    def is_cancelled(self):
+        return self._cancel_event.is_set()
+
+    def run(self):
+        try:
+            value = self.task(self.progress.emit, self.is_cancelled)
+            if not self.is_cancelled():
+                self.result.emit(value)
+        except Exception as e:
+            self.error.emit(str(e))
+        finally:
+            self.finished.emit()
+
+
+def start_stage_worker(owner, task, on_result, on_progress=None, on_error=None):
+    """
+    Create a StageWorker for `task` on a new QThread owned by `owner` and start it.
+    Returns (thread, worker); keep references to both while it runs.
+    """
+    thread = QThread(owner)
+    worker = StageWorker(task)
+    worker.moveToThread(thread)
+
+    thread.started.connect(worker.run)
+    worker.result.connect(on_result)
+    if on_progress is not None:
+        worker.progress.connect(on_progress)
+    if on_error is not None:
+        worker.error.connect(on_error)
+    worker.finished.connect(thread.quit)
+    thread.finished.connect(worker.deleteLater)
+    thread.start()
+    return thread, worker
@@ -0,0 +1,173 @@
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+
+###############################################################################
+# Single-Pass Summary Images
+###############################################################################
+SUMMARY_IMAGES = ("mean", "max", "std", "correlation")
+
+# Neighbour offsets (dy, dx) whose co-moments are accumulated. With their
+# mirror images they cover the full 8-neighbourhood of every pixel.
+NEIGHBOUR_OFFSETS = ((0, 1), (1, 0), (1, 1), (1, -1))
+
+
+def _pair_slices(offset):
+    # (pixel, neighbour) slices of an (H, W) image for one neighbour offset
+    dy, dx = offset
+    rows, rows_shifted = slice(0, -dy if dy else None), slice(dy, None)
+    if dx >= 0:
+        cols, cols_shifted = slice(0, -dx if dx else None), slice(dx, None)
+    else:
+        cols, cols_shifted = slice(-dx, None), slice(0, dx)
+    return (rows, cols), (rows_shifted, cols_shifted)
+
+
+def chunk_moments(frames):
+    """
+    Accumulator state of a (T, H, W) block: frame count, per-pixel mean, sum
+    of squared deviations (m2), maximum, and the co-moment of every pixel with
+    each of its NEIGHBOUR_OFFSETS neighbours. Deviations are taken from the
+    block's own mean, so the sums do not lose precision on large baselines.
+    """
+    frames = np.asarray(frames, dtype=np.float32)
+    mean = frames.mean(axis=0, dtype=np.float64)
+    centered = frames - mean.astype(np.float32)
+    moments = {'n': frames.shape[0], 'mean': mean,
+               'm2': np.einsum('tij,tij->ij', centered, centered, dtype=np.float64),
+               'max': frames.max(axis=0)}
+    for offset in NEIGHBOUR_OFFSETS:
+        pixel, neighbour = _pair_slices(offset)
+        a = centered[(slice(None),) + pixel]
+        b = centered[(slice(None),) + neighbour]
+        moments[offset] = np.einsum('tij,tij->ij', a, b, dtype=np.float64)
+    return moments
+
+
+def merge_moments(a, b):
+    """
+    Combine the states of two disjoint blocks of frames (Chan et al.'s
+    pairwise update), as if both had been accumulated in one pass.
+    """
+    if a is None:
+        return b
+    n = a['n'] + b['n']
+    delta = b['mean'] - a['mean']
+    weight = a['n'] * b['n'] / n
+    merged = {'n': n, 'mean': a['mean'] + delta * (b['n'] / n),
+              'm2': a['m2'] + b['m2'] + delta * delta * weight,
+              'max': np.maximum(a['max'], b['max'])}
+    for offset in NEIGHBOUR_OFFSETS:
+        pixel, neighbour = _pair_slices(offset)
+        merged[offset] = a[offset] + b[offset] + delta[pixel] * delta[neighbour] * weight
+    return merged
+
+
+def finish_moments(moments):
+    """
+    Summary images from an accumulator state, as a dict of (H, W) float32
+    arrays keyed by SUMMARY_IMAGES. "correlation" is the local correlation
+    image: each pixel's mean temporal correlation with its 8 neighbours
+    (fewer at the borders).
+    """
+    m2 = moments['m2']
+    corr_sum = np.zeros(m2.shape, dtype=np.float64)
+    counts = np.zeros(m2.shape, dtype=np.float64)
+    for offset in NEIGHBOUR_OFFSETS:
+        pixel, neighbour = _pair_slices(offset)
+        denominator = np.sqrt(m2[pixel] * m2[neighbour])
+        corr = np.divide(moments[offset], denominator, out=np.zeros_like(denominator),
+                         where=denominator > 0)
+        corr_sum[pixel] += corr
+        corr_sum[neighbour] += corr
+        counts[pixel] += 1
+        counts[neighbour] += 1
+
+    return {'mean': moments['mean'].astype(np.float32),
+            'max': moments['max'].astype(np.float32),
+            'std': np.sqrt(m2 / moments['n']).astype(np.float32),
+            'correlation': (corr_sum / np.maximum(counts, 1)).astype(np.float32)}
+
+
+class SummaryImageEngine:
+    """
+    Computes every SUMMARY_IMAGES image of a (T, H, W) movie in one pass.
+
+    The movie is read once, in time chunks of `frames_per_chunk` frames. Each
+    chunk is reduced to its accumulator state (chunk_moments) on a pool of
+    `max_workers` threads (the reductions run in numpy with the GIL released)
+    while the next chunk is read. States are merged in frame order, so the
+    result does not depend on the number of workers. At most max_workers + 1
+    chunks are in memory at once.
+    """
+    name = "summary_images"
+
+    def __init__(self, frames_per_chunk=256, max_workers=None):
+        self.frames_per_chunk = frames_per_chunk
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.last_run_stats = None
+
+    def params(self):
+        # Chunking and workers do not change the images
+        return {'images': list(SUMMARY_IMAGES)}
+
+    def compute(self, source, progress=None, is_cancelled=None):
+        """
+        Summary images of `source` as a dict of (H, W) float32 arrays, or None
+        if cancelled.
+        """
+        n_frames = source.shape[0]
+        if n_frames == 0:
+            raise ValueError("Cannot compute summary images of an empty movie")
+        chunks = [(start, min(start + self.frames_per_chunk, n_frames))
+                  for start in range(0, n_frames, self.frames_per_chunk)]
+
+        started = time.perf_counter()
+        read_seconds = 0.0
+        moments = None
+        pending = deque()
+
+        def collect():
+            nonlocal moments
+            future, stop = pending.popleft()
+            moments = merge_moments(moments, future.result())
+            if progress is not None:
+                progress(stop, n_frames)
+
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="SummaryImages") as pool:
+            for start, stop in chunks:
+                if len(pending) > self.max_workers:
+                    collect()
+                if is_cancelled is not None and is_cancelled():
+                    for future, _ in pending:
+                        future.cancel()
+                    return None
+                read_started = time.perf_counter()
+                block = np.asarray(source[start:stop])
+                read_seconds += time.perf_counter() - read_started
+                pending.append((pool.submit(chunk_moments, block), stop))
+                del block
+            while pending:
+                collect()
+
+        images = finish_moments(moments)
+        elapsed = time.perf_counter() - started
+        self.last_run_stats = {'frames': n_frames, 'seconds': elapsed, 'read_seconds': read_seconds,
+                               'frames_per_second': n_frames / elapsed if elapsed > 0 else float('inf'),
+                               'chunks': len(chunks)}
+        return images
+
+    def timing_report(self):
+        """
+        One-line summary of last_run_stats.
+        """
+        stats = self.last_run_stats
+        if stats is None:
+            return "No run yet."
+        return (f"summary_images: {stats['frames']} frames in {stats['chunks']} chunks, "
+                f"{stats['seconds']:.2f}s ({stats['frames_per_second']:.0f} frames/s, "
+                f"{stats['read_seconds']:.2f}s reading)")
@@ -1,25 +1,121 @@
+import os
+import queue
 import sys
 from PyQt6.QtWidgets import (
     QApplication, QDialog, QMainWindow, QWidget, QTabWidget,
-    QVBoxLayout, QHBoxLayout, QFileDialog, QLabel, QPushButton
+    QVBoxLayout, QHBoxLayout, QFileDialog, QLabel, QPushButton,
+    QFormLayout, QSpinBox, QDoubleSpinBox, QComboBox, QDialogButtonBox, QMessageBox, QInputDialog, QCheckBox,
+    QPlainTextEdit
 )
+from PyQt6.QtCore import Qt, QTimer, pyqtSignal
+from PyQt6.QtGui import QImage, QPixmap
+import numpy as np
+
+from graft_engine import GraFTEngine, format_iteration
+from pixel_graph import GRAPH_METHODS
+from hdf5_output import ACCESS_PATTERNS, COMPRESSORS, HDF5Output
+from lazy_dataset import allocate_array
+from motion_correction import PiecewiseRigidMotionCorrector, RigidMotionCorrector
+from preprocessing_pipeline import PreprocessingPipeline
+from preprocessing_stages import BinningStage, CropStage, MaskStage
+from stage_cache import StageCache, chain_key, dataset_key
+from stage_worker import start_stage_worker
+from summary_images import SUMMARY_IMAGES, SummaryImageEngine
+from wavelet_denoising import THRESHOLD_RULES, THRESHOLD_MODES, WaveletDenoiser
 
 ###############################################################################
 # Individual Tabs
 ###############################################################################
+class CropDialog(QDialog):
+    """
+    Lets the user enter a temporal (frames) and spatial (rows/columns) ROI.
+    """
+    def __init__(self, shape, crop_stage=None, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle("Crop Data")
+        self.shape = shape
+
+        layout = QFormLayout()
+        self.spin_boxes = {}
+        current = crop_stage.params() if crop_stage is not None else {}
+        for key, label, n in (('t_range', "Frames", shape[0]),
+                              ('y_range', "Rows (Y)", shape[1]),
+                              ('x_range', "Columns (X)", shape[2])):
+            start, stop = current.get(key) or (0, n)
+            start_box, stop_box = QSpinBox(), QSpinBox()
+            start_box.setRange(0, n - 1)
+            stop_box.setRange(1, n)
+            start_box.setValue(start)
+            stop_box.setValue(stop)
+
+            row = QHBoxLayout()
+            row.addWidget(start_box)
+            row.addWidget(QLabel("to"))
+            row.addWidget(stop_box)
+            layout.addRow(f"{label} (0-{n}):", row)
+            self.spin_boxes[key] = (start_box, stop_box)
+
+        buttons = QDialogButtonBox(QDialogButtonBox.StandardButton.Ok |
+                                   QDialogButtonBox.StandardButton.Cancel)
+        buttons.accepted.connect(self.accept)
+        buttons.rejected.connect(self.reject)
+        layout.addRow(buttons)
+        self.setLayout(layout)
+
+    def crop_stage(self):
+        ranges = {}
+        for (key, (start_box, stop_box)), n in zip(self.spin_boxes.items(), self.shape):
+            r = (start_box.value(), stop_box.value())
+            ranges[key] = None if r == (0, n) else r  # full axis
+        return CropStage(**ranges)
+
+
 class PreprocessingTab(QWidget):
+    # (name, dataset) when a pipeline result has been written to an HDF5 output file
+    output_ready = pyqtSignal(str, object)
+
     def __init__(self, parent=None):
         super().__init__(parent)
+        self.source_data = None    # dataset as loaded (array or lazy handle)
+        self.working_data = None   # source_data with the enabled stages applied
+        self.crop_stage = None
+        self.binning_stage = None  # used while binned_check is ticked
+        self.mask_stage = None
+        self.motion_stage = None   # configured chunk stages, applied in this order
+        self.denoise_stage = None
+        self.processed_data = None     # cropped movie with processed_stages applied, float32
+        self.processed_stages = []
+        self.processed_base = None     # _base_params() processed_data was computed from
+        self.motion_shifts = None      # per-frame (dy, dx), or per patch for piecewise
+        self.dataset_key = None        # identity of source_data for the stage cache
+        self.dataset_identity = None
+        self.summary_images = None     # {name: (H, W) image} of the working data
+        self._summary_state = None     # _working_state() the summary images belong to
+        self.output_settings = None    # HDF5 output of Run Pipeline; None = memory / stage cache
+        self.stage_cache = StageCache(max_bytes=self.STAGE_CACHE_MAX_BYTES)
+        self._stage_thread = None
+        self._stage_worker = None
         self.init_ui()
 
     def init_ui(self):
         layout = QVBoxLayout()
         layout.addWidget(QLabel("Preprocessing Steps:"))
 
+        self.data_label = QLabel("No dataset loaded.")
+        layout.addWidget(self.data_label)
+
         crop_button = QPushButton("Crop")
         crop_button.clicked.connect(self.crop_data)
         layout.addWidget(crop_button)
 
+        binning_button = QPushButton("Binning")
+        binning_button.clicked.connect(self.binning)
+        layout.addWidget(binning_button)
+
+        self.binned_check = QCheckBox("Run the next steps on the binned data (fast preview)")
+        self.binned_check.toggled.connect(self._binning_toggled)
+        layout.addWidget(self.binned_check)
+
         mask_button = QPushButton("Mask Selection")
         mask_button.clicked.connect(self.mask_selection)
         layout.addWidget(mask_button)
@@ -32,20 +128,745 @@ class PreprocessingTab(QWidget):
         wavelet_button.clicked.connect(self.wavelet_denoising)
         layout.addWidget(wavelet_button)
 
+        self.defer_check = QCheckBox("Configure only, then stream all steps with Run Pipeline")
+        layout.addWidget(self.defer_check)
+
+        output_button = QPushButton("Output Settings")
+        output_button.clicked.connect(self.configure_output)
+        layout.addWidget(output_button)
+
+        run_button = QPushButton("Run Pipeline")
+        run_button.clicked.connect(self.run_pipeline)
+        layout.addWidget(run_button)
+
+        self.stage_label = QLabel("")
+        layout.addWidget(self.stage_label)
+
+        summary_button = QPushButton("Summary Images")
+        summary_button.clicked.connect(self.compute_summary_images)
+        layout.addWidget(summary_button)
+
+        summary_row = QHBoxLayout()
+        self.summary_labels = {}
+        for name in SUMMARY_IMAGES:
+            column = QVBoxLayout()
+            image_label = QLabel()
+            image_label.setFixedSize(self.SUMMARY_THUMBNAIL_SIZE, self.SUMMARY_THUMBNAIL_SIZE)
+            image_label.setAlignment(Qt.AlignmentFlag.AlignCenter)
+            column.addWidget(image_label)
+            column.addWidget(QLabel(name.capitalize()), alignment=Qt.AlignmentFlag.AlignHCenter)
+            summary_row.addLayout(column)
+            self.summary_labels[name] = image_label
+        summary_row.addStretch()
+        layout.addLayout(summary_row)
+
         layout.addStretch()
         self.setLayout(layout)
 
+    # Frames averaged for the mean image used to threshold a mask
+    MASK_PREVIEW_FRAMES = 500
+    # Stage outputs larger than this go to a memory-mapped scratch file
+    STAGE_MEMORY_LIMIT_BYTES = 2 * 1024 ** 3
+    # Time chunk of the streaming pipeline
+    PIPELINE_CHUNK_FRAMES = 512
+    # Disk space for cached stage outputs (least recently used evicted first)
+    STAGE_CACHE_MAX_BYTES = 50 * 1024 ** 3
+    # Edge length of the summary image thumbnails, in screen pixels
+    SUMMARY_THUMBNAIL_SIZE = 160
+
+    def set_dataset(self, name, data, identity=None):
+        """
+        Called by the main window once a dataset has been loaded. `identity`
+        (see stage_cache.dataset_identity) enables reusing cached stage
+        outputs across sessions; without it nothing is cached.
+        """
+        self.cancel_stage()
+        self.source_data = data
+        self.dataset_identity = identity
+        self.dataset_key = dataset_key(identity) if identity is not None else None
+        self.crop_stage = None
+        self.binning_stage = None
+        self.binned_check.setChecked(False)
+        self.mask_stage = None
+        self.motion_stage = None
+        self.denoise_stage = None
+        self._clear_processed()
+        self._update_working_data()
+        print(f"[Preprocessing] Working on '{name}' {data.shape}")
+
+    # -- stage bookkeeping -----------------------------------------------------
+    def chunk_stages(self):
+        """
+        Configured per-chunk stages, in pipeline order.
+        """
+        return [stage for stage in (self.motion_stage, self.denoise_stage) if stage is not None]
+
+    def pending_stages(self):
+        """
+        Configured stages that processed_data does not include yet.
+        """
+        return self.chunk_stages()[len(self.processed_stages):]
+
+    def binning_active(self):
+        """
+        True when the chunk stages run on the binned rather than the
+        full-resolution (cropped) movie.
+        """
+        return self.binning_stage is not None and self.binned_check.isChecked()
+
+    def _base_params(self):
+        return {'crop': self.crop_stage.params() if self.crop_stage is not None else None,
+                'binning': self.binning_stage.params() if self.binning_active() else None}
+
+    def _processed_is_current(self):
+        # processed_data stays usable while it was computed from the current
+        # base movie and its stages are a prefix of the configured ones
+        if self.processed_data is not None and self.processed_base != self._base_params():
+            return False
+        configured = self.chunk_stages()
+        done = self.processed_stages
+        return len(done) <= len(configured) and all(a is b for a, b in zip(done, configured))
+
+    def stage_keys(self):
+        """
+        Cache keys of the configured stages' outputs, chained from the dataset
+        identity through the crop and binning, or None when the dataset has no
+        identity.
+        """
+        key = self._base_key()
+        if key is None:
+            return None
+        keys = []
+        for stage in self.chunk_stages():
+            key = chain_key(key, stage.name, stage.params())
+            keys.append(key)
+        return keys
+
+    def _base_key(self):
+        # Cache key of the base movie (dataset -> crop -> binning)
+        if self.dataset_key is None:
+            return None
+        key = self.dataset_key
+        if self.crop_stage is not None:
+            key = chain_key(key, self.crop_stage.name, self.crop_stage.params())
+        if self.binning_active():
+            key = chain_key(key, self.binning_stage.name, self.binning_stage.params())
+        return key
+
+    def working_key(self):
+        """
+        Cache key of working_data: the base movie with processed_stages applied.
+        """
+        if self.processed_stages:
+            keys = self.stage_keys()
+            return keys[len(self.processed_stages) - 1] if keys is not None else None
+        return self._base_key()
+
+    def _working_state(self):
+        # Changes whenever working_data stands for another movie
+        return (id(self.source_data), repr(self._base_params()), tuple(id(s) for s in self.processed_stages))
+
+    def _motion_extras(self):
+        # Side arrays stored with every cached output downstream of motion correction
+        stage = self.motion_stage
+        if stage is None:
+            return {}
+        shifts = stage.shifts if stage.shifts is not None else self.motion_shifts
+        extras = {'template': stage.template}
+        if shifts is not None:
+            extras['shifts'] = shifts
+        return extras
+
+    def _restore_motion_extras(self, extras):
+        if self.motion_stage is None:
+            return
+        if 'template' in extras:
+            self.motion_stage.template = extras['template']
+        if 'shifts' in extras:
+            self.motion_shifts = extras['shifts']
+
+    def _clear_processed(self):
+        self.processed_data = None
+        self.processed_stages = []
+        self.processed_base = None
+        self.motion_shifts = None
+
+    def _cropped_source(self):
+        if self.crop_stage is None:
+            return self.source_data
+        return self.crop_stage.apply(self.source_data)
+
+    def _base_source(self):
+        """
+        Movie the chunk stages start from: the cropped source, binned (lazily)
+        when binning is active.
+        """
+        data = self._cropped_source()
+        if self.binning_active():
+            data = self.binning_stage.apply(data)
+        return data
+
+    def _source_pipeline(self, stages, mask=None):
+        # Without binning the crop is pushed down into the pipeline (and named in its report)
+        if self.binning_active():
+            return PreprocessingPipeline(self._base_source(), stages=stages, mask=mask,
+                                         frames_per_chunk=self.PIPELINE_CHUNK_FRAMES)
+        return PreprocessingPipeline(self.source_data, crop=self.crop_stage, stages=stages, mask=mask,
+                                     frames_per_chunk=self.PIPELINE_CHUNK_FRAMES)
+
+    def _update_working_data(self):
+        if not self._processed_is_current():
+            self._clear_processed()
+
+        data = None
+        if self.processed_data is not None:
+            data = self.processed_data
+        elif self.source_data is not None:
+            data = self._base_source()
+        self.working_data = data
+
+        # A mask drawn for another field of view no longer applies
+        if (self.mask_stage is not None and data is not None
+                and self.mask_stage.image_shape != tuple(data.shape[1:3])):
+            print("[Preprocessing] Field of view changed, clearing mask.")
+            self.mask_stage = None
+
+        if self.summary_images is not None and self._summary_state != self._working_state():
+            self._show_summary_images(None)
+
+        if data is None:
+            self.data_label.setText("No dataset loaded.")
+        else:
+            text = f"Working data: {data.shape}, {data.dtype}"
+            if self.crop_stage is not None:
+                text += f" (cropped from {self.source_data.shape})"
+            if self.binning_active():
+                params = self.binning_stage.params()
+                text += (f"\nBinned: {params['t_bin']} frames, {params['s_bin']}x{params['s_bin']} pixels "
+                         f"({params['reducer']}) from {self._cropped_source().shape}")
+            elif self.binning_stage is not None:
+                text += "\nBinning configured, steps run at full resolution"
+            if self.processed_stages:
+                text += f"\nApplied: {', '.join(self._describe(s) for s in self.processed_stages)}"
+            if self.pending_stages():
+                text += f"\nPending: {', '.join(self._describe(s) for s in self.pending_stages())}"
+            if self.mask_stage is not None:
+                text += (f"\nMask: {self.mask_stage.n_pixels} pixels "
+                         f"({self.mask_stage.coverage:.0%} of the field of view)")
+            self.data_label.setText(text)
+
+    def _describe(self, stage):
+        params = stage.params()
+        if stage is self.motion_stage:
+            text = f"motion correction ({params['mode']}, max shift {params['max_shift']} px"
+            if self.motion_shifts is not None and stage in self.processed_stages and len(self.motion_shifts):
+                text += f", largest {np.abs(self.motion_shifts).max():.1f} px"
+            return text + ")"
+        return (f"wavelet denoising ({params['wavelet']}, level {params['level']}, "
+                f"{params['threshold_rule']}/{params['threshold_mode']})")
+
+    def _require_movie(self):
+        if self.source_data is None or len(self.source_data.shape) < 3:
+            QMessageBox.warning(self, "No Movie", "Load a (T, H, W) dataset before preprocessing.")
+            return False
+        if self._stage_thread is not None:
+            QMessageBox.warning(self, "Busy", "Wait for the running preprocessing step to finish.")
+            return False
+        return True
+
     def crop_data(self):
         print("[Preprocessing] Cropping data...")
+        if not self._require_movie():
+            return
+
+        dialog = CropDialog(self.source_data.shape, self.crop_stage, parent=self)
+        if dialog.exec() != QDialog.DialogCode.Accepted:
+            return
+        crop_stage = dialog.crop_stage()
+        try:
+            crop_stage.validate(self.source_data.shape)
+        except ValueError as e:
+            QMessageBox.warning(self, "Invalid Crop", str(e))
+            return
+        if self.binning_stage is not None:
+            try:
+                self.binning_stage.validate(crop_stage.output_shape(self.source_data.shape))
+            except ValueError as e:
+                print(f"[Preprocessing] {e}; clearing binning.")
+                self.binning_stage = None
+                self.binned_check.setChecked(False)
+
+        if self.processed_stages and crop_stage.params() != (self.crop_stage or CropStage()).params():
+            print("[Preprocessing] Crop changed, processed steps will be recomputed.")
+            self._clear_processed()
+        self.crop_stage = crop_stage
+        self._update_working_data()
+        print(f"[Preprocessing] Crop {crop_stage.params()} -> {self.working_data.shape}")
+
+    def binning(self):
+        print("[Preprocessing] Configuring binning...")
+        if not self._require_movie():
+            return
+
+        current = self.binning_stage.params() if self.binning_stage is not None else {}
+        shape = self._cropped_source().shape
+        t_bin, ok = QInputDialog.getInt(self, "Binning", "Frames per temporal bin (1 = none):",
+                                        current.get('t_bin', 1), 1, max(1, shape[0]))
+        if not ok:
+            return
+        s_bin, ok = QInputDialog.getInt(self, "Binning", "Spatial bin size k (k x k pixels, 1 = none):",
+                                        current.get('s_bin', 2), 1, max(1, min(shape[1:3])))
+        if not ok:
+            return
+        reducers = list(BinningStage.REDUCERS)
+        reducer, ok = QInputDialog.getItem(self, "Binning", "Combine binned values by:", reducers,
+                                           reducers.index(current.get('reducer', "mean")), False)
+        if not ok:
+            return
+
+        if t_bin == 1 and s_bin == 1:
+            self.binning_stage = None
+            self.binned_check.setChecked(False)
+            self._update_working_data()
+            print("[Preprocessing] Binning cleared.")
+            return
+        try:
+            binning_stage = BinningStage(t_bin=t_bin, s_bin=s_bin, reducer=reducer)
+            binning_stage.validate(shape)
+        except ValueError as e:
+            QMessageBox.warning(self, "Invalid Binning", str(e))
+            return
+
+        self.binning_stage = binning_stage
+        if self.binned_check.isChecked():
+            self._update_working_data()
+        else:
+            self.binned_check.setChecked(True)  # updates the working data
+        print(f"[Preprocessing] Binning {binning_stage.params()} -> {self.working_data.shape}")
+
+    def _binning_toggled(self, checked):
+        if self._stage_thread is not None:
+            # The running pipeline reads the current base movie; switch after it finishes
+            self.binned_check.blockSignals(True)
+            self.binned_check.setChecked(not checked)
+            self.binned_check.blockSignals(False)
+            QMessageBox.warning(self, "Busy", "Wait for the running preprocessing step to finish.")
+            return
+        if self.source_data is not None:
+            self._update_working_data()
 
     def mask_selection(self):
         print("[Preprocessing] Selecting mask...")
+        if not self._require_movie():
+            return
+
+        methods = ["Threshold mean image", "Load mask from file", "Clear mask"]
+        method, ok = QInputDialog.getItem(self, "Mask Selection", "Mask source:", methods, 0, False)
+        if not ok:
+            return
+
+        try:
+            if method == "Clear mask":
+                mask_stage = None
+            elif method == "Threshold mean image":
+                percentile, ok = QInputDialog.getDouble(
+                    self, "Mask Selection", "Keep pixels above percentile of the mean image:",
+                    60.0, 0.0, 99.9, 1)
+                if not ok:
+                    return
+                if self.summary_images is not None:
+                    mean_image = self.summary_images['mean']  # whole movie, already computed
+                else:
+                    n_frames = min(self.MASK_PREVIEW_FRAMES, self.working_data.shape[0])
+                    mean_image = np.asarray(self.working_data[:n_frames], dtype=np.float64).mean(axis=0)
+                mask_stage = MaskStage.from_threshold(mean_image, percentile)
+            else:
+                path, _ = QFileDialog.getOpenFileName(
+                    self, "Select Mask", "", "Masks (*.npy *.png *.tif *.tiff);;All Files (*)")
+                if not path:
+                    return
+                mask_stage = MaskStage.from_file(path)
+                if mask_stage.image_shape != tuple(self.working_data.shape[1:3]):
+                    raise ValueError(f"Mask is {mask_stage.image_shape} but frames are "
+                                     f"{tuple(self.working_data.shape[1:3])}")
+        except Exception as e:
+            QMessageBox.warning(self, "Mask Selection", f"Could not build mask: {e}")
+            return
+
+        self.mask_stage = mask_stage
+        self._update_working_data()
+        if mask_stage is not None:
+            print(f"[Preprocessing] Mask keeps {mask_stage.n_pixels} pixels "
+                  f"({mask_stage.coverage:.0%} of the field of view)")
+
+    def compute_summary_images(self):
+        """
+        Mean, max, std and local correlation images of the working data, in a
+        single streaming pass; cached with the dataset like a stage output.
+        """
+        print("[Preprocessing] Computing summary images...")
+        if not self._require_movie():
+            return
+
+        engine = SummaryImageEngine()
+        source = self.working_data
+        state = self._working_state()
+        key = self.working_key()
+        if key is not None:
+            key = chain_key(key, engine.name, engine.params())
+            hit = self.stage_cache.get(key)
+            if hit is not None:
+                stack, _, meta = hit
+                print("[Preprocessing] Reusing cached summary images")
+                self._summary_state = state
+                self._show_summary_images(dict(zip(meta.get('images', SUMMARY_IMAGES), np.asarray(stack))))
+                return
+
+        def task(progress, is_cancelled):
+            images = engine.compute(source, progress=progress, is_cancelled=is_cancelled)
+            if images is None:
+                return None, None
+            if key is not None:
+                stack = np.stack([images[name] for name in SUMMARY_IMAGES])
+                entry = self.stage_cache.create(key, stack.shape)
+                if entry is not None:
+                    entry.data[...] = stack
+                    entry.commit(meta={'stage': engine.name, 'images': list(SUMMARY_IMAGES)})
+            return images, engine.timing_report()
+
+        def on_done(value):
+            images, report = value
+            if images is None or self._working_state() != state:
+                return  # cancelled, or the working data changed while running
+            self._summary_state = state
+            self._show_summary_images(images)
+            print(f"[Preprocessing] {report}")
+
+        self._run_stage("summary images", task, on_done)
+
+    def _show_summary_images(self, images):
+        self.summary_images = images
+        for name, image_label in self.summary_labels.items():
+            if images is None:
+                image_label.clear()
+                continue
+            image = np.nan_to_num(np.asarray(images[name], dtype=np.float32))
+            low, high = np.percentile(image, (1, 99))
+            scaled = np.clip((image - low) / max(high - low, 1e-12) * 255, 0, 255).astype(np.uint8)
+            scaled = np.ascontiguousarray(scaled)
+            height, width = scaled.shape
+            qimage = QImage(scaled.data, width, height, width, QImage.Format.Format_Grayscale8).copy()
+            image_label.setPixmap(QPixmap.fromImage(qimage).scaled(
+                self.SUMMARY_THUMBNAIL_SIZE, self.SUMMARY_THUMBNAIL_SIZE,
+                Qt.AspectRatioMode.KeepAspectRatio, Qt.TransformationMode.SmoothTransformation))
+
+    def analysis_input(self):
+        """
+        (gather, mask_stage) for the analysis. gather(progress, is_cancelled)
+        streams the working data, restricted to the mask, into a float32
+        (n_pixels, T) matrix (a scratch memmap beyond STAGE_MEMORY_LIMIT_BYTES)
+        and is meant for a worker thread; it returns None if cancelled. Pending
+        stages are streamed in the same pass, so the full movie is never
+        written. mask_stage is the mask the pixels come from (all pixels when
+        no mask is set).
+        """
+        if self.working_data is None:
+            return None, None
+        mask_stage = self.mask_stage
+        if mask_stage is None:
+            mask_stage = MaskStage(np.ones(self.working_data.shape[1:3], dtype=bool))
+        if self.pending_stages():
+            pipeline = self.build_pipeline(mask=mask_stage)
+        else:
+            pipeline = PreprocessingPipeline(self.working_data, mask=mask_stage,
+                                             frames_per_chunk=self.PIPELINE_CHUNK_FRAMES)
+        limit = self.STAGE_MEMORY_LIMIT_BYTES
+
+        def gather(progress=None, is_cancelled=None):
+            return pipeline.run(progress=progress, is_cancelled=is_cancelled, memory_limit_bytes=limit)
+
+        return gather, mask_stage
+
+    def is_busy(self):
+        return self._stage_thread is not None
+
+    def build_pipeline(self, mask=None):
+        """
+        Streaming pipeline for the pending stages, starting from processed_data
+        (or the cropped, possibly binned source when nothing has been processed yet).
+        """
+        if self.processed_data is not None:
+            return PreprocessingPipeline(self.processed_data, stages=self.pending_stages(), mask=mask,
+                                         frames_per_chunk=self.PIPELINE_CHUNK_FRAMES)
+        return self._source_pipeline(self.chunk_stages(), mask=mask)
+
+    def _stage_configured(self, stage):
+        self._update_working_data()
+        if self.defer_check.isChecked():
+            print(f"[Preprocessing] {stage.name} configured {stage.params()}; waiting for Run Pipeline.")
+        else:
+            self.run_pipeline()
 
     def motion_correction(self):
         print("[Preprocessing] Performing motion correction...")
+        if not self._require_movie():
+            return
+
+        frame_shape = self._base_source().shape[1:3]
+        modes = ["Rigid", "Piecewise rigid (patches)"]
+        mode, ok = QInputDialog.getItem(self, "Motion Correction", "Mode:", modes, 0, False)
+        if not ok:
+            return
+        max_shift, ok = QInputDialog.getInt(
+            self, "Motion Correction", "Maximum shift (pixels):",
+            min(20, min(frame_shape) // 4), 1, min(frame_shape) // 2)
+        if not ok:
+            return
+
+        if mode == "Rigid":
+            corrector = RigidMotionCorrector(max_shift=max_shift)
+        else:
+            patch_size, ok = QInputDialog.getInt(
+                self, "Motion Correction", "Patch size (pixels):",
+                min(128, min(frame_shape)), 16, min(frame_shape))
+            if not ok:
+                return
+            overlap, ok = QInputDialog.getInt(
+                self, "Motion Correction", "Patch overlap (pixels):",
+                patch_size // 4, 0, patch_size - 1)
+            if not ok:
+                return
+            corrector = PiecewiseRigidMotionCorrector(patch_size=patch_size, overlap=overlap,
+                                                      max_shift=max_shift)
+
+        self.motion_stage = corrector
+        self._stage_configured(corrector)
 
     def wavelet_denoising(self):
         print("[Preprocessing] Applying wavelet denoising...")
+        if not self._require_movie():
+            return
+
+        wavelets = ["sym4", "db4", "coif2", "haar", "bior2.2"]
+        wavelet, ok = QInputDialog.getItem(self, "Wavelet Denoising", "Wavelet:", wavelets, 0, True)
+        if not ok:
+            return
+        level, ok = QInputDialog.getInt(self, "Wavelet Denoising", "Decomposition level:", 3, 1, 10)
+        if not ok:
+            return
+        rules = [f"{rule} ({mode})" for rule in THRESHOLD_RULES for mode in THRESHOLD_MODES]
+        rule, ok = QInputDialog.getItem(self, "Wavelet Denoising", "Threshold rule:", rules, 0, False)
+        if not ok:
+            return
+        overlap, ok = QInputDialog.getInt(self, "Wavelet Denoising", "Chunk overlap (frames):",
+                                          32, 0, 4096)
+        if not ok:
+            return
+
+        threshold_rule, threshold_mode = rule.rstrip(")").split(" (")
+        try:
+            denoiser = WaveletDenoiser(wavelet=wavelet.strip(), level=level, overlap=overlap,
+                                       threshold_rule=threshold_rule, threshold_mode=threshold_mode)
+        except ValueError as e:
+            QMessageBox.warning(self, "Wavelet Denoising", str(e))
+            return
+
+        self.denoise_stage = denoiser
+        self._stage_configured(denoiser)
+
+    def configure_output(self):
+        """
+        Choose where Run Pipeline writes its result: memory (with a scratch
+        file / the stage cache beyond the memory limit) or a chunked HDF5 file
+        that then becomes the working dataset.
+        """
+        destinations = ["Memory / stage cache", "HDF5 file"]
+        destination, ok = QInputDialog.getItem(self, "Output Settings", "Write results to:",
+                                               destinations, 0, False)
+        if not ok:
+            return
+        if destination == destinations[0]:
+            self.output_settings = None
+            print("[Preprocessing] Results stay in memory / stage cache.")
+            return
+
+        path, _ = QFileDialog.getSaveFileName(self, "Preprocessing Output", "preprocessed.h5",
+                                              "HDF5 Files (*.h5 *.hdf5)")
+        if not path:
+            return
+        source_path = (self.dataset_identity or {}).get('path')
+        if source_path is not None and os.path.abspath(path) == source_path:
+            QMessageBox.warning(self, "Output Settings", "The output file cannot be the loaded source file.")
+            return
+        compression, ok = QInputDialog.getItem(
+            self, "Output Settings", "Compression (none is fastest):", list(COMPRESSORS), 0, False)
+        if not ok:
+            return
+        access, ok = QInputDialog.getItem(
+            self, "Output Settings", "Chunk layout optimized for reading:", list(ACCESS_PATTERNS), 0, False)
+        if not ok:
+            return
+
+        self.output_settings = {'path': path, 'compression': compression, 'access': access}
+        print(f"[Preprocessing] Results will be written to {path} ({compression}, {access} chunks)")
+
+    def run_pipeline(self):
+        """
+        Compute all pending stages in one streaming pass over the movie,
+        starting from the longest cached prefix of the configured stages. With
+        an HDF5 output configured the result is written there even when every
+        stage is cached.
+        """
+        print("[Preprocessing] Running pipeline...")
+        if not self._require_movie():
+            return
+        configured = self.chunk_stages()
+        if not self.pending_stages():
+            print("[Preprocessing] Nothing to run, all configured steps are applied.")
+            return
+
+        keys = self.stage_keys()
+        start_index, start_data = len(self.processed_stages), self.processed_data
+        if keys is not None:
+            for index in range(len(configured), start_index, -1):
+                hit = self.stage_cache.get(keys[index - 1])
+                if hit is not None:
+                    start_data, extras, _ = hit
+                    start_index = index
+                    self._restore_motion_extras(extras)
+                    print(f"[Preprocessing] Reusing cached output of "
+                          f"{' -> '.join(stage.name for stage in configured[:index])}")
+                    break
+
+        base = self._base_params()
+        output_settings = self.output_settings
+        if start_index == len(configured) and output_settings is None:
+            self.processed_data = start_data
+            self.processed_stages = configured
+            self.processed_base = base
+            self._update_working_data()
+            return
+
+        stages = configured[start_index:]
+        if start_data is not None:
+            pipeline = PreprocessingPipeline(start_data, stages=stages,
+                                             frames_per_chunk=self.PIPELINE_CHUNK_FRAMES)
+        else:
+            pipeline = self._source_pipeline(stages)
+        stage_keys = keys[start_index:] if keys is not None else None
+        limit = self.STAGE_MEMORY_LIMIT_BYTES
+
+        def task(progress, is_cancelled):
+            # Every stage output goes straight into its cache entry: the last
+            # one is the pipeline output, earlier ones are checkpoints. An
+            # HDF5 output file takes the place of the last entry. Outputs
+            # larger than the cache have no entry (None).
+            entries = []
+            writer = None
+
+            def discard():
+                for entry in entries:
+                    if entry is not None:
+                        entry.abort()
+                if writer is not None:
+                    writer.abort()
+
+            try:
+                for key in stage_keys or ():
+                    entries.append(self.stage_cache.create(key, pipeline.output_shape))
+                if output_settings is not None and entries:
+                    if entries[-1] is not None:
+                        entries[-1].abort()  # the HDF5 file holds the final result instead
+                    entries[-1] = None
+                final = entries[-1] if entries else None
+                if output_settings is not None:
+                    writer = HDF5Output(output_settings['path'], pipeline.output_shape,
+                                        compression=output_settings['compression'],
+                                        access=output_settings['access'])
+                    out = writer
+                elif final is not None:
+                    out = final.data
+                else:
+                    out = allocate_array(pipeline.output_shape, np.float32, limit)
+                checkpoints = {i: entry.data for i, entry in enumerate(entries[:-1]) if entry is not None}
+
+                # The pipeline closes the stages (and the denoiser's process pool) when it ends
+                data = pipeline.run(out=out, progress=progress, is_cancelled=is_cancelled,
+                                    checkpoints=checkpoints)
+                report = pipeline.timing_report()
+                if data is None:
+                    discard()
+                    return None, None
+
+                extras = self._motion_extras()
+                for stage, entry in zip(stages, entries):
+                    if entry is not None:
+                        cached = entry.commit(extras=extras, meta={'stage': stage.name, 'params': stage.params()})
+                        if entry is final:
+                            data = cached
+                if writer is not None:
+                    writer.set_attrs({'stages': [{'name': stage.name, 'params': stage.params()}
+                                                 for stage in configured],
+                                      'crop': base['crop'], 'binning': base['binning'],
+                                      'source': self.dataset_identity})
+                    for name, array in extras.items():
+                        writer.write_extra(f"motion_{name}", array)
+                    data = writer.finish()
+            except Exception:
+                discard()  # committed entries and a finished file are no longer affected
+                raise
+            return data, report
+
+        def on_done(value):
+            data, report = value
+            if data is None or self.chunk_stages() != configured or self._base_params() != base:
+                return  # cancelled, or reconfigured while running
+            if self.motion_stage in stages:
+                self.motion_shifts = self.motion_stage.shifts
+            self.processed_data = data
+            self.processed_stages = configured
+            self.processed_base = base
+            self._update_working_data()
+            print(f"[Preprocessing] Pipeline finished\n{report}")
+            if output_settings is not None:
+                self.output_ready.emit(os.path.basename(output_settings['path']), data)
+
+        # With every stage cached, the pass only copies the cached result into the output file
+        self._run_stage(" -> ".join(stage.name for stage in stages) or "output", task, on_done)
+
+    # -- background stages -----------------------------------------------------
+    def _run_stage(self, name, task, on_done):
+        """
+        Run task(progress, is_cancelled) on a StageWorker thread and call
+        on_done(result) on the GUI thread when it completes.
+        """
+        self.stage_label.setText(f"Running {name}...")
+
+        def on_progress(done, total):
+            self.stage_label.setText(f"Running {name}: {done}/{total} frames")
+
+        def on_error(message):
+            QMessageBox.critical(self, "Preprocessing Error", f"{name} failed: {message}")
+
+        self._stage_thread, self._stage_worker = start_stage_worker(
+            self, task, on_done, on_progress, on_error)
+        self._stage_thread.finished.connect(self._on_stage_finished)
+
+    def _on_stage_finished(self):
+        self._stage_thread = None
+        self._stage_worker = None
+        self.stage_label.setText("")
+
+    def cancel_stage(self):
+        """
+        Ask a running stage to stop and wait for its thread to exit.
+        """
+        if self._stage_thread is None:
+            return
+        self._stage_worker.cancel()
+        self._stage_thread.quit()
+        self._stage_thread.wait()
+        self._on_stage_finished()
 
 
 class ParameterSetupTab(QWidget):
@@ -55,14 +876,85 @@ class ParameterSetupTab(QWidget):
 
     def init_ui(self):
         layout = QVBoxLayout()
-        layout.addWidget(QLabel("Parameter setup goes here."))
+        layout.addWidget(QLabel("GraFT Parameters:"))
+
+        form = QFormLayout()
+        self.spin_boxes = {}
+        defaults = GraFTEngine().params()
+        for key, label, low, high in (('n_components', "Components", 1, 1000),
+                                      ('n_iterations', "Maximum iterations", 1, 10000),
+                                      ('patience', "Converged iterations before stopping", 1, 100),
+                                      ('n_neighbors', "Graph neighbours per pixel", 1, 100),
+                                      ('graph_radius', "Graph search radius (pixels)", 1, 50)):
+            box = QSpinBox()
+            box.setRange(low, high)
+            box.setValue(defaults[key])
+            form.addRow(f"{label}:", box)
+            self.spin_boxes[key] = box
+        for key, label, high in (('sparsity', "Sparsity (correlation units)", 1.0),
+                                 ('graph_weight', "Graph weight", 100.0),
+                                 ('beta', "Reweighting beta", 10.0)):
+            box = QDoubleSpinBox()
+            box.setDecimals(3)
+            box.setSingleStep(0.01)
+            box.setRange(0.001 if key == 'beta' else 0.0, high)
+            box.setValue(defaults[key])
+            form.addRow(f"{label}:", box)
+            self.spin_boxes[key] = box
+        for key, label in (('objective_tol', "Objective change tolerance"),
+                           ('dictionary_tol', "Dictionary change tolerance"),
+                           ('support_tol', "Support change tolerance")):
+            box = QDoubleSpinBox()
+            box.setDecimals(6)
+            box.setSingleStep(1e-4)
+            box.setRange(0.0, 1.0)
+            box.setValue(defaults[key])
+            box.setToolTip("Relative change per iteration below which the fit counts as converged")
+            form.addRow(f"{label}:", box)
+            self.spin_boxes[key] = box
+        self.workers_box = QSpinBox()
+        self.workers_box.setRange(0, max(1, os.cpu_count() or 1))
+        self.workers_box.setSpecialValueText("Auto")  # 0: serial for small problems, see auto_workers
+        self.workers_box.setValue(0)
+        self.workers_box.setToolTip("Processes sharing the inference; 1 runs it in this process, "
+                                    "Auto uses a pool only for large movies")
+        form.addRow("Worker processes:", self.workers_box)
+        self.graph_method_box = QComboBox()
+        self.graph_method_box.addItems(["auto"] + list(GRAPH_METHODS))
+        self.graph_method_box.setToolTip("auto: neighbours within the search radius in the image")
+        form.addRow("Graph search:", self.graph_method_box)
+        layout.addLayout(form)
+
         layout.addStretch()
         self.setLayout(layout)
 
+    def graft_params(self):
+        """
+        Keyword arguments for GraFTEngine from the form.
+        """
+        params = {key: box.value() for key, box in self.spin_boxes.items()}
+        params['graph_method'] = self.graph_method_box.currentText()
+        params['n_workers'] = self.workers_box.value() or None
+        return params
+
+
+MONITOR_INTERVAL_MS = 250  # refresh period of the live iteration log
+
 
 class AlgorithmExecutionTab(QWidget):
-    def __init__(self, parent=None):
+    def __init__(self, preprocess_tab=None, parameter_tab=None, parent=None):
         super().__init__(parent)
+        self.preprocess_tab = preprocess_tab   # source of the data matrix
+        self.parameter_tab = parameter_tab     # source of the GraFT parameters
+        self.engine = None                     # last fitted GraFTEngine
+        self.mask_stage = None                 # mask the engine's pixels came from
+        self._thread = None
+        self._worker = None
+        # History entries queued by the solver thread, drained by a GUI timer
+        self._iterations = queue.SimpleQueue()
+        self._monitor_timer = QTimer(self)
+        self._monitor_timer.setInterval(MONITOR_INTERVAL_MS)
+        self._monitor_timer.timeout.connect(self._drain_iterations)
         self.init_ui()
 
     def init_ui(self):
@@ -72,11 +964,102 @@ class AlgorithmExecutionTab(QWidget):
         run_button.clicked.connect(self.run_algorithm)
         layout.addWidget(run_button)
 
-        layout.addStretch()
+        self.status_label = QLabel("")
+        layout.addWidget(self.status_label)
+
+        self.iteration_log = QPlainTextEdit()
+        self.iteration_log.setReadOnly(True)
+        self.iteration_log.setLineWrapMode(QPlainTextEdit.LineWrapMode.NoWrap)
+        self.iteration_log.setMaximumBlockCount(10000)
+        layout.addWidget(self.iteration_log)
         self.setLayout(layout)
 
+    def _drain_iterations(self):
+        # Show every iteration finished since the last tick
+        entry = None
+        while True:
+            try:
+                entry = self._iterations.get_nowait()
+            except queue.Empty:
+                break
+            self.iteration_log.appendPlainText(format_iteration(entry))
+        if entry is not None and self._thread is not None:
+            self.status_label.setText(f"Iteration {entry['iteration']}, objective {entry['objective']:.6g} "
+                                      f"({entry['seconds']:.2f}s)")
+
     def run_algorithm(self):
+        """
+        Fit GraFT to the masked, preprocessed working data on a worker thread.
+        """
         print("[Algorithm] Running main analysis...")
+        if self._thread is not None:
+            QMessageBox.warning(self, "Busy", "The analysis is already running.")
+            return
+        if self.preprocess_tab is None or self.preprocess_tab.working_data is None:
+            QMessageBox.warning(self, "No Data", "Load and preprocess a dataset before running GraFT.")
+            return
+        if self.preprocess_tab.is_busy():
+            QMessageBox.warning(self, "Busy", "Wait for the running preprocessing step to finish.")
+            return
+
+        params = self.parameter_tab.graft_params() if self.parameter_tab is not None else {}
+        try:
+            engine = GraFTEngine(**params)
+        except ValueError as e:
+            QMessageBox.warning(self, "GraFT Parameters", str(e))
+            return
+        gather, mask_stage = self.preprocess_tab.analysis_input()
+
+        def task(progress, is_cancelled):
+            # Streams the pixel matrix, with any pending preprocessing steps, first
+            matrix = gather(progress=progress, is_cancelled=is_cancelled)
+            if matrix is None:
+                return None
+            print(f"[Algorithm] GraFT {engine.params()} on {matrix.shape[0]} pixels x {matrix.shape[1]} frames")
+            # Iterations are reported through the monitor
+            return engine.fit(matrix, coords=mask_stage.coordinates, is_cancelled=is_cancelled,
+                              monitor=self._iterations.put)
+
+        def on_progress(done, total):
+            self.status_label.setText(f"Gathering pixels: {done}/{total} frames")
+
+        def on_done(fitted):
+            if fitted is None:
+                return
+            self.engine = fitted
+            self.mask_stage = mask_stage
+            stats = fitted.last_run_stats
+            self._drain_iterations()
+            self.iteration_log.appendPlainText(f"Stopped after {stats['iterations']} iterations "
+                                               f"({stats['stopped']}), {stats['seconds']:.2f}s")
+            print(f"[Algorithm] GraFT finished\n{fitted.timing_report()}")
+
+        def on_error(message):
+            QMessageBox.critical(self, "GraFT Error", f"GraFT failed: {message}")
+
+        self.status_label.setText("Running GraFT...")
+        self.iteration_log.clear()
+        self._thread, self._worker = start_stage_worker(self, task, on_done, on_progress, on_error)
+        self._thread.finished.connect(self._on_finished)
+        self._monitor_timer.start()
+
+    def _on_finished(self):
+        self._monitor_timer.stop()
+        self._drain_iterations()
+        self._thread = None
+        self._worker = None
+        self.status_label.setText("")
+
+    def cancel(self):
+        """
+        Ask a running fit to stop after its current iteration and wait for it.
+        """
+        if self._thread is None:
+            return
+        self._worker.cancel()
+        self._thread.quit()
+        self._thread.wait()
+        self._on_finished()
 
 
 class ResultsVisualizationTab(QWidget):
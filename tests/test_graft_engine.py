@@ -0,0 +1,18 @@
+import numpy as np
+
+from graft_engine import GraFTEngine
+
+
+def test_pool_matches_serial():
+    rng = np.random.default_rng(0)
+    size, n_frames = 24, 200
+    maps = rng.random((size * size, 4)) * (rng.random((size * size, 4)) < 0.2)
+    traces = np.maximum(rng.standard_normal((4, n_frames)), 0)
+    data = (maps @ traces + 0.1 * rng.standard_normal((size * size, n_frames))).astype(np.float32)
+    coords = np.stack(np.mgrid[:size, :size].reshape(2, -1), axis=1)
+
+    settings = dict(n_components=4, n_iterations=5, graph_method="spatial", seed=0)
+    serial = GraFTEngine(n_workers=1, **settings).fit(data, coords=coords)
+    pooled = GraFTEngine(n_workers=2, **settings).fit(data, coords=coords)
+    np.testing.assert_allclose(pooled.dictionary, serial.dictionary, atol=1e-4)
+    np.testing.assert_allclose(pooled.coefficients, serial.coefficients, atol=1e-4)
@@ -0,0 +1,28 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("pywt")
+
+from motion_correction import RigidMotionCorrector
+from preprocessing_pipeline import PreprocessingPipeline
+from wavelet_denoising import WaveletDenoiser
+
+
+def shifted_movie(n_frames=400, size=48, seed=0):
+    rng = np.random.default_rng(seed)
+    yy, xx = np.mgrid[:size, :size]
+    image = np.exp(-((yy - size / 2) ** 2 + (xx - size / 3) ** 2) / 40.0) * 10
+    shifts = rng.integers(-3, 4, size=(n_frames, 2))
+    frames = np.stack([np.roll(image, tuple(shift), axis=(0, 1)) for shift in shifts])
+    return (frames + rng.standard_normal(frames.shape)).astype(np.float32)
+
+
+def test_fused_pass_matches_separate_stage_passes():
+    movie = shifted_movie()
+    corrected = np.empty(movie.shape, dtype=np.float32)
+    RigidMotionCorrector(max_shift=5, template_frames=50).correct(movie, out=corrected)
+    separate = WaveletDenoiser(frames_per_chunk=128, max_workers=1).denoise(corrected)
+
+    stages = [RigidMotionCorrector(max_shift=5, template_frames=50), WaveletDenoiser(max_workers=1)]
+    fused = PreprocessingPipeline(movie, stages=stages, frames_per_chunk=96).run()
+    np.testing.assert_allclose(fused, separate, atol=1e-4)
@@ -0,0 +1,36 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("pywt")
+
+from wavelet_denoising import WaveletDenoiser
+
+
+def noisy_movie(n_frames, size, seed=0):
+    rng = np.random.default_rng(seed)
+    signal = 5 * np.sin(np.arange(n_frames) / 40)[:, None, None]
+    noise = rng.standard_normal((n_frames, size, size)) * np.linspace(1, 3, n_frames)[:, None, None]
+    return (signal + noise).astype(np.float32)
+
+
+@pytest.mark.parametrize("threshold_rule", ["universal", "bayes"])
+def test_thresholds_and_output_do_not_depend_on_chunk_size(threshold_rule):
+    movie = noisy_movie(1500, 16)
+    thresholds = []
+    outputs = []
+    for frames_per_chunk in (100, 256, 1500):
+        denoiser = WaveletDenoiser(threshold_rule=threshold_rule, frames_per_chunk=frames_per_chunk,
+                                   max_workers=1)
+        outputs.append(denoiser.denoise(movie))
+        thresholds.append(denoiser._thresholds)
+    for other_thresholds, other_output in zip(thresholds[1:], outputs[1:]):
+        np.testing.assert_array_equal(other_thresholds, thresholds[0])
+        np.testing.assert_array_equal(other_output, outputs[0])
+
+
+def test_pool_matches_serial():
+    # Several chunks, each large enough to be split over both workers
+    movie = noisy_movie(256, 96)
+    serial = WaveletDenoiser(frames_per_chunk=64, max_workers=1).denoise(movie)
+    pooled = WaveletDenoiser(frames_per_chunk=64, max_workers=2).denoise(movie)
+    np.testing.assert_array_equal(pooled, serial)
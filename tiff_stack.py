@@ -0,0 +1,158 @@
+import os
+
+import numpy as np
+
+from lazy_dataset import LazyArray, split_frame_key
+
+
+###############################################################################
+# Multi-page TIFF / BigTIFF Stacks
+###############################################################################
+def _page_memmap_layout(tif):
+    """
+    Work out whether every page of `tif` can be addressed in place.
+
+    Returns (offset, page_stride) when all pages are uncompressed, stored as
+    consecutive strips, and evenly spaced in the file (e.g. one contiguous
+    block, or ScanImage/ImageJ files with a fixed-size IFD between frames).
+    Returns None otherwise. Only IFD tags are read, never pixel data.
+    """
+    key = tif.pages.first
+    if (key.compression != 1 or key.predictor != 1 or key.fillorder != 1
+            or key.is_tiled or key.bitspersample != key.dtype.itemsize * 8
+            or (key.samplesperpixel > 1 and key.planarconfig != 1)):
+        return None
+
+    page_nbytes = int(np.prod(key.shape)) * key.dtype.itemsize
+    offsets = []
+    for page in tif.pages:
+        data_offsets, byte_counts = page.dataoffsets, page.databytecounts
+        if page.shape != key.shape or sum(byte_counts) != page_nbytes:
+            return None
+        for i in range(len(data_offsets) - 1):
+            if data_offsets[i] + byte_counts[i] != data_offsets[i + 1]:
+                return None
+        offsets.append(data_offsets[0])
+
+    if len(offsets) == 1:
+        return offsets[0], page_nbytes
+    strides = np.diff(np.asarray(offsets, dtype=np.int64))
+    if strides[0] < page_nbytes or np.any(strides != strides[0]):
+        return None
+    return offsets[0], int(strides[0])
+
+
+def scan_tiff(tiff_path):
+    """
+    Describe a (multi-page, Big)TIFF from its IFD chain only.
+    Returns a dict with keys: shape, dtype, nbytes, n_pages, bigtiff,
+    compression, memmappable.
+    """
+    import tifffile
+    with tifffile.TiffFile(tiff_path) as tif:
+        tif.pages.useframes = True  # lightweight frames for all but the first IFD
+        key = tif.pages.first
+        n_pages = len(tif.pages)
+        shape = (n_pages,) + key.shape
+        return {
+            'shape': shape,
+            'dtype': str(key.dtype),
+            'nbytes': int(np.prod(shape, dtype=np.int64)) * key.dtype.itemsize,
+            'n_pages': n_pages,
+            'bigtiff': tif.is_bigtiff,
+            'compression': key.compression.name if hasattr(key.compression, 'name') else str(key.compression),
+            'memmappable': _page_memmap_layout(tif) is not None,
+        }
+
+
+class TiffStack(LazyArray):
+    """
+    Lazy (T, H, W[, S]) view of a multi-page TIFF or BigTIFF, one frame per page
+    (raw ScanImage/Bruker stacks keep their page order; interleaved channels
+    are not split here).
+
+    When every page is uncompressed and stored as consecutive strips at a fixed
+    stride, the stack is a strided view over a numpy.memmap of the file
+    (mode == "mmap"). Otherwise pages are decoded on demand, in parallel,
+    only for the frames being sliced (mode == "chunked").
+    """
+    def __init__(self, file_path, max_workers=None):
+        import tifffile
+
+        self.file_path = file_path
+        self.max_workers = max_workers or os.cpu_count() or 1
+
+        self._tif = tifffile.TiffFile(file_path)
+        try:
+            self._tif.pages.useframes = True
+            key = self._tif.pages.first
+            self.frame_shape = key.shape
+            self._dtype = key.dtype.newbyteorder(self._tif.byteorder)
+            self._n_pages = len(self._tif.pages)
+            layout = _page_memmap_layout(self._tif)
+        except Exception:
+            self._tif.close()
+            raise
+
+        self._memmap = None
+        if layout is not None:
+            offset, page_stride = layout
+            raw = np.memmap(file_path, dtype=np.uint8, mode='r')
+            frame_strides = np.empty(self.frame_shape, dtype=self._dtype).strides
+            self._memmap = np.ndarray(shape=self.shape, dtype=self._dtype, buffer=raw,
+                                      offset=offset, strides=(page_stride,) + frame_strides)
+            self.mode = "mmap"
+            self._tif.close()
+        else:
+            self.mode = "chunked"
+
+    # -- array-like metadata ---------------------------------------------------
+    @property
+    def shape(self):
+        return (self._n_pages,) + self.frame_shape
+
+    @property
+    def dtype(self):
+        return self._dtype
+
+    def __repr__(self):
+        return (f"<TiffStack '{os.path.basename(self.file_path)}' shape={self.shape} "
+                f"dtype={self.dtype} mode={self.mode}>")
+
+    # -- reading ---------------------------------------------------------------
+    def _decode_pages(self, pages, out=None):
+        # tifffile decodes the pages concurrently on `maxworkers` threads
+        return self._tif.asarray(key=pages, maxworkers=self.max_workers, out=out)
+
+    def read_into(self, out, start, stop):
+        """
+        Read frames [start, stop) straight into out[start:stop].
+        """
+        if self._memmap is not None:
+            out[start:stop] = self._memmap[start:stop]
+        elif stop > start:
+            target = out[start:stop]
+            frames = self._decode_pages(range(start, stop),
+                                        out=target if target.flags.c_contiguous else None)
+            if frames is not target:
+                target[...] = frames.reshape(target.shape)
+        return out
+
+    def __getitem__(self, key):
+        if self._memmap is not None:
+            return self._memmap[key]
+
+        frame_key, rest = split_frame_key(key)
+        indices = np.arange(self._n_pages)[frame_key]
+        scalar = np.ndim(indices) == 0
+        indices = np.atleast_1d(indices)
+        if len(indices) == 0:
+            return np.empty((0,) + self.frame_shape, dtype=self.dtype)[rest]
+
+        frames = self._decode_pages(indices.tolist()).reshape((len(indices),) + self.frame_shape)
+        frames = frames[rest]
+        return frames[0] if scalar else frames
+
+    def close(self):
+        self._memmap = None
+        self._tif.close()
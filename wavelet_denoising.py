@@ -0,0 +1,368 @@
+import os
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from process_pool import make_spawn_pool
+
+
+###############################################################################
+# Wavelet Shrinkage (per-pixel, along time)
+###############################################################################
+THRESHOLD_RULES = ("universal", "bayes")
+THRESHOLD_MODES = ("soft", "hard")
+
+# Pixels transformed at once inside a chunk; bounds the temporaries of wavedec
+PIXELS_PER_BLOCK = 16384
+
+# Sample of the whole-movie noise estimate: NOISE_SAMPLE_WINDOWS windows of
+# at most NOISE_SAMPLE_BYTES / NOISE_SAMPLE_WINDOWS (float32) each, spread
+# evenly over the movie, or tiling it when it is shorter
+NOISE_SAMPLE_BYTES = 256 * 1024 ** 2
+NOISE_SAMPLE_WINDOWS = 8
+
+# Fewest pixels worth a process-pool task; chunks with fewer pixels per
+# worker are denoised in the calling process
+MIN_PIXELS_PER_TASK = 4096
+
+
+def _shrink(coeffs, threshold, mode):
+    if mode == "hard":
+        return coeffs * (np.abs(coeffs) > threshold)
+    return np.sign(coeffs) * np.maximum(np.abs(coeffs) - threshold, 0)
+
+
+def _detail_energies(details):
+    # Per-column sums of squares of each detail level
+    return [np.einsum('ti,ti->i', d, d, dtype=np.float64) for d in details]
+
+
+def shrinkage_thresholds(finest, energies, counts, n_frames, threshold_rule):
+    """
+    (levels, n) float32 thresholds per detail level (coarsest first) and
+    column. sigma is the MAD of the finest detail coefficients `finest`
+    (sorted in place); "universal" is sigma * sqrt(2 ln n_frames), "bayes"
+    sigma^2 / sigma_signal per level from the sums of squares `energies`.
+    """
+    sigma = np.median(finest, axis=0, overwrite_input=True) / 0.6745
+    if threshold_rule == "universal":
+        rows = [sigma * np.sqrt(2 * np.log(n_frames))] * len(energies)
+    elif threshold_rule == "bayes":
+        rows = [sigma ** 2 / np.sqrt(np.maximum(energy / count - sigma ** 2, 1e-12))
+                for energy, count in zip(energies, counts)]
+    else:
+        raise ValueError(f"Unknown threshold rule '{threshold_rule}', expected one of {THRESHOLD_RULES}")
+    return np.stack(rows).astype(np.float32)
+
+
+def denoise_traces(traces, wavelet="sym4", level=3, threshold_rule="universal",
+                   threshold_mode="soft", thresholds=None):
+    """
+    Wavelet-shrinkage denoise the columns of a (T, n) float32 array.
+
+    `thresholds` are the (levels, n) shrinkage thresholds of the columns (see
+    shrinkage_thresholds); if not given they are estimated from `traces`
+    itself. Approximation coefficients (the slow baseline) are kept as they are.
+    """
+    import pywt
+
+    n_frames = traces.shape[0]
+    level = min(level, pywt.dwt_max_level(n_frames, pywt.Wavelet(wavelet).dec_len))
+    if level < 1:
+        return traces.astype(np.float32, copy=True)
+
+    coeffs = pywt.wavedec(traces, wavelet, level=level, axis=0, mode='symmetric')
+    if thresholds is None:
+        thresholds = shrinkage_thresholds(np.abs(coeffs[-1]), _detail_energies(coeffs[1:]),
+                                          [len(d) for d in coeffs[1:]], n_frames, threshold_rule)
+    # A short block may be decomposed into fewer levels: those are the finest
+    details = [_shrink(d, threshold, threshold_mode) for d, threshold in zip(coeffs[1:], thresholds[-level:])]
+
+    denoised = pywt.waverec([coeffs[0]] + details, wavelet, axis=0, mode='symmetric')
+    return denoised[:n_frames].astype(np.float32, copy=False)
+
+
+def denoise_frames(frames, out=None, thresholds=None, pixels=None, **params):
+    """
+    Denoise a (T, H, W) block pixel by pixel along time, PIXELS_PER_BLOCK
+    pixels at a time. thresholds are (levels, H * W), see denoise_traces.
+    pixels = (start, stop) restricts the work to that range of flat pixel
+    indices. Writes into `out` if given.
+    """
+    frames = np.asarray(frames, dtype=np.float32)
+    if out is None:
+        out = np.empty(frames.shape, dtype=np.float32)
+    src = frames.reshape(frames.shape[0], -1)
+    dst = out.reshape(out.shape[0], -1)
+    first, last = pixels if pixels is not None else (0, src.shape[1])
+    for start in range(first, last, PIXELS_PER_BLOCK):
+        block = slice(start, min(start + PIXELS_PER_BLOCK, last))
+        block_thresholds = None if thresholds is None else thresholds[:, block]
+        dst[:, block] = denoise_traces(src[:, block], thresholds=block_thresholds, **params)
+    return out
+
+
+# Per-process state of the pool workers, set once by _attach_thresholds
+_worker_threshold_block = None
+_worker_thresholds = None
+
+
+def _attach_thresholds(name, shape):
+    global _worker_threshold_block, _worker_thresholds
+    _worker_threshold_block = shared_memory.SharedMemory(name=name)
+    _worker_thresholds = np.ndarray(shape, dtype=np.float32, buffer=_worker_threshold_block.buf)
+
+
+def _denoise_shared_pixels(in_name, out_name, shape, pixels, params):
+    """
+    Process-pool task: denoise pixels [start, stop) of the shared-memory
+    block `in_name` into `out_name`.
+    """
+    shm_in = shared_memory.SharedMemory(name=in_name)
+    shm_out = shared_memory.SharedMemory(name=out_name)
+    try:
+        frames = np.ndarray(shape, dtype=np.float32, buffer=shm_in.buf)
+        out = np.ndarray(shape, dtype=np.float32, buffer=shm_out.buf)
+        denoise_frames(frames, out=out, thresholds=_worker_thresholds, pixels=pixels, **params)
+        del frames, out  # release the buffer exports before closing
+    finally:
+        shm_in.close()
+        shm_out.close()
+    return pixels
+
+
+class WaveletDenoiser:
+    """
+    Temporal wavelet-shrinkage denoising of (T, H, W) movies, as a pipeline
+    stage. prepare() estimates every pixel's thresholds once from the whole
+    movie, so the result does not depend on the chunking; process_chunk()
+    splits a chunk's pixels over max_workers processes through shared memory
+    and close() stops them. denoise() runs the stage alone over a movie.
+    """
+    name = "wavelet_denoising"
+
+    # Target size of one chunk (with overlap) when frames_per_chunk is not set
+    CHUNK_BYTES = 256 * 1024 ** 2
+
+    def __init__(self, wavelet="sym4", level=3, threshold_rule="universal", threshold_mode="soft",
+                 overlap=32, frames_per_chunk=None, max_workers=None):
+        import pywt
+
+        if wavelet not in pywt.wavelist(kind='discrete'):
+            raise ValueError(f"'{wavelet}' is not a discrete wavelet known to PyWavelets")
+        if threshold_rule not in THRESHOLD_RULES:
+            raise ValueError(f"threshold_rule must be one of {THRESHOLD_RULES}, got '{threshold_rule}'")
+        if threshold_mode not in THRESHOLD_MODES:
+            raise ValueError(f"threshold_mode must be one of {THRESHOLD_MODES}, got '{threshold_mode}'")
+        if level < 1 or overlap < 0:
+            raise ValueError("level must be >= 1 and overlap >= 0")
+
+        self._filter_length = pywt.Wavelet(wavelet).dec_len
+        self._thresholds = None
+        self._pool = None
+        self._threshold_block = None
+        self._slots = None
+        self.wavelet = wavelet
+        self.level = level
+        self.threshold_rule = threshold_rule
+        self.threshold_mode = threshold_mode
+        self.overlap = overlap
+        self.frames_per_chunk = frames_per_chunk
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.last_run_stats = None
+
+    def params(self):
+        return {'wavelet': self.wavelet, 'level': self.level, 'threshold_rule': self.threshold_rule,
+                'threshold_mode': self.threshold_mode, 'overlap': self.overlap}
+
+    def _denoise_params(self):
+        return {'wavelet': self.wavelet, 'level': self.level,
+                'threshold_rule': self.threshold_rule, 'threshold_mode': self.threshold_mode}
+
+    def _chunk_frames(self, frame_shape):
+        if self.frames_per_chunk is not None:
+            return max(1, self.frames_per_chunk)
+        frame_bytes = int(np.prod(frame_shape, dtype=np.int64)) * 4
+        overlap = self.temporal_overlap
+        return max(4 * overlap, 64, self.CHUNK_BYTES // max(frame_bytes, 1) - 2 * overlap)
+
+    @property
+    def chunk_alignment(self):
+        # Chunk starts on a multiple of 2**level see the whole-movie dyadic grid
+        return 2 ** self.level
+
+    @property
+    def temporal_overlap(self):
+        # Frames further away than the filters reach at the coarsest level do
+        # not change a kept frame
+        step = self.chunk_alignment
+        reach = (self._filter_length - 1) * (step - 1)
+        return -(-max(self.overlap, reach) // step) * step
+
+    def noise_windows(self, shape):
+        """
+        (start, stop) frame windows that estimate_thresholds() samples from a
+        movie of `shape`. They depend on the shape only, never on the chunking.
+        """
+        n_frames = shape[0]
+        frame_bytes = int(np.prod(shape[1:], dtype=np.int64)) * 4
+        step = self.chunk_alignment
+        length = max(NOISE_SAMPLE_BYTES // NOISE_SAMPLE_WINDOWS // max(frame_bytes, 1),
+                     self._filter_length * step) // step * step
+        if n_frames <= NOISE_SAMPLE_WINDOWS * length:
+            # Consecutive windows, the remainder joins the last one
+            starts = list(range(0, max(n_frames - length, 0) + 1, length))
+            return [(start, stop) for start, stop in zip(starts, starts[1:] + [n_frames])]
+        starts = np.linspace(0, n_frames - length, NOISE_SAMPLE_WINDOWS).astype(np.int64) // step * step
+        return [(int(start), int(start) + length) for start in starts]
+
+    def prepare_bytes(self, source):
+        """
+        Upper bound of the frame data prepare(source) holds at once: the
+        finest detail coefficients of the sample plus its longest window as
+        read from `source` (see StageInput.block_bytes).
+        """
+        windows = self.noise_windows(source.shape)
+        frame_bytes = int(np.prod(source.shape[1:], dtype=np.int64)) * 4
+        longest = max(hi - lo for lo, hi in windows)
+        block_bytes = getattr(source, 'block_bytes', None)
+        read = block_bytes(longest) if block_bytes is not None else longest * frame_bytes
+        return sum((hi - lo + self._filter_length - 1) // 2 for lo, hi in windows) * frame_bytes + read
+
+    def estimate_thresholds(self, source):
+        """
+        (levels, H * W) shrinkage thresholds of the pixels of a (T, H, W)
+        movie, from the detail coefficients of its noise_windows(), each read
+        as one block.
+        """
+        import pywt
+
+        n_pixels = int(np.prod(source.shape[1:], dtype=np.int64))
+        windows = self.noise_windows(source.shape)
+        level = min(self.level, pywt.dwt_max_level(min(hi - lo for lo, hi in windows), self._filter_length))
+        if level < 1:
+            return np.zeros((0, n_pixels), dtype=np.float32)  # too short to denoise
+        lengths = [pywt.dwt_coeff_len(hi - lo, self._filter_length, 'symmetric') for lo, hi in windows]
+        finest = np.empty((sum(lengths), n_pixels), dtype=np.float32)
+        energies = np.zeros((level, n_pixels), dtype=np.float64)
+        counts = np.zeros(level, dtype=np.int64)
+        row = 0
+        for (lo, hi), length in zip(windows, lengths):
+            traces = np.asarray(source[lo:hi], dtype=np.float32).reshape(hi - lo, -1)
+            for start in range(0, n_pixels, PIXELS_PER_BLOCK):
+                block = slice(start, start + PIXELS_PER_BLOCK)
+                coeffs = pywt.wavedec(traces[:, block], self.wavelet, level=level, axis=0, mode='symmetric')
+                finest[row:row + length, block] = np.abs(coeffs[-1])
+                energies[:, block] += _detail_energies(coeffs[1:])
+            counts += [len(d) for d in coeffs[1:]]
+            row += length
+        return shrinkage_thresholds(finest, energies, counts, source.shape[0], self.threshold_rule)
+
+    def denoise_chunk(self, frames, thresholds=None):
+        """
+        Denoise an in-memory (T, H, W) block in this process (no overlap
+        handling), with thresholds estimated from the block unless given.
+        """
+        return denoise_frames(frames, thresholds=thresholds, **self._denoise_params())
+
+    def prepare(self, source):
+        """
+        Estimate the noise thresholds of `source` for process_chunk().
+        """
+        self.close()  # a running pool holds the thresholds of the previous source
+        self._thresholds = self.estimate_thresholds(source)
+        return self
+
+    def process_chunk(self, frames, start):
+        """
+        Pipeline entry point; the pipeline supplies the temporal_overlap margins.
+        """
+        if self._thresholds is None:
+            raise RuntimeError("Call prepare() before denoising chunks")
+        frames = np.asarray(frames, dtype=np.float32)
+        n_tasks = min(self.max_workers, int(np.prod(frames.shape[1:], dtype=np.int64)) // MIN_PIXELS_PER_TASK)
+        if n_tasks > 1:
+            return self._denoise_in_pool(frames, n_tasks)
+        return self.denoise_chunk(frames, self._thresholds)
+
+    def denoise(self, source, out=None, progress=None, is_cancelled=None):
+        """
+        Stream `source` through the denoiser into `out` (float32, allocated in
+        memory if not given). Returns `out`, or None if cancelled.
+        """
+        # Imported here so the pool workers, which import this module, do not load it
+        from preprocessing_pipeline import PreprocessingPipeline
+
+        if out is None:
+            out = np.empty(source.shape, dtype=np.float32)
+        pipeline = PreprocessingPipeline(source, stages=[self],
+                                         frames_per_chunk=self._chunk_frames(tuple(source.shape[1:])))
+        if pipeline.run(out=out, progress=progress, is_cancelled=is_cancelled) is None:
+            return None
+
+        stats = pipeline.last_run_stats
+        self.last_run_stats = {'frames': stats['frames'], 'seconds': stats['seconds'],
+                               'frames_per_second': stats['frames_per_second'],
+                               'chunks': stats['chunks']}
+        return out
+
+    def timing_report(self):
+        """
+        One-line summary of last_run_stats.
+        """
+        stats = self.last_run_stats
+        if stats is None:
+            return "No run yet."
+        return (f"wavelet_denoising {self.params()}: {stats['frames']} frames in {stats['chunks']} "
+                f"chunks, {stats['seconds']:.2f}s ({stats['frames_per_second']:.0f} frames/s)")
+
+    # -- process pool ----------------------------------------------------------
+    def _get_pool(self):
+        if self._pool is None:
+            thresholds = self._thresholds
+            self._threshold_block = shared_memory.SharedMemory(create=True, size=max(thresholds.nbytes, 1))
+            np.ndarray(thresholds.shape, dtype=np.float32, buffer=self._threshold_block.buf)[...] = thresholds
+            self._pool = make_spawn_pool(self.max_workers, initializer=_attach_thresholds,
+                                         initargs=(self._threshold_block.name, thresholds.shape))
+        return self._pool
+
+    def _get_slots(self, nbytes):
+        # Input and output blocks, grown when a longer chunk arrives
+        if self._slots is None or self._slots[0].size < nbytes:
+            self._release_slots()
+            self._slots = (shared_memory.SharedMemory(create=True, size=nbytes),
+                           shared_memory.SharedMemory(create=True, size=nbytes))
+        return self._slots
+
+    def _release_slots(self):
+        for shm in self._slots or ():
+            shm.close()
+            shm.unlink()
+        self._slots = None
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+            self._pool = None
+        self._release_slots()
+        if self._threshold_block is not None:
+            self._threshold_block.close()
+            self._threshold_block.unlink()
+            self._threshold_block = None
+
+    def _denoise_in_pool(self, frames, n_tasks):
+        pool = self._get_pool()
+        shm_in, shm_out = self._get_slots(frames.nbytes)
+        block = np.ndarray(frames.shape, dtype=np.float32, buffer=shm_in.buf)
+        block[...] = frames
+        del block
+        bounds = np.linspace(0, int(np.prod(frames.shape[1:], dtype=np.int64)), n_tasks + 1).astype(np.int64)
+        futures = [pool.submit(_denoise_shared_pixels, shm_in.name, shm_out.name, frames.shape,
+                               (int(first), int(last)), self._denoise_params())
+                   for first, last in zip(bounds[:-1], bounds[1:])]
+        for future in futures:
+            future.result()
+        result = np.ndarray(frames.shape, dtype=np.float32, buffer=shm_out.buf)
+        denoised = result.copy()
+        del result  # release the buffer export before the slot can be closed
+        return denoised